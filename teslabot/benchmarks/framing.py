@@ -0,0 +1,97 @@
+"""
+Measures how many lines per second the incoming line framer can split.
+
+Run from 'teslabot' dir with
+    python -m benchmarks.framing [transcript]
+
+transcript is a recorded server transcript (raw bytes, CRLF terminated). If it is
+omitted, a synthetic 10 MB transcript dominated by NAMES/WHO replies is generated.
+"""
+
+import random
+import sys
+import time
+
+from framer import LineFramer
+
+TRANSCRIPT_SIZE = 10 * 1024 * 1024
+CHUNK_SIZES = (512, 16384)
+
+
+def make_transcript(size = TRANSCRIPT_SIZE):
+    """Returns a synthetic transcript that resembles the burst sent on join."""
+    rand = random.Random(0)
+    nicks = ['user{0}'.format(i) for i in range(5000)]
+    lines = []
+    total = 0
+
+    while total < size:
+        kind = rand.random()
+        if kind < 0.4:
+            names = ' '.join(rand.choice(('', '@', '+')) + rand.choice(nicks)
+                             for i in range(30))
+            line = ':irc.server.net 353 Teslabot = #channel :{0}'.format(names)
+        elif kind < 0.8:
+            nick = rand.choice(nicks)
+            line = ':irc.server.net 352 Teslabot #channel ~{0} host-{1}.example.com ' \
+                   'irc.server.net {0} H :0 {0}'.format(nick, rand.randint(0, 99999))
+        else:
+            nick = rand.choice(nicks)
+            line = ':{0}!~{0}@host.example.com PRIVMSG #channel :{1}'.format(
+                nick, ' '.join(rand.choice(nicks) for i in range(8)))
+        lines.append(line)
+        total += len(line) + 2
+
+    return '\r\n'.join(lines) + '\r\n'
+
+
+def legacy_split(data, chunk_size):
+    """The string concatenation and split() approach that IRC._recv used to take."""
+    buffer = ''
+    count = 0
+
+    for i in xrange(0, len(data), chunk_size):
+        buffer = buffer + data[i:i + chunk_size]
+        lines = buffer.split('\r\n')
+        buffer = lines.pop()
+
+        if lines and lines[0] == '':
+            lines.pop(0)
+        for line in lines:
+            line.decode('utf-8', 'ignore')
+            count += 1
+    return count
+
+
+def framer_split(data, chunk_size):
+    framer = LineFramer()
+    count = 0
+
+    for i in xrange(0, len(data), chunk_size):
+        for line in framer.feed(data[i:i + chunk_size]):
+            line.decode('utf-8', 'ignore')
+            count += 1
+    return count
+
+
+def measure(func, data, chunk_size):
+    start = time.time()
+    count = func(data, chunk_size)
+    elapsed = time.time() - start
+    return count, elapsed
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'rb') as f:
+            data = f.read()
+    else:
+        data = make_transcript()
+
+    print('Transcript: {0:.1f} MiB'.format(len(data) / 1024.0 / 1024))
+
+    for chunk_size in CHUNK_SIZES:
+        for name, func in (('legacy', legacy_split), ('framer', framer_split)):
+            count, elapsed = measure(func, data, chunk_size)
+            print('{0:>6} chunk={1:>5}: {2} lines in {3:.3f}s ({4:,.0f} lines/s)'.format(
+                name, chunk_size, count, elapsed, count / elapsed))
@@ -0,0 +1,143 @@
+"""
+Measures how much memory the tracked network state takes per user.
+
+Run from 'teslabot' dir with
+    python -m benchmarks.memory [users]
+
+A synthetic network of 200k users (by default) spread over a few hundred channels is
+loaded into a UserList and a ChannelList, the same way NAMES replies and messages
+would populate them. The size is the sum of sys.getsizeof() over every object that
+is reachable from both lists, counting shared objects once. For comparison, the same
+network is also loaded into the dict-based layout that User and UserModes used to have.
+"""
+
+import random
+import sys
+import time
+import types
+
+from channel import ChannelList
+from user import UserList
+import user as user_module
+
+USERS = 200000
+CHANNELS = 500
+
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType)
+
+
+def deep_sizeof(*roots):
+    """Returns the total size of the objects reachable from the roots, in bytes."""
+    seen = set()
+    stack = list(roots)
+    total = 0
+
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SKIP_TYPES):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        else:
+            if hasattr(obj, '__dict__'):
+                stack.append(obj.__dict__)
+            for cls in type(obj).__mro__:
+                for slot in cls.__dict__.get('__slots__', ()):
+                    if hasattr(obj, slot):
+                        stack.append(getattr(obj, slot))
+    return total
+
+
+def make_network(users = USERS, channels = CHANNELS):
+    """Returns a list of (source, [(channel, prefix modes)]) pairs."""
+    rand = random.Random(0)
+    chans = [u'#channel{0}'.format(i) for i in range(channels)]
+    idents = [u'~quassel', u'~znc', u'~weechat', u'~user']
+    gateways = [u'gateway/web/irccloud.com', u'gateway/tor-sasl/user', u'services']
+    network = []
+
+    for i in xrange(users):
+        nick = u'user{0}'.format(i) if rand.random() < 0.8 else u'User{0}'.format(i)
+        kind = rand.random()
+        if kind < 0.5:
+            src = u'{0}!~{1}@host-{2}.example.com'.format(nick, nick.lower(), i)
+        elif kind < 0.8:
+            src = u'{0}!{1}@user/{2}'.format(nick, rand.choice(idents), nick.lower())
+        else:
+            src = u'{0}!{1}@{2}'.format(nick, rand.choice(idents), rand.choice(gateways))
+
+        joins = []
+        for chan in rand.sample(chans, rand.randint(1, 3)):
+            kind = rand.random()
+            modes = 'o' if kind < 0.01 else 'v' if kind < 0.06 else ''
+            joins.append((chan, modes))
+        network.append((src, joins))
+    return network
+
+
+def load(network):
+    users = UserList()
+    channels = ChannelList(users)
+
+    for src, joins in network:
+        user = users.get(src)
+        for chan, modes in joins:
+            for mode in modes:
+                user.modes.add(chan, mode)
+            channels.get(chan).add(user, modes)
+    # The lists themselves also hold a logger, which isn't part of the state
+    return users._users, channels._channels
+
+
+def load_legacy(network):
+    """Loads the network into per-instance dicts, lists of modes and sets of prefixes."""
+    class LegacyUser(object):
+        pass
+
+    users = {}
+    channels = {}
+
+    for src, joins in network:
+        nick, sep, rest = src.partition('!')
+        real, sep, host = rest.partition('@')
+
+        user = LegacyUser()
+        user.nick, user.real, user.host = nick, real, host
+        user.server, user.idle, user.signon = False, 0, 0
+        user._admin, user._ahost, user._areal = False, host, real
+        user.modes = LegacyUser()
+        user.modes._modes = {}
+        user.modes._privileges = {'v': 1, 'o': 2, 'h': 3, 'a': 4, 'q': 5}
+        key = nick.lower()
+        users[key] = user
+
+        for chan, modes in joins:
+            for mode in modes:
+                user.modes._modes.setdefault(chan, []).append(mode)
+            members, prefixes = channels.setdefault(chan.lower(), ({}, {}))
+            members[key] = user
+            prefixes[key] = set(modes)
+    return users, channels
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    network = make_network(count)
+    print('Network: {0} users, {1} memberships'.format(
+        count, sum(len(joins) for src, joins in network)))
+
+    for name, func in (('legacy', load_legacy), ('compact', load)):
+        start = time.time()
+        state = func(network)
+        elapsed = time.time() - start
+
+        size = deep_sizeof(state, user_module._interned)
+        print('{0:>7}: {1:.1f} MiB, {2:.0f} bytes/user (loaded in {3:.2f}s)'.format(
+            name, size / 1024.0 / 1024, float(size) / count, elapsed))
+        del state
@@ -0,0 +1,164 @@
+"""A thread-safe LRU cache whose entries expire, optionally backed by sqlite.
+
+    cache = Cache(max_entries=1000, ttl=3600)
+    title = cache.get_or_set(url, fetch_title, url)
+
+With a path, entries are also written to a sqlite database, so they survive a restart
+(or a plugin reload). Persisted values must be JSON-serializable.
+"""
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+MISSING = object()
+
+
+class Cache(object):
+    """An LRU cache with a time-to-live per entry.
+
+    Attributes:
+        max_entries: The maximum number of entries kept in memory (and on disk)
+        ttl: The default number of seconds an entry is fresh for, or None for no limit
+        hits: The number of lookups that found a fresh entry
+        misses: The number of lookups that didn't
+        expirations: The number of entries dropped because they had expired
+        evictions: The number of entries dropped to make room for new ones
+
+        _entries: An OrderedDict of keys to (value, expiry time or None) pairs, from
+            the least recently used to the most recently used
+        _db: A sqlite3 connection, or None
+    """
+    def __init__(self, max_entries = 1024, ttl = None, path = None):
+        self.logger = logging.getLogger('teslabot.cache')
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.expirations = 0
+        self.evictions = 0
+
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+        self._db = None
+        if path:
+            self._open(path)
+
+    def _open(self, path):
+        # The connection is shared by the threads of the plugin, under _lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                         'value TEXT NOT NULL, expires REAL)')
+        self._db.execute('DELETE FROM cache WHERE expires < ?', (time.time(),))
+        self._db.commit()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return self.get(key, MISSING) is not MISSING
+
+    def get(self, key, default = None):
+        """Returns the value of a fresh entry, or default."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None and self._db:
+                entry = self._load(key)
+            if entry is not None and entry[1] is not None and entry[1] < time.time():
+                self.expirations += 1
+                self._delete(key)
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._remember(key, entry)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl = None):
+        """Stores a value for ttl seconds (or the cache's ttl)."""
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._remember(key, (value, expires))
+            if self._db:
+                self._store(key, value, expires)
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get_or_set(self, key, func, *args):
+        """Returns the cached value of key, or calls func(*args), caches its result and
+        returns it. Exceptions raised by func aren't cached.
+
+        The lock isn't held while func runs, so concurrent misses on the same key may
+        both call it."""
+        value = self.get(key, MISSING)
+        if value is MISSING:
+            value = func(*args)
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db:
+                self._db.execute('DELETE FROM cache')
+                self._db.commit()
+
+    def stats(self):
+        """Returns a dict of the cache's counters."""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+            'expirations': self.expirations,
+            'evictions': self.evictions,
+        }
+
+    def _load(self, key):
+        row = self._db.execute('SELECT value, expires FROM cache WHERE key = ?',
+                               (key,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def _store(self, key, value, expires):
+        try:
+            self._db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)',
+                             (key, json.dumps(value), expires))
+            # Keep the most recently written entries, as many as the memory cache holds
+            self._db.execute('DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache '
+                             'ORDER BY rowid DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+            self._db.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            self.logger.warning('Failed to persist cache entry {0!r}: {1}'.format(key, e))
+
+    def _delete(self, key):
+        if self._db:
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            if self._db:
+                self._db.close()
+                self._db = None
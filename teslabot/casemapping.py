@@ -0,0 +1,38 @@
+"""Case-insensitive comparison of nicknames and channel names.
+
+IRC servers announce how they compare names with the CASEMAPPING token of RPL_ISUPPORT.
+Besides A-Z, rfc1459 treats []\\~ as the uppercase versions of {}|^, and
+strict-rfc1459 does the same except for ~ and ^.
+"""
+import string
+
+ASCII = 'ascii'
+RFC1459 = 'rfc1459'
+STRICT_RFC1459 = 'strict-rfc1459'
+
+_EXTRA = {
+    ASCII: ('', ''),
+    RFC1459: ('[]\\~', '{}|^'),
+    STRICT_RFC1459: ('[]\\', '{}|'),
+}
+
+_BYTE_TABLES = {}
+_UNICODE_TABLES = {}
+
+for _name, (_upper, _lower) in _EXTRA.items():
+    _BYTE_TABLES[_name] = string.maketrans(string.ascii_uppercase + _upper,
+                                           string.ascii_lowercase + _lower)
+    _UNICODE_TABLES[_name] = dict((ord(u), ord(l)) for u, l in
+                                  zip(string.ascii_uppercase + _upper,
+                                      string.ascii_lowercase + _lower))
+
+
+def casefold(name, casemapping = RFC1459):
+    """Returns the lowercase form of a nickname or channel name under the given
+    casemapping. Unknown casemappings are treated as rfc1459. Only ASCII letters (and
+    the casemapping's extra characters) are folded, whatever the type of name."""
+    if isinstance(name, unicode):
+        return name.translate(_UNICODE_TABLES.get(casemapping, _UNICODE_TABLES[RFC1459]))
+
+    table = _BYTE_TABLES.get(casemapping, _BYTE_TABLES[RFC1459])
+    return name.translate(table)
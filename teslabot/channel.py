@@ -1,4 +1,5 @@
-from user import User
+from user import User, PREFIX_BITS, modes_to_mask, mask_to_modes
+from casemapping import casefold, RFC1459
 import logging
 from ircconstants import *
 
@@ -7,142 +8,225 @@ class Channel(object):
     Attributes:
         name: A string of the channel's name
         topic: A string of the channel's topic
-        
-        _users: A list of a list of User class and its respective channel flag.
+        casemapping: The casemapping used to fold nicknames
+
+        _users: A dict of casefolded nicknames and their User object
+        _prefixes: A dict of casefolded nicknames and the bitmask of the prefix modes
+            that the user has in the channel (see user.PREFIX_BITS)
         _modes: A list of channel modes
     """
-    def __init__(self, name):
+    _OPER_MASK = modes_to_mask('oaq')
+
+    def __init__(self, name, casemapping = RFC1459):
         self.name = name
         self.topic = ''
-        self._users = []
+        self.casemapping = casemapping
+        self._users = {}
+        self._prefixes = {}
         self._modes = []
-        
-        self._i = 0
-        self._size = 0
-        
+
+    def _key(self, nick):
+        key = casefold(nick, self.casemapping)
+        return nick if key == nick else key
+
     def count(self):
-        """Returns the size of _users list."""
+        """Returns the number of users in the channel."""
         return len(self._users)
-    
-    def add(self, user, flag = None):
-        self._users.append([user, flag])
-        self._size += 1
-        
+
+    def add(self, user, modes = None):
+        """Adds a user to the channel. If the user is already in the channel, the given
+        prefix modes are added to the ones it already has."""
+        key = self._key(user.nick)
+        self._users[key] = user
+
+        mask = self._prefixes.get(key, 0)
+        if modes:
+            mask |= modes_to_mask(modes)
+        self._prefixes[key] = mask
+
     def __iter__(self):
-        return self
-    
-    def next(self):
-        if self._i < self._size:
-            self._i += 1
-            return self._users[self._i - 1][0]
-        else:
-            self._i = 0
-            raise StopIteration
-        
+        """Iterates over a snapshot of the channel's users, so that the channel can be
+        modified (or iterated again) during the iteration."""
+        return iter(self._users.values())
+
+    def __len__(self):
+        return len(self._users)
+
+    def __contains__(self, user):
+        """Accepts a User object or a nickname string."""
+        if isinstance(user, User):
+            return self._users.get(self._key(user.nick)) is user
+        return self._key(user) in self._users
+
     def __getitem__(self, nick):
-        for i, item in enumerate(self._users):
-            if item[0].nick == nick:
-                return self._users[i][0]
-            
+        return self._users.get(self._key(nick))
+
     def get(self, nick):
-        user = self.__getitem__(nick)
-        if user:
-            return user
-    
+        return self.__getitem__(nick)
+
     def __str__(self):
-        user_list = [x[0].nick for x in self._users]
+        user_list = [x.nick for x in self._users.values()]
         return str(user_list)
-        
+
     def remove(self, user):
-        for i, item in enumerate(self._users):
-            if item[0].nick == user.nick:
-                self._users.pop(i)
-                self._size += 1
+        key = self._key(user.nick)
+        self._users.pop(key, None)
+        self._prefixes.pop(key, None)
+
+    def rename(self, user, old_nick):
+        """Re-indexes a user of the channel after a nickname change."""
+        old_key = self._key(old_nick)
+        if self._users.get(old_key) is not user:
+            return
+
+        del self._users[old_key]
+        mask = self._prefixes.pop(old_key, 0)
+
+        key = self._key(user.nick)
+        self._users[key] = user
+        self._prefixes[key] = mask
+
+    def prefixes(self, user):
+        """Returns the set of prefix modes that a given user has in the channel."""
+        return set(mask_to_modes(self._prefixes.get(self._key(user.nick), 0)))
+
+    def set_mode(self, user, mode, value = True):
+        """Adds (or removes, if value is False) a prefix mode of a given user."""
+        key = self._key(user.nick)
+        mask = self._prefixes.get(key)
+        if mask is None:
+            return
+        if value:
+            self._prefixes[key] = mask | PREFIX_BITS.get(mode, 0)
+        else:
+            self._prefixes[key] = mask & ~PREFIX_BITS.get(mode, 0)
+
+    def is_oper(self, user):
+        """Returns true if a given user is a channel operator (or higher)."""
+        return bool(self._prefixes.get(self._key(user.nick), 0) & self._OPER_MASK)
+
+    def set_casemapping(self, casemapping):
+        self.casemapping = casemapping
+        users, prefixes = self._users, self._prefixes
+        self._users = {}
+        self._prefixes = {}
+
+        for key, user in users.items():
+            new_key = self._key(user.nick)
+            self._users[new_key] = user
+            self._prefixes[new_key] = prefixes.get(key, 0)
 
 
 class ChannelList(object):
-    """Stores a list of all currently joined channels and handles channel events."""
-    def __init__(self, users):
-        self._channels = []
+    """Stores a dict of all currently joined channels and handles channel events.
+
+    Attributes:
+        casemapping: The casemapping used to fold channel names and nicknames
+
+        _channels: A dict of casefolded channel names and their Channel object
+    """
+    def __init__(self, users, casemapping = RFC1459):
+        self._channels = {}
         self.logger = logging.getLogger('teslabot.irc.channelist')
         self._flags = {'+': 'v', '@': 'o', '%': 'h', '&': 'a', '~': 'q'}
         self._users = users
+        self.casemapping = casemapping
+
+    def _key(self, name):
+        return casefold(name, self.casemapping)
+
+    def set_prefixes(self, flags):
+        """Replaces the dict of channel prefix symbols (e.g. '@') and their mode letter
+        (e.g. 'o') that NAMES replies are parsed with."""
+        self._flags = dict(flags)
 
-        self._i = 0
-        self._size = 0
-    
     def __iter__(self):
-        return self
-    
-    def next(self):
-        if self._i < self._size:
-            self._i += 1
-            return self._channels[self._i - 1]
-        else:
-            self._i = 0
-            raise StopIteration
-    
+        """Iterates over a snapshot of the joined channels."""
+        return iter(self._channels.values())
+
+    def __len__(self):
+        return len(self._channels)
+
+    def __contains__(self, name):
+        return self._key(name) in self._channels
+
     def __getitem__(self, name):
         """Returns the unique Channel object of a given channel name."""
-        for i, item in enumerate(self._channels):
-            if item.name == name:
-                return self._channels[i]
-        raise KeyError
+        return self._channels[self._key(name)]
 
     def get(self, chan):
         """Returns a channel object. If it doesn't exist, create it.
-        
+
         Arguments:
             chan: A channel name
         """
-        channel = self.__getitem__(chan)
-        if channel:
-            return channel
-        else:
-            channel = self.add(chan)
-            return channel
-    
+        try:
+            return self.__getitem__(chan)
+        except KeyError:
+            return self.add(chan)
+
     def __str__(self):
-        return str(self._channels)
-    
+        return str([channel.name for channel in self._channels.values()])
+
     def add(self, chan):
-        channel = Channel(chan)
-        self._channels.append(channel)
-        self._size += 1
-        
+        """Creates a Channel object for a given channel name. If the channel already
+        exists, the existing object is returned."""
+        key = self._key(chan)
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = Channel(chan, self.casemapping)
+
         return channel
-    
-    def remove(self, name):
-        for i, item in enumerate(self._channels):
-            if item.name == name:
-                self._channels.pop(i)
-                self._size += 1
-        
-    def on_reply(self, rpl, args):
-        if rpl == RPL_TOPIC:
-            self.on_RPL_TOPIC(args)
-            
-        elif rpl == RPL_NAMREPLY:
-            self.on_RPL_NAMREPLY(args)
-        
-    def on_RPL_TOPIC(self, args):
-        nick, chan, topic = args.split(' ', 2)
-        
-        self.__getitem__(chan).topic = topic[1:]
-        self.logger.info('Channel topic for {0}: {1}'.format(chan, topic[1:]))
-        
-    def on_RPL_NAMREPLY(self, args):
+
+    def remove(self, channel):
+        """Accepts a Channel object or a channel name string."""
+        if isinstance(channel, Channel):
+            channel = channel.name
+        self._channels.pop(self._key(channel), None)
+
+    def rename_user(self, user, old_nick):
+        """Re-indexes a user in every channel after a nickname change."""
+        for channel in self._channels.values():
+            channel.rename(user, old_nick)
+
+    def set_casemapping(self, casemapping):
+        self.casemapping = casemapping
+        channels = self._channels.values()
+        self._channels = {}
+
+        for channel in channels:
+            channel.set_casemapping(casemapping)
+            self._channels[self._key(channel.name)] = channel
+
+    def on_RPL_TOPIC(self, user, msg):
+        nick, chan, topic = msg.args[:3]
+
+        try:
+            self.__getitem__(chan).topic = topic
+        except KeyError:
+            return
+        self.logger.info(u'Channel topic for {0}: {1}'.format(chan, topic))
+
+    def on_RPL_NAMREPLY(self, user, msg):
         """Populates the users dict of a channel object."""
-        args = args.split(' ', 3)
-        chan = args[2]
-        nicks = args[3][1:].split(' ')
-        nicks.pop() # Pop empty string
-        
+        chan = msg.args[2]
+        nicks = msg.args[3].split()
+
+        try:
+            channel = self.__getitem__(chan)
+        except KeyError:
+            return
+
         for nick in nicks:
-            if nick[0] in self._flags:
-                user = self._users[nick[1:]]
-                user.modes.add(chan, self._flags[nick[0]])
-                self.__getitem__(chan).add(user)
-            else:
-                user = self._users[nick]
-                self.__getitem__(chan).add(user)
\ No newline at end of file
+            # With multi-prefix, a nick may be preceded by several prefixes
+            modes = []
+            while nick and nick[0] in self._flags:
+                modes.append(self._flags[nick[0]])
+                nick = nick[1:]
+            if not nick:
+                continue
+
+            user = self._users[nick]
+            for mode in modes:
+                user.modes.add(channel.name, mode)
+            channel.add(user, modes)
@@ -1,6 +1,7 @@
 import ConfigParser
 import logging
 import sys
+import eventqueue
 
 class Config:
     """Extracts configuration settings from the default configuration file (teslabot.cfg)."""
@@ -48,6 +49,27 @@ class Config:
         except ConfigParser.NoOptionError:
             self.logging = logging.INFO
 
+        try:
+            self.workers = self.parser.getint('teslabot', 'workers')
+        except ConfigParser.NoOptionError:
+            self.workers = 0
+
+        try:
+            self.perf_interval = self.parser.getint('teslabot', 'perf_interval')
+        except ConfigParser.NoOptionError:
+            self.perf_interval = 0
+
+        try:
+            self.metrics_port = self.parser.getint('teslabot', 'metrics_port')
+        except (ConfigParser.NoOptionError, ValueError):
+            self.metrics_port = 0
+        try:
+            self.metrics_host = self.parser.get('teslabot', 'metrics_host') or '127.0.0.1'
+        except ConfigParser.NoOptionError:
+            self.metrics_host = '127.0.0.1'
+
+        self.queue_size, self.queue_policy = self._read_queue('teslabot', 0, eventqueue.DROP_NEWEST)
+
     def read_plugins(self):
         """Extracts the list of plugins to be loaded by the IRC client."""
         try:
@@ -62,6 +84,32 @@ class Config:
         
         return self.plugins
     
+    def read_queue(self, section, size, policy):
+        """Returns the (size, policy) of the event queue of a plugin, from the queue_size
+        and queue_policy options of its section. Missing options default to size and
+        policy."""
+        try:
+            f = open(self._config)
+            self.parser.readfp(f)
+        except IOError:
+            return size, policy
+
+        return self._read_queue(section, size, policy)
+
+    def _read_queue(self, section, size, policy):
+        try:
+            size = self.parser.getint(section, 'queue_size')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+        try:
+            policy = self.parser.get(section, 'queue_policy')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            pass
+
+        if policy not in eventqueue.POLICIES:
+            raise Exception("Invalid value for 'queue_policy' configuration.")
+        return size, policy
+
     def get(self, section, option):
         try:
             f = open(self._config)
@@ -0,0 +1,182 @@
+"""Generator-based coroutines that run on the EventLoop.
+
+A coroutine is a generator function that yields Future objects. The Task that drives
+it resumes the generator on the loop's thread once the future is done, sending the
+future's result back (or throwing its exception into the generator). Yielding a list
+of futures waits for all of them and returns the list of their results. A coroutine
+returns a value by raising Return, since Python 2 generators cannot return one:
+
+    def fetch_title(self, url):
+        page = yield self.run_in_executor(download, url)
+        yield self.irch.say(title_of(page), '#channel')
+        raise Return(title_of(page))
+"""
+import threading
+import types
+
+class Return(Exception):
+    """Raised by a coroutine to return a value."""
+    def __init__(self, value = None):
+        Exception.__init__(self, value)
+        self.value = value
+
+
+class Future(object):
+    """The result of an operation that may not have completed yet.
+
+    A future can be completed from any thread. Its callbacks are always called on the
+    loop's thread.
+
+    Attributes:
+        _loop: The EventLoop that runs the callbacks
+        _callbacks: A list of callables that are called with the future once it's done
+        _done: A threading.Event that is set once the future is done
+    """
+    def __init__(self, loop):
+        self._loop = loop
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout = None):
+        """Returns the result of the future, or raises its exception. Blocks for at most
+        timeout seconds if the future isn't done yet, so it must not be called on the
+        loop's thread before the future is done.
+
+        Raises:
+            RuntimeError: The future isn't done after timeout seconds.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Future is not done.')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) on the loop's thread once the future is done. If it's
+        done already, the callback is called on the loop's next iteration."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        # Never call back right away: a coroutine that yields completed futures in a
+        # loop would otherwise recurse once per iteration.
+        self._loop.call_soon_threadsafe(callback, self)
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exception):
+        self._set(None, exception)
+
+    def _set(self, result, exception):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        self._schedule(callbacks)
+
+    def _schedule(self, callbacks):
+        if not callbacks:
+            return
+        if self._loop.in_loop_thread():
+            for callback in callbacks:
+                callback(self)
+        else:
+            for callback in callbacks:
+                self._loop.call_soon_threadsafe(callback, self)
+
+
+def completed(loop, result = None):
+    """Returns a future that is already done."""
+    future = Future(loop)
+    future.set_result(result)
+    return future
+
+
+def sleep(loop, delay, result = None):
+    """Returns a future that is done after delay seconds."""
+    future = Future(loop)
+    loop.call_later(delay, future.set_result, result)
+    return future
+
+
+def gather(loop, futures):
+    """Returns a future of the list of results of several futures. It fails with the
+    first exception raised by any of them, once every future is done."""
+    gathered = Future(loop)
+    futures = list(futures)
+    remaining = [len(futures)]
+
+    def on_done(future):
+        remaining[0] -= 1
+        if remaining[0]:
+            return
+        for f in futures:
+            if f.exception() is not None:
+                gathered.set_exception(f.exception())
+                return
+        gathered.set_result([f.result() for f in futures])
+
+    if not futures:
+        gathered.set_result([])
+    for future in futures:
+        future.add_done_callback(on_done)
+    return gathered
+
+
+class Task(Future):
+    """Drives a coroutine on the loop's thread. The task is a future of the coroutine's
+    return value."""
+    def __init__(self, loop, coro):
+        Future.__init__(self, loop)
+        self._coro = coro
+
+        if loop.in_loop_thread():
+            self._step()
+        else:
+            loop.call_soon_threadsafe(self._step)
+
+    def _step(self, value = None, exception = None):
+        try:
+            if exception is not None:
+                yielded = self._coro.throw(exception)
+            else:
+                yielded = self._coro.send(value)
+        except StopIteration:
+            self.set_result(None)
+            return
+        except Return as e:
+            self.set_result(e.value)
+            return
+        except Exception as e:
+            self.set_exception(e)
+            return
+
+        if isinstance(yielded, list):
+            yielded = gather(self._loop, yielded)
+        if not isinstance(yielded, Future):
+            self._step(exception=TypeError('Coroutines must yield futures, not {0!r}.'.format(yielded)))
+            return
+        yielded.add_done_callback(self._wakeup)
+
+    def _wakeup(self, future):
+        if future.exception() is not None:
+            self._step(exception=future.exception())
+        else:
+            self._step(future.result())
+
+
+def is_coroutine(obj):
+    return isinstance(obj, types.GeneratorType)
@@ -0,0 +1,201 @@
+import heapq
+import fcntl
+import logging
+import os
+import select
+import threading
+import time
+import errno
+
+class Timer(object):
+    """A scheduled callback returned by EventLoop.call_later() and EventLoop.call_every().
+
+    Attributes:
+        when: UNIX time at which the callback is due
+        interval: Seconds between calls of a repeating timer, or None for a one-shot timer
+        cancelled: True once cancel() has been called
+    """
+    def __init__(self, when, callback, args, interval = None):
+        self.when = when
+        self.interval = interval
+        self.cancelled = False
+        self._callback = callback
+        self._args = args
+
+    def __lt__(self, other):
+        return self.when < other.when
+
+    def cancel(self):
+        self.cancelled = True
+
+    def _run(self):
+        self._callback(*self._args)
+
+
+class EventLoop(object):
+    """A select()-based reactor that multiplexes socket readiness and timers on a
+    single thread.
+
+    Other threads must not touch the reader/writer tables directly. Instead, they
+    hand work to the loop with call_soon_threadsafe(), which wakes select() up
+    through a self-pipe.
+
+    Attributes:
+        running: Whether or not run() is currently looping
+
+        _readers: A dict of file descriptors and their (file object, callback) pair
+        _writers: A dict of file descriptors and their (file object, callback) pair
+        _timers: A heap of Timer objects ordered by due time
+        _pending: A list of callbacks queued by call_soon_threadsafe()
+    """
+    def __init__(self):
+        self.logger = logging.getLogger('teslabot.eventloop')
+        self.running = False
+
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._pending = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+        self._wake_r, self._wake_w = os.pipe()
+        for fd in (self._wake_r, self._wake_w):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def _fd(self, fileobj):
+        if isinstance(fileobj, int):
+            return fileobj
+        return fileobj.fileno()
+
+    def add_reader(self, fileobj, callback):
+        """Calls callback() whenever fileobj is ready to be read."""
+        self._readers[self._fd(fileobj)] = (fileobj, callback)
+
+    def remove_reader(self, fileobj):
+        try:
+            del self._readers[self._fd(fileobj)]
+        except (KeyError, ValueError, OSError):
+            # The descriptor may already be closed; drop any stale entry by object.
+            for fd, item in self._readers.items():
+                if item[0] is fileobj:
+                    del self._readers[fd]
+
+    def add_writer(self, fileobj, callback):
+        """Calls callback() whenever fileobj is ready to be written to."""
+        self._writers[self._fd(fileobj)] = (fileobj, callback)
+
+    def remove_writer(self, fileobj):
+        try:
+            del self._writers[self._fd(fileobj)]
+        except (KeyError, ValueError, OSError):
+            for fd, item in self._writers.items():
+                if item[0] is fileobj:
+                    del self._writers[fd]
+
+    def call_later(self, delay, callback, *args):
+        """Schedules a one-shot callback in delay seconds. Returns a Timer."""
+        timer = Timer(time.time() + delay, callback, args)
+        self._add_timer(timer)
+        return timer
+
+    def call_every(self, interval, callback, *args):
+        """Schedules callback every interval seconds. Returns a Timer.
+
+        The next due time is computed from the previous due time rather than from
+        the time the callback finished, so the timer doesn't drift.
+        """
+        timer = Timer(time.time() + interval, callback, args, interval)
+        self._add_timer(timer)
+        return timer
+
+    def _add_timer(self, timer):
+        if self.in_loop_thread():
+            heapq.heappush(self._timers, timer)
+        else:
+            self.call_soon_threadsafe(heapq.heappush, self._timers, timer)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """Queues callback to run on the loop's thread and wakes the loop up."""
+        with self._lock:
+            self._pending.append((callback, args))
+        try:
+            os.write(self._wake_w, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def in_loop_thread(self):
+        return self._thread is None or self._thread is threading.current_thread()
+
+    def _next_timeout(self, timeout):
+        while self._timers and self._timers[0].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            delay = max(0, self._timers[0].when - time.time())
+            if timeout is None or delay < timeout:
+                return delay
+        return timeout
+
+    def run_once(self, timeout = None):
+        """Waits for I/O or the next timer (at most timeout seconds) and runs
+        every callback that is ready."""
+        self._thread = threading.current_thread()
+        timeout = self._next_timeout(timeout)
+
+        rlist = [self._wake_r] + self._readers.keys()
+        wlist = self._writers.keys()
+
+        try:
+            r, w, x = select.select(rlist, wlist, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+
+        if self._wake_r in r:
+            r.remove(self._wake_r)
+            os.read(self._wake_r, 4096)
+
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for callback, args in pending:
+            callback(*args)
+
+        for fd in r:
+            item = self._readers.get(fd)
+            if item:
+                item[1]()
+        for fd in w:
+            item = self._writers.get(fd)
+            if item:
+                item[1]()
+
+        self._run_timers()
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0].when <= now:
+            timer = heapq.heappop(self._timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.when += timer.interval
+                # Skip missed ticks instead of firing them in a burst, but stay
+                # aligned to the original schedule.
+                if timer.when <= now:
+                    missed = int((now - timer.when) / timer.interval) + 1
+                    timer.when += missed * timer.interval
+                heapq.heappush(self._timers, timer)
+            timer._run()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            self.run_once()
+
+    def stop(self):
+        self.running = False
+        if not self.in_loop_thread():
+            self.call_soon_threadsafe(lambda: None)
@@ -0,0 +1,157 @@
+import collections
+import threading
+import time
+import Queue
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE)
+
+
+def _key(item):
+    """Returns what makes two items the same for the coalesce policy: the event, and
+    the Hook of a _run_hook."""
+    if item[0] == '_run_hook':
+        return item[0], item[1][0]
+    return item[0]
+
+
+class EventQueue(object):
+    """A queue of [event, args] items for a plugin, with an optional bound.
+
+    When the queue is full, put() applies the queue's policy:
+        drop-oldest: Drops the oldest event to make room for the new one.
+        drop-newest: Drops the new event.
+        coalesce: Replaces the oldest queued event of the same type (e.g. the previous
+            on_channel_message) with the new one. If there is none, the new event
+            is dropped.
+
+    Forced items are never dropped or replaced, by any policy. put() never waits for
+    room: events come from the event loop's thread, which can't stop to wait.
+
+    get() raises Queue.Empty like Queue.Queue, so it can be used in its place.
+
+    Attributes:
+        maxsize: The maximum number of events, or 0 for an unbounded queue
+        policy: One of POLICIES
+        queued: The number of events that were queued
+        dropped: The number of events that were dropped (coalesced ones excluded)
+        coalesced: The number of events that replaced an older one
+        max_depth: The largest number of events that were waiting at once
+        last_wait: The number of seconds the item last returned by get() waited
+
+        _items: A deque of (item, time queued, forced) tuples
+    """
+    def __init__(self, maxsize = 0, policy = DROP_NEWEST):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy [{0}].'.format(policy))
+
+        self.maxsize = maxsize
+        self.policy = policy
+
+        self.queued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_wait = 0.0
+
+        self._items = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def qsize(self):
+        return len(self._items)
+
+    def put(self, item, force = False):
+        """Queues an [event, args] item. Returns True if the queue has grown, or False
+        if the item was dropped or took the place of another one.
+
+        A forced item (e.g. on_exit) is queued even if the queue is full, and stays
+        queued until get() returns it."""
+        with self._cond:
+            if self.maxsize and len(self._items) >= self.maxsize and not force:
+                if self.policy == DROP_OLDEST:
+                    self.dropped += 1
+                    if not self._drop_oldest():
+                        return False
+                    self._append(item)
+                    return False
+                elif self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                else:
+                    return self._coalesce(item)
+
+            self._append(item, force)
+            return True
+
+    def _append(self, item, force = False):
+        self._items.append((item, time.time(), force))
+        self.queued += 1
+        if len(self._items) > self.max_depth:
+            self.max_depth = len(self._items)
+        self._cond.notify_all()
+
+    def _drop_oldest(self):
+        """Removes the oldest item that isn't forced. Returns False if every item is
+        forced."""
+        for i, (queued, when, forced) in enumerate(self._items):
+            if not forced:
+                del self._items[i]
+                return True
+        return False
+
+    def _coalesce(self, item):
+        key = _key(item)
+        for i, (queued, when, forced) in enumerate(self._items):
+            if not forced and _key(queued) == key:
+                del self._items[i]
+                self._items.append((item, time.time(), False))
+                self.coalesced += 1
+                return False
+
+        self.dropped += 1
+        return False
+
+    def get(self, block = True, timeout = None):
+        """Removes and returns the oldest item.
+
+        Raises:
+            Queue.Empty: There is no item (after timeout seconds, if block is True).
+        """
+        with self._cond:
+            if block:
+                deadline = None if timeout is None else time.time() + timeout
+                while not self._items:
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self._cond.wait(remaining)
+            if not self._items:
+                raise Queue.Empty
+            item, queued, forced = self._items.popleft()
+            self.last_wait = time.time() - queued
+            self._cond.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def stats(self):
+        """Returns a dict of the queue's counters."""
+        return {
+            'depth': len(self._items),
+            'max_depth': self.max_depth,
+            'maxsize': self.maxsize,
+            'policy': self.policy,
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'coalesced': self.coalesced,
+        }
@@ -0,0 +1,75 @@
+class LineFramer(object):
+    """Splits a stream of bytes into lines.
+
+    Incoming data is appended to a single bytearray. On every feed(), the last line
+    terminator is located with rfind(), starting where the previous scan stopped, and
+    the block of complete lines is copied out of the buffer exactly once through a
+    memoryview and split in a single pass. The buffer is compacted once per feed()
+    rather than once per line.
+
+    CRLF, LF and CR terminators are accepted, since none of them may appear inside an
+    IRC message. A CR at the end of the buffer isn't taken as a terminator until the
+    next feed() shows whether a LF follows it. Empty lines are skipped.
+
+    Attributes:
+        max_line: The maximum length of a line in bytes, excluding its terminator. Longer
+            lines are dropped.
+        overflows: The number of lines dropped because they exceeded max_line
+
+        _buffer: A bytearray holding a partial line
+        _discarding: Whether or not the rest of an overlong line is being skipped
+    """
+    # 8191 bytes of IRCv3 message tags followed by a 512 byte RFC 1459 message
+    MAX_LINE = 8191 + 512
+
+    def __init__(self, max_line = MAX_LINE):
+        self.max_line = max_line
+        self.overflows = 0
+
+        self._buffer = bytearray()
+        self._discarding = False
+
+    def __len__(self):
+        """Returns the number of buffered bytes that don't form a complete line yet."""
+        return len(self._buffer)
+
+    def clear(self):
+        del self._buffer[:]
+        self._discarding = False
+
+    def feed(self, data):
+        """Appends data to the buffer and returns a list of complete lines (byte strings)
+        without their terminators."""
+        buf = self._buffer
+        # The buffered partial line is known not to contain a terminator, except for a
+        # trailing CR that may be the first half of a CRLF.
+        scan = max(len(buf) - 1, 0)
+        buf.extend(data)
+
+        end = max(buf.rfind('\n', scan), buf.rfind('\r', scan, len(buf) - 1))
+        if end == -1:
+            if len(buf) > self.max_line:
+                # Drop the partial line and skip the remainder up to the next terminator.
+                del buf[:]
+                if not self._discarding:
+                    self.overflows += 1
+                self._discarding = True
+            return []
+
+        # The buffer cannot be resized while a memoryview of it exists.
+        view = memoryview(buf)
+        lines = view[:end].tobytes().splitlines()
+        del view
+        del buf[:end + 1]
+
+        if self._discarding:
+            self._discarding = False
+            if lines:
+                lines.pop(0)
+
+        if lines and max(map(len, lines)) > self.max_line:
+            count = len(lines)
+            lines = [line for line in lines if len(line) <= self.max_line]
+            self.overflows += count - len(lines)
+
+        return filter(None, lines)
@@ -2,6 +2,13 @@ from ircconstants import *
 from user import User
 from user import UserList
 from channel import ChannelList
+from statesync import StateSync
+from eventloop import EventLoop
+from framer import LineFramer
+from ircmessage import Dispatcher, parse
+from outbound import OutboundQueue, split_utf8
+from coroutine import Future
+from perf import Histogram
 import socket
 import sys
 import time
@@ -19,33 +26,54 @@ class IRC(object):
         user: A User object to store the bot's user details
         logger: A Logger object
         channels: A ChannelList object
+        statesync: A StateSync object that fills in the users of joined channels with WHO
+        dispatcher: A Dispatcher object that routes messages to their handlers
+        isupport: A dict of the RPL_ISUPPORT tokens advertised by the server
+        outbound: An OutboundQueue object that paces outgoing messages
         admins: A list of User objects
         ssl: A boolean to enable or disable SSL wrapper
         
         _init_channels: A list of channels that is joined when the client is connected
         _reconnect: Whether or not to reconnect when socket connection is lost
         _password: The connection password (if any)
-        _buffer: A socket buffer string
+        _framer: A LineFramer object that splits the socket stream into messages
         
         _oper: Boolean indicating whether or not the server accepts the client as an IRCOP
+        _registered: Boolean indicating whether or not the server has welcomed the client
         _oper_user: A username string argument for the OPER command
         _oper_pass: A password string argument for the OPER command
         
+        loop: An EventLoop object that drives the socket and the keepalive timers
+        
         _ping: UNIX time of last ping request
-        _stimeout_count: A counter to keep track of the number of timeouts
-        _SOCKET_TIMEOUT: The number of seconds before the socket times out
+        _keepalive_timer: The Timer of the next keepalive check
+        _SOCKET_TIMEOUT: The number of seconds before a blocking socket operation times out
         _PING_TIMEOUT: The number of seconds after which a PING message is considered timed out
-        _PING_FREQUENCY: The number of seconds (in multiples of _SOCKET_TIMEOUT) that must elapse
-            before a PING message is sent to the server.
+        _PING_INTERVAL: The number of idle seconds that must elapse before a PING message is
+            sent to the server.
+        _RECV_SIZE: The maximum number of bytes read from the socket at once
+        _SEND_RATE: The number of messages per second sent once the burst is exhausted
+        _SEND_BURST: The number of messages that can be sent at once without throttling
         
         _last_msg: UNIX time of latest received message
+        
+        received: The number of messages received
+        reconnects: The number of reconnection attempts
+        parse_time: A Histogram of the time taken to parse a message
     """
+    # Parsing a message takes microseconds, not milliseconds
+    PARSE_BOUNDS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.01)
+
     def __init__(self, nick, realname, channels, admins, _ssl = False, reconnect = False,
                   password = False, oper_user = False, oper_pass = False):
         self.users = UserList()
         self.user = User(nick=nick, real=realname)
         self.users.append(self.user)
         self.channels = ChannelList(self.users)
+        self.statesync = StateSync(self)
+        self.dispatcher = Dispatcher()
+        self.isupport = {}
+        self._register_handlers()
 
         self._nick = nick
         self._real = realname
@@ -56,25 +84,33 @@ class IRC(object):
         self._reconnect = reconnect
         self._reconnect_time = 0
         self._password = password
-        self._buffer = ''
+        self._framer = LineFramer()
         self._ipaddr = None
         
         self._oper = False
+        self._registered = False
         self._oper_user = oper_user
         self._oper_pass = oper_pass
         
-        self._msg_time = []
-        self._msg_last_id = 0
-        self._max_mps = 5
-        self._throttle = False
+        self._SEND_RATE = 1.0
+        self._SEND_BURST = 5
+        self.outbound = OutboundQueue(self._write, self._SEND_RATE, self._SEND_BURST)
+
+        self.loop = EventLoop()
+        self.sock = None
 
         self._ping = 0
-        self._stimeout_count = 0
+        self._keepalive_timer = None
         self._SOCKET_TIMEOUT = 5
         self._PING_TIMEOUT = 5
-        self._PING_FREQUENCY = 12
+        self._PING_INTERVAL = 60
+        self._RECV_SIZE = 16384
         
         self._last_msg = 0
+        
+        self.received = 0
+        self.reconnects = 0
+        self.parse_time = Histogram(self.PARSE_BOUNDS)
 
         self.alive = 1
         
@@ -85,17 +121,72 @@ class IRC(object):
 
     def run(self):
         """
-        Keeps the the connection alive by continuously calling _recv().
-        It will attempt to reconnect if connection is lost and reconnect is enabled.
+        Runs the event loop, which calls _recv() whenever the socket is readable and
+        fires the keepalive timers. It will attempt to reconnect if connection is lost
+        and reconnect is enabled.
         """
         while self.alive:
             try:
-                self._recv()
+                self.loop.run_once(self._SOCKET_TIMEOUT)
             except socket.error as e:
                 self.reconnect()
 
-    def _get_headers(self):
-        return ':' + self.user.nick + '!' + self.user.real + '@' + self.user.host
+    def _get_budget(self, prefix):
+        """Returns the number of bytes left for text in a message that starts with prefix
+        once the server has prepended the bot's source to it.
+        
+        The ident may be prefixed with a tilde by the server. Until the bot knows its
+        hostname, the longest valid hostname is assumed.
+        """
+        real = self.user.real or self._real
+        host = self.user.host or 'x' * 63
+        source = u':{0}!~{1}@{2} '.format(self.user.nick, real, host)
+        
+        return 512 - len('\r\n') - len(source.encode('utf-8')) - len(prefix)
+
+    def _send_text(self, command, target, msg, future = None):
+        """Splits a message into lines that fit in the 512 byte limit and queues them
+        as a single batch.
+        
+        Args:
+            command: PRIVMSG or NOTICE
+            target: A channel or nick string
+            msg: A string (lines are separated by CRLF) or a list of lines
+            future: A Future that is completed once the batch has been written
+        
+        Returns:
+            A list of the lines that were sent, excluding empty ones.
+        
+        Raises:
+            ValueError: The target is too long to leave room for any text.
+        """
+        if type(msg) != list:
+            msg = msg.split('\r\n')
+        
+        prefix = u'{0} {1} :'.format(command, target).encode('utf-8')
+        budget = self._get_budget(prefix)
+        
+        lines = []
+        batch = []
+        for line in msg:
+            if not line:
+                continue
+            lines.append(line)
+            if isinstance(line, unicode):
+                line = line.encode('utf-8')
+            for chunk in split_utf8(line, budget):
+                batch.append(prefix + chunk)
+        
+        on_sent = None
+        if future:
+            def on_sent(error):
+                if error is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(error)
+        
+        self.outbound.put_many(batch, target.lower(), on_sent)
+        return lines
 
     def join(self, chan):
         """Accepts channel name string."""
@@ -108,27 +199,17 @@ class IRC(object):
     @nick.setter
     def nick(self, value):
         self.send('NICK {0}'.format(value))
-        self.user.nick = value
+        # Once registered, the server confirms the change with a NICK message.
+        if not self._registered:
+            self.users.rename(self.user, value)
         
     def notice(self, msg, nick):
-        """Accepts a string or a list of messages."""
-        if type(msg) == list:
-            for line in msg:
-                if len(line) > 0:
-                    self.send(u'NOTICE {0} :{1}'.format(nick, line))
-                    self.logger.info('>{0}< {1}'.format(nick, line))
-        else:
-            msg = msg.split('\r\n')
-            for line in msg:
-                maxlen = 512 - len(self._get_headers()) - len(nick) - 12
-                
-                if len(line) < maxlen:
-                    self.send('NOTICE {0} :{1}'.format(nick, line))
-                    self.logger.info('>{0}< {1}'.format(nick, line))
-                else:
-                    self.send('NOTICE {0} :{1}'.format(nick, line[:maxlen-1]))
-                    self.logger.info('>{0}< {1}'.format(nick, line[:maxlen-1]))
-                    self.notice(line, line[maxlen-1:])
+        """Accepts a string or a list of messages. Returns a Future that is done once
+        the messages have been written to the socket."""
+        future = Future(self.loop)
+        for line in self._send_text('NOTICE', nick, msg, future):
+            self.logger.info(u'>{0}< {1}'.format(nick, line))
+        return future
             
     def mode(self, target, modes = False, args = False):
         """Sends a MODE command.
@@ -147,98 +228,37 @@ class IRC(object):
     def kick(self, nick, chan, reason = ''):
         self.send(u'KICK {0} {1} :{2}'.format(chan, nick, reason))
             
-    def _get_avg_mps(self):
-        """Returns the average rate of sent messages per second."""
-        x1 = self._msg_last_id - self._max_mps
-        t1 = self._msg_time[self._msg_last_id - self._max_mps]
-        x2 = self._msg_last_id
-        t2 = self._msg_time[self._msg_last_id]
-        
-        avg_mps = (x2 - x1) / (t2 - t1)
-        
-        return avg_mps
-            
-    def _is_throttling(self):
-        """Returns true if the rate of messages per second has exceeded the limit.
-        
-        Formula:
-            (x2 - x1)/(t2 - t1) = mps (average messages per second)
-            where (x1, t1) and (x2, t2) represent amount of x messages covered in y seconds.
-            
-            The distance between (x1, t1) and (x2, t2) is determined by _max_mps (5 by default).
-            
-            If the average mps exceeds _max_mps, throttling occurs. When throttling, messages are
-            sent every 1 second. When the average mps is equal to or less than 1, throttling stops.
-            
-        Data structure:
-            _msg_time: a list of UNIX time values, whose index represents the number of messages.
-            Although in practice, the difference between each index is the only relevant fact.
-            As a result, we "pop" values from the beginning of the list that are no longer needed.
-        """
-        self._msg_time.append(time.time())
-        throttle = False
-        
-        if self._throttle:    
-            avg_mps = self._get_avg_mps()
-            
-            if self._msg_last_id % self._max_mps == 0:
-                # In order to prevent the list from growing big, we drop values we no longer need.
-                self._msg_time.pop(0)
-                self._msg_last_id -= 1
-            
-            if avg_mps <= 1:
-                self.logger.warning('Throttling disabled.')
-                self._throttle = False
-            else:
-                self.logger.warning('Throttling.')
-                throttle = True
-        
-        elif len(self._msg_time) > self._max_mps:
-            avg_mps = self._get_avg_mps()
-            
-            # In order to prevent the list from growing large, we drop values we no longer need.
-            if self._msg_last_id % self._max_mps == 0:
-                self._msg_time.pop(0)
-                self._msg_last_id -= 1
-            
-            if avg_mps >= self._max_mps:
-                self.logger.warning('Throttling enabled.')
-                self._throttle = throttle = True
-            else:
-                throttle = False
-                
-        self._msg_last_id += 1
-        return throttle
-
     def send(self, msg, silent = False):
-        """msg should be 512 bytes or less"""
+        """Queues a message for the writer thread. msg should be 512 bytes or less.
         
-        if self._is_throttling():
-            time.sleep(1)
-            
+        Messages are paced by the outbound queue's rate limiter; PING, PONG and QUIT
+        messages are written immediately. This method is thread-safe and never blocks
+        on the rate limiter.
+        """
         # Encode to bytes -- assuming it's a utf-8 string
         msg = msg.encode('utf-8')
         
-        self.sock.send(msg + '\r\n')
+        self.outbound.put(msg)
         if not silent:
             self.logger.debug('{0}'.format(msg))
 
+    def _write(self, lines):
+        """Writes a list of byte string lines to the socket. Called by the outbound queue."""
+        sock = self.sock
+        if sock is None:
+            raise socket.error('Not connected.')
+        sock.sendall(''.join([line + '\r\n' for line in lines]))
+
     def leave(self, chan, reason = 'Leaving'):
         self.send('PART {0} :{1}'.format(chan, reason))
 
     def say(self, msg, dst):
-        msg = msg.split('\r\n')
-
-        for line in msg:
-            maxlen = 512 - len(self._get_headers()) - len(dst) - 12
-            
-            if len(line) < maxlen:
-                self.send(u'PRIVMSG {0} :{1}'.format(dst, line))
-                self.logger.info(u'[{0}] <{1}> {2}'.format(dst, self.user.nick, line))
-            else:
-                self.send(u'PRIVMSG ' + dst + ' :' + line[:maxlen-1])
-                self.logger.info(u'[{0}] <{1}> {2}'.format(dst, self.user.nick, line[:maxlen-1]))
-                self.say(line[maxlen-1:], dst)
+        """Accepts a string or a list of messages. Returns a Future that is done once
+        the messages have been written to the socket."""
+        future = Future(self.loop)
+        for line in self._send_text('PRIVMSG', dst, msg, future):
+            self.logger.info(u'[{0}] <{1}> {2}'.format(dst, self.user.nick, line))
+        return future
                 
     def names(self, chan):
         self.send('NAMES {0}'.format(chan))
@@ -262,46 +282,19 @@ class IRC(object):
             return True
         return False
 
-    def _on_privmsg(self, user, args):
-        """Calls the appropriate handler for a given PRIVMSG type.
-        Either channel, private, or CTCP message.
-        
-        Args:
-            user: A User class instance
-            args: A string of arguments
-        """
-        dst, msg  = args.split(' ', 1)
-        
-        # CTCP query/reply
-        if msg[1] == '\x01' and msg[-1] == '\x01':
-            ctcp_msg = msg[2:-1]
-            if len(ctcp_msg.split()) > 1:
-                cmd, subargs = ctcp_msg.split(' ', 1)
-            else:
-                cmd = ctcp_msg
-                subargs = None
-
-            self.on_ctcp(user, cmd, subargs)
-        
-        # Channel message
-        if self.is_chan(dst[:1]):
-            self.on_channel_message(user, self.channels.get(dst), msg[1:])
-
-        # Private query
-        elif dst.lower() == self.user.nick.lower():
-            self.on_private_message(user, msg[1:])
-
-        else:
-            self.logger.warning("Unrecognized PRIVMSG format.")
-
     def quit(self, msg = 'Quitting', force = None):
         try:
             if force:
                 sys.exit()
             
             self.send('QUIT :{0}'.format(msg))
-            self.sock.close()
             self.alive = 0
+            # The socket is registered with the event loop, so it must be closed
+            # from the loop's thread.
+            if self.loop.in_loop_thread():
+                self._disconnect()
+            else:
+                self.loop.call_soon_threadsafe(self._disconnect)
         finally:
             self.logger.info('Disconnected from [{0}].'.format(self.user.host))
 
@@ -311,174 +304,312 @@ class IRC(object):
 
     def _set_hostname(self, hostname):
         self.user.host = hostname
-        
-    def _recv_timeout(self):
-        self._stimeout_count += 1
-        if self._stimeout_count >= self._PING_FREQUENCY and not self._ping:
-            self._stimeout_count = 0
+
+    def _keepalive(self):
+        """Sends a PING message once the connection has been idle for _PING_INTERVAL
+        seconds."""
+        idle = time.time() - self._last_msg
+        if idle < self._PING_INTERVAL:
+            self._keepalive_timer = self.loop.call_later(self._PING_INTERVAL - idle,
+                                                         self._keepalive)
+        else:
             self.ping()
-        elif self._ping:
-            diff = time.time() - self._ping
-            if diff >= self._PING_TIMEOUT:
-                self.logger.info('Disconnected due to timeout.')
-                self.reconnect()
+            self._keepalive_timer = self.loop.call_later(self._PING_TIMEOUT,
+                                                         self._ping_timeout)
+
+    def _ping_timeout(self):
+        """Reconnects if the server hasn't sent anything since the last PING."""
+        if self._ping and self._last_msg < self._ping:
+            self.logger.info('Disconnected due to timeout.')
+            self.reconnect()
+        else:
+            self._ping = 0
+            self._keepalive()
+
+    def _stop_keepalive(self):
+        if self._keepalive_timer:
+            self._keepalive_timer.cancel()
+            self._keepalive_timer = None
+        self._ping = 0
+
+    def _disconnect(self):
+        """Unregisters and closes the current socket, if any."""
+        self._stop_keepalive()
+        if self.sock:
+            self.loop.remove_reader(self.sock)
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+            self.sock = None
                 
-    def _recv(self, timeout = False):
-        """Processes messages received from the IRC server and calls the
-        appropriate handlers."""
-        buffer = ''
-        self._last_msg = time.time()
-        
+    def _recv(self):
+        """Reads the data available in the socket, processes messages received from the
+        IRC server and calls the appropriate handlers."""
         try:
-            buffer = self._buffer + self.sock.recv(512)
-        except (socket.error, ssl.SSLError) as e:
-            if e.message == 'The read operation timed out'\
-                    or e.message == 'timed out':
-               self._recv_timeout()
-               return
+            chunks = [self.sock.recv(self._RECV_SIZE)]
+            
+            # SSL may have decrypted more data than what was returned by recv(),
+            # which select() cannot see.
+            if self._ssl:
+                while chunks[-1] and self.sock.pending():
+                    chunks.append(self.sock.recv(self._RECV_SIZE))
         except socket.timeout:
-            self._recv_timeout()
             return
-        
-        self._buffer = ''
+        except ssl.SSLError as e:
+            if e.args[0] in (ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE) \
+                    or e.message == 'The read operation timed out':
+                return
+            raise
 
         # Server has closed the socket connection
-        if len(buffer) == 0:
+        if len(chunks[0]) == 0:
             self.logger.debug('Server has closed socket connection.')
             raise socket.error
-        
-        data = buffer.split('\r\n')
-        
-        # If not empty, this is part of a new message. Add it to the buffer.
-        self._buffer += data.pop()
 
-        # Server didn't send CRLF
-        if not len(data):
-            return
-
-        # Remove empty strings due to an \r\n in the beginning 
-        if data[0] == '':
-            data.pop(0)
-
-        for msg in data:
-            self.logger.debug('{0}'.format(msg))
-            # Assuming it's UTF-8 encoded. If not, ignore errors.
-            self._parse_message(msg.decode('utf-8', 'ignore'))
+        self._last_msg = time.time()
+        
+        for chunk in chunks:
+            for msg in self._framer.feed(chunk):
+                self.logger.debug('{0}'.format(msg))
+                # Assuming it's UTF-8 encoded. If not, ignore errors.
+                self._parse_message(msg.decode('utf-8', 'ignore'))
 
-    def _parse_message(self, msg):
-        """Parses a given IRC message."""
-        if msg[:4] == 'PING':
-            self.send('PONG {0}'.format(msg[5:]))
+    def _register_handlers(self):
+        """Registers the message handlers of the IRC core with the dispatcher.
+        
+        Other handlers (e.g. for reply numerics in ircconstants) can be added at any time
+        with dispatcher.register().
+        """
+        handlers = (
+            ('PING', self._on_PING),
+            ('PONG', self._on_PONG),
+            ('ERROR', self._on_ERROR),
+            ('PRIVMSG', self._on_PRIVMSG),
+            ('NOTICE', self._on_NOTICE),
+            ('MODE', self._on_MODE),
+            ('TOPIC', self._on_TOPIC),
+            ('JOIN', self._on_JOIN),
+            ('KICK', self._on_KICK),
+            ('NICK', self._on_NICK),
+            ('PART', self._on_PART),
+            ('QUIT', self._on_QUIT),
+            (RPL_WELCOME, self._on_RPL_WELCOME),
+            (RPL_ISUPPORT, self._on_RPL_ISUPPORT),
+            (RPL_YOUREOPER, self._on_RPL_YOUREOPER),
+            (RPL_HOSTHIDDEN, self._on_RPL_HOSTHIDDEN),
+            (RPL_WHOISUSER, self._on_whois),
+            (RPL_WHOISIDLE, self._on_whois),
+            (RPL_WHOISACTUALLY, self._on_whois),
+            (RPL_WHOISHOST, self._on_whois),
+            (ERR_NICKNAMEINUSE, self._on_ERR_NICKNAMEINUSE),
+            (RPL_TOPIC, self.channels.on_RPL_TOPIC),
+            (RPL_NAMREPLY, self.channels.on_RPL_NAMREPLY),
+            (RPL_WHOREPLY, self.statesync.on_RPL_WHOREPLY),
+            (RPL_WHOSPCRPL, self.statesync.on_RPL_WHOSPCRPL),
+            (RPL_ENDOFWHO, self.statesync.on_RPL_ENDOFWHO),
+            (RPL_MOTDSTART, self._on_motd),
+            (RPL_MOTD, self._on_motd),
+            (RPL_ENDOFMOTD, self._on_motd),
+        )
+        for command, handler in handlers:
+            self.dispatcher.register(command, handler)
+
+    def _parse_message(self, line):
+        """Parses a given IRC message and calls the handlers of its command."""
+        self.received += 1
+        start = time.time()
+        try:
+            msg = parse(line)
+        except ValueError:
+            self.logger.warning(u'Malformed message: {0}'.format(line))
             return
-
-        elif msg[:5] == 'ERROR':
-            self.quit(force=True)
+        self.parse_time.add(time.time() - start)
         
-        src, cmd, args = msg.split(' ', 2)
-        user = self.users.get(src[1:])
+        if msg.prefix:
+            user = self.users.get(msg.prefix)
+        else:
+            user = None
         
-        if cmd == 'PONG' and self._ping:
+        self.dispatcher.dispatch(user, msg)
+
+    def _on_PING(self, user, msg):
+        self.send(u'PONG :{0}'.format(msg.args[-1] if msg.args else ''))
+
+    def _on_PONG(self, user, msg):
+        if self._ping:
             diff = time.time() - self._ping
             self._ping = 0
             self.logger.debug('PONG acknowledged ({0}s).'.format(diff))
 
-        elif cmd == 'PRIVMSG':
-            self._on_privmsg(user, args)
+    def _on_ERROR(self, user, msg):
+        self.quit(force=True)
 
-        elif cmd == 'MODE':
-            args = args.split(' ', 2)
-            subargs = False
-
-            if self.is_chan(args[0]):
-                if len(args) == 3:
-                    subargs = args.pop().split()
-
-                chan, modes = args
-                channel = self.channels.get(chan)
-                self.on_channel_mode(user, channel, modes, subargs)
-            
-        elif cmd == 'NOTICE':
-            self.on_notice(user, args)
+    def _on_PRIVMSG(self, user, msg):
+        """Calls the appropriate handler for a given PRIVMSG type.
+        Either channel, private, or CTCP message.
+        """
+        if len(msg.args) < 2:
+            return
+        dst, text = msg.args[0], msg.args[-1]
+        
+        # CTCP query/reply
+        if len(text) > 1 and text[0] == '\x01' and text[-1] == '\x01':
+            cmd, sep, subargs = text[1:-1].partition(' ')
+            self.on_ctcp(user, cmd, subargs or None)
+        
+        # Channel message
+        if self.is_chan(dst):
+            self.on_channel_message(user, self.channels.get(dst), text)
 
-        elif cmd == 'TOPIC':
-            chan = args.split(' ', 1)[0]
-            topic = args.split(' ', 1)[1][1:]
+        # Private query
+        elif dst.lower() == self.user.nick.lower():
+            self.on_private_message(user, text)
 
-            self.on_channel_topic(user, self.channels[chan], topic)
+        else:
+            self.logger.warning("Unrecognized PRIVMSG format.")
 
-        elif cmd == 'JOIN':
-            if args[0] != ':':
-                chan = args
-            else:
-                chan = args[1:]
-            channel = self.channels.add(chan)
+    def _on_NOTICE(self, user, msg):
+        if msg.args:
+            self.on_notice(user, msg.args[-1])
+
+    def _on_MODE(self, user, msg):
+        args = msg.args
+        if len(args) > 1 and self.is_chan(args[0]):
+            channel = self.channels.get(args[0])
+            self.on_channel_mode(user, channel, args[1], args[2:] or False)
+
+    def _on_TOPIC(self, user, msg):
+        if len(msg.args) > 1:
+            self.on_channel_topic(user, self.channels[msg.args[0]], msg.args[1])
+
+    def _on_JOIN(self, user, msg):
+        if msg.args:
+            channel = self.channels.get(msg.args[0])
+            channel.add(user)
+            if user is self.user:
+                self.statesync.request(channel.name)
             self.on_channel_join(user, channel)
-            
-        elif cmd == 'KICK':
-            chan, target, reason = args.split(' ', 2)
-            channel = self.channels[chan]
-            target = self.users.get(target)
-            
-            self.on_channel_kick(user, channel, target, reason[1:])
-            
-        elif cmd == 'NICK':
-            self.users.get(user=user).nick = args
-
-        elif cmd == 'PART':
-            subargs = args.split()
-            
-            if len(subargs) == 2:
-                chan, reason = subargs
-                self.on_channel_part(user, self.channels[chan], reason[1:])
-            else:
-                chan = args.split()[0]
-                self.on_channel_part(user, self.channels[chan])
-
-        elif cmd == RPL_WELCOME:
-            self.on_connect()
-            
-        elif cmd == RPL_YOUREOPER:
-            self._oper = True
 
-        elif cmd == RPL_HOSTHIDDEN:
-            self._set_hostname(args)
-
-        elif cmd in (RPL_WHOISUSER, RPL_WHOISIDLE, RPL_WHOISACTUALLY,
-            RPL_WHOISHOST):
-            self._on_whois(cmd, args)
+    def _on_KICK(self, user, msg):
+        args = msg.args
+        if len(args) < 2:
+            return
+        channel = self.channels[args[0]]
+        target = self.users.get(args[1])
+        reason = args[2] if len(args) > 2 else ''
+        
+        self.on_channel_kick(user, channel, target, reason)
+        
+        target.modes.remove(channel.name, -1)
+        if target is self.user:
+            self._leave_channel(channel)
+        else:
+            channel.remove(target)
+            self._forget(target)
+
+    def _on_NICK(self, user, msg):
+        if msg.args:
+            old_nick = user.nick
+            self.users.rename(user, msg.args[0])
+            self.channels.rename_user(user, old_nick)
+
+    def _on_PART(self, user, msg):
+        args = msg.args
+        if not args:
+            return
+        reason = args[1] if len(args) > 1 else None
+        self.on_channel_part(user, self.channels[args[0]], reason)
+        self._forget(user)
 
-        elif cmd == ERR_NICKNAMEINUSE:
-            self.on_nickinuse()
+    def _on_QUIT(self, user, msg):
+        reason = msg.args[0] if msg.args else None
+        self.on_quit(user, reason)
         
-        elif cmd in (RPL_TOPIC, RPL_TOPICWHOTIME, RPL_NAMREPLY):
-            self.channels.on_reply(cmd, args)
+        for channel in self.channels:
+            channel.remove(user)
+        self._forget(user)
+
+    def _forget(self, user):
+        """Removes a user from the user list once the bot no longer shares a channel
+        with it. The bot itself and administrators are never removed."""
+        if user is self.user or user._admin:
+            return
+        for channel in self.channels:
+            if user in channel:
+                return
+        self.users.remove(user)
+
+    def _leave_channel(self, channel):
+        """Drops a channel that the bot has left, along with the users that the bot
+        no longer shares a channel with."""
+        self.channels.remove(channel)
+        self.statesync.cancel(channel.name)
+        for user in channel:
+            user.modes.remove(channel.name, -1)
+            self._forget(user)
+
+    def _on_RPL_WELCOME(self, user, msg):
+        self._registered = True
+        # The server may have accepted a different nickname than the one requested
+        if msg.params and msg.params[0] != self.user.nick:
+            self.users.rename(self.user, msg.params[0])
+        self.on_connect()
+
+    def _on_RPL_ISUPPORT(self, user, msg):
+        # The first parameter is the client's nick; the trailing one is a description.
+        for token in msg.params[1:]:
+            key, sep, value = token.partition('=')
+            if key[:1] == '-':
+                self.isupport.pop(key[1:], None)
+                continue
+            self.isupport[key] = value
             
-        elif cmd in (RPL_MOTDSTART, RPL_MOTD, RPL_ENDOFMOTD):
-            self.on_motd(args)
+            if key == 'CASEMAPPING':
+                self.users.set_casemapping(value)
+                self.channels.set_casemapping(value)
+            elif key == 'PREFIX':
+                self.statesync.set_prefix(value)
+            elif key == 'CHANMODES':
+                self.statesync.set_chanmodes(value)
+
+    def _on_RPL_YOUREOPER(self, user, msg):
+        self._oper = True
+
+    def _on_RPL_HOSTHIDDEN(self, user, msg):
+        if len(msg.args) > 1:
+            self._set_hostname(msg.args[1])
+
+    def _on_ERR_NICKNAMEINUSE(self, user, msg):
+        self.on_nickinuse()
+
+    def _on_motd(self, user, msg):
+        if msg.args:
+            self.on_motd(msg.args[-1])
             
     def on_motd(self, msg):
         if not __debug__:
-            self.logger.info(msg.split(':', 1)[1])
+            self.logger.info(msg)
             
-    def _on_whois(self, cmd, args):
+    def _on_whois(self, user, msg):
+        cmd, args = msg.command, msg.args
+        
         if cmd == RPL_WHOISUSER:
-            if args.split(' ')[1] == self.user.nick:   # Self-WHOIS
-                self._set_hostname(args.split(' ')[3])    # Get the hostname
+            if args[1] == self.user.nick:   # Self-WHOIS
+                self._set_hostname(args[3])    # Get the hostname
                 self.logger.debug('Setting hostname to [{0}].'.format(self.user.host))
             else:
                 pass
         elif cmd == RPL_WHOISIDLE:
-            args = args.split()
-            
             user = self.users.get(args[1])
             user.idle = int(args[2])
             user.signon = int(args[3])
 
-        elif cmd == RPL_WHOISACTUALLY:
-            self._ipaddr = args.split()[-1][1:-1]
+        elif cmd == RPL_WHOISACTUALLY and args[-1].split():
+            self._ipaddr = args[-1].split()[-1][1:-1]
 
-        elif cmd == RPL_WHOISHOST:
-            self._ipaddr = args.split()[-1]
+        elif cmd == RPL_WHOISHOST and args[-1].split():
+            self._ipaddr = args[-1].split()[-1]
 
     def ipaddr(self):
         return self._ipaddr
@@ -487,6 +618,10 @@ class IRC(object):
         """Attempts to establish a socket connection with a given IRC server."""
         self._host = host
         self._port = port
+        self._disconnect()
+        self._framer.clear()
+        self._registered = False
+        self.statesync.clear()
         
         try:
             self.logger.info('Connecting to {0}:{1}.'.format(host, port))
@@ -498,6 +633,13 @@ class IRC(object):
             self.sock.connect((host, port))
             self.alive = 1
             
+            self._last_msg = time.time()
+            self.loop.add_reader(self.sock, self._recv)
+            # Anything queued for the previous connection is stale.
+            self.outbound.clear()
+            self.outbound.start()
+            self._keepalive_timer = self.loop.call_later(self._PING_INTERVAL, self._keepalive)
+            
             if self._password:
                 self.send('PASS {0}'.format(self._password))
         
@@ -506,6 +648,8 @@ class IRC(object):
 
         except socket.error as e:
             self.logger.critical('Failed to connect to {0}:{1}.'.format(host, port))
+            self._disconnect()
+            self.loop.call_later(0, self.reconnect)
             
     def reconnect(self):
         if self._reconnect:
@@ -516,10 +660,13 @@ class IRC(object):
                 time.sleep(15)
                 
             self.logger.debug('Reconnecting.')
+            self.reconnects += 1
             self.connect(self._host, self._port)
             self._reconnect_time = time.time()
         else:
             self.logger.info('Reconnection disabled.')
+            self.alive = 0
+            self._disconnect()
             
     def on_connect(self):
         self.whois(self.user.nick)
@@ -537,13 +684,14 @@ class IRC(object):
         Args:
             args: A list of arguments
         """
-        for i, mode in enumerate(modes[1:]):
-            if mode in ('a', 'q', 'o', 'h', 'v'):
-                target = self.users.get(args[i])
-                if modes[0] == '+':
+        for adding, mode, arg in self.statesync.parse_modes(modes, args or []):
+            if arg and self.statesync.is_prefix_mode(mode):
+                target = self.users.get(arg)
+                if adding:
                     target.modes.add(channel.name, mode)
                 else:
                     target.modes.remove(channel.name, mode)
+                channel.set_mode(target, mode, adding)
 
     def on_channel_message(self, user, channel, msg):
         raise NotImplementedError
@@ -561,14 +709,19 @@ class IRC(object):
     def on_channel_part(self, user, channel, reason):
         """on_channel_part is called when a user (including the bot) leaves the channel."""
         user.modes.remove(channel.name, -1)
-        if user.nick == self.user.nick:
-            self.channels.remove(channel)
+        if user is self.user:
+            self._leave_channel(channel)
         else:
             channel.remove(user)
             
     def on_channel_kick(self, user, channel, target, reason):
         raise NotImplementedError
 
+    def on_quit(self, user, reason):
+        """on_quit is called when a user disconnects from the server, before it is removed
+        from every channel."""
+        pass
+
     def on_channel_topic(self, user, channel, topic):
         raise NotImplementedError
 
@@ -577,7 +730,7 @@ class IRC(object):
     
     def on_notice(self, user, msg):
         if not __debug__:
-            self.logger.info('-{0}- {1}'.format(user.nick, msg))
+            self.logger.info(u'-{0}- {1}'.format(user.nick if user else '*', msg))
 
     def on_nickinuse(self):
         raise NotImplementedError
@@ -1,8 +1,13 @@
 from irc import IRC
+from pluginbase import AsyncPluginBase
+from workerpool import WorkerPool
+from eventqueue import EventQueue
+from perf import PerfStats
 import threading
 import Queue
 import config
 import random
+import time
 
 class IRCClient(IRC):
     """IRCClient inherits the IRC core and expands it into a multi-threaded IRC
@@ -10,17 +15,40 @@ class IRCClient(IRC):
     
     Plugins share an identical IRCClient object. Public methods can be called by plugins.
     TODO: Ensure that public methods are thread-safe.
+    
+    By default, every plugin runs on a thread of its own. If workers is non-zero, plugin
+    callbacks run on a pool of that many threads instead, with a strand per plugin so
+    that the callbacks of a given plugin never run concurrently.
+    
+    Plugins derived from AsyncPluginBase always run on the event loop's thread.
+    
+    Plugin hooks are timers of the event loop (see schedule()). When a hook is due, a
+    call to it is delivered to the plugin like an event.
+    
+    Events wait for a threaded (or pooled) plugin in an EventQueue. Its bound and its
+    policy when full are queue_size and queue_policy, unless the plugin's section of the
+    configuration file sets its own.
+    
+    Every event handled by a plugin is timed (see handle_event()). The statistics are
+    written to the log every perf_interval seconds, if it's non-zero.
+    
+    When run() returns, every plugin gets on_exit (see stop_plugins()).
     """
+    _EXECUTOR_WORKERS = 8
+    SHUTDOWN_TIMEOUT = 10
+
     def __init__(self, nick, realname, channels, admin, trigger, plugins,
                   password = False, _ssl = False, reconnect = False,
-                  oper_user = False, oper_pass = False):
+                  oper_user = False, oper_pass = False, workers = 0,
+                  queue_size = 0, queue_policy = 'drop-newest', perf_interval = 0):
         IRC.__init__(self, nick, realname, channels, admin, _ssl, reconnect, password,
                      oper_user, oper_pass)
 
         self.plugins = plugins
-        self.send_lock = threading.Lock()
         self.trigger = trigger
         self._password = password
+        self.queue_size = queue_size
+        self.queue_policy = queue_policy
         
         # Stores the class instance of a plugin inside the key of any
         # event the plugin has chosen to listen for.
@@ -29,7 +57,6 @@ class IRCClient(IRC):
         self._plugin_callbacks = {
             'on_connect': [],
             'on_quit': [],
-            'on_quit': [],
             'on_whois': [],
             'on_channel_message': [],
             'on_chat_command': [],
@@ -41,9 +68,25 @@ class IRCClient(IRC):
             'on_exit': [],
             'on_load': [],
             }
+        # Maps every chat command to the list of (plugin, command type) pairs that
+        # handle it. Like _plugin_callbacks, it's rebuilt and swapped in by load_plugins().
+        self._command_index = {}
         self._plugin_threads = {}
         self._plugin_objects = []
         
+        # Maps plugin names to the (size, policy) of their event queue
+        self._queue_limits = {}
+        # With a worker pool, maps plugin names to their [plugin, strand, queue] triple
+        self._pool = None
+        self._plugin_strands = {}
+        if workers:
+            self._pool = WorkerPool(workers)
+            self._pool.start()
+        # Runs the blocking calls of asynchronous plugins (see executor())
+        self._executor = self._pool
+        # The WebClient shared by plugins (see http())
+        self._http = None
+        
         # Constants for command types: CMD_CHANNEL is a channel command,
         # CMD_PRIVATE is a private message command, and CMD_ALL is both
         self.CMD_ALL = 0
@@ -52,6 +95,10 @@ class IRCClient(IRC):
         
         self.auto_rejoin = 1
         
+        self.perf = PerfStats()
+        if perf_interval:
+            self.loop.call_every(perf_interval, self._log_perf)
+        
     def _import_plugins(self, Reload = False):
         """Imports (or reloads) modules from the list of plugins and returns a 
         list of plugin (class) objects."""
@@ -84,15 +131,28 @@ class IRCClient(IRC):
         A plugin's class object is appended to the list of an event (on_connect, etc.)
         if the plugin has chosen to listen for that specific event. The class object
         is essentially a callback for _on_event().
+        
+        The command index is built at the same time. Both tables are built from scratch
+        and replace the current ones at once, so events dispatched during a reload see
+        either the old plugins or the new ones.
         """
+        previous = self._plugin_objects if Reload else []
         plugins = self._import_plugins(Reload)
+        callbacks = dict((event, []) for event in self._plugin_callbacks)
+        commands = {}
+        c = config.Config()
         
         for p in plugins:            
             self.logger.debug('Loaded plugin [{0}].'.format(p.name))
+            self._queue_limits[p.name] = c.read_queue(p.name.lower(), self.queue_size,
+                                                      self.queue_policy)
+            
+            for cmd, ctype in p.chat_commands:
+                commands.setdefault(cmd, []).append((p, ctype))
             
             for event in p._callbacks:
                 try:
-                    self._plugin_callbacks[event].append(p)
+                    callbacks[event].append(p)
                 except KeyError:
                     self.logger.warning('Callback [{0}] for plugin [{1}] cannot be loaded.' \
                                        ' Event doesn\'t exist.'.format(event, p.name))
@@ -105,29 +165,68 @@ class IRCClient(IRC):
                         alive = t.is_alive()
                         
                         if alive:
-                            q.put(['on_exit', ''])
+                            q.put(['on_exit', ''], force=True)
                         
                         del self._plugin_threads[p.name]
                 except KeyError:
                     pass
+                
+                # Let the previous instance clean up on its strand
+                entry = self._plugin_strands.pop(p.name, None)
+                if entry:
+                    entry[1].submit(entry[0].dispatch, 'on_exit', [])
+        
+        self._plugin_callbacks = callbacks
+        self._command_index = commands
+        
+        for p in previous:
+            p.stop_hooks()
+            if isinstance(p, AsyncPluginBase):
+                self._dispatch_async(p, 'on_exit', [])
+        for p in plugins:
+            p.start(self)
         self._on_event('on_load', [])
         
+    def run(self):
+        """Runs the bot until it quits, then stops the plugins."""
+        try:
+            IRC.run(self)
+        finally:
+            self.stop_plugins()
+            
+    def stop_plugins(self, timeout = SHUTDOWN_TIMEOUT):
+        """Sends on_exit to every plugin, after the events already queued for it, and waits
+        for up to timeout seconds until they have all been handled.
+        
+        Plugin threads are daemons, so whatever a plugin hasn't done by then is lost when
+        the bot exits."""
+        for p in self._plugin_objects:
+            p.stop_hooks()
+        self._on_event('on_exit', [])
+        
+        deadline = time.time() + timeout
+        for name, (t, q) in self._plugin_threads.items():
+            t.join(max(deadline - time.time(), 0))
+        for name, (plugin, strand, q) in self._plugin_strands.items():
+            while strand.busy() and time.time() < deadline:
+                time.sleep(0.05)
+        
+        busy = [name for name, (t, q) in self._plugin_threads.items() if t.is_alive()]
+        busy += [name for name, (p, strand, q) in self._plugin_strands.items() if strand.busy()]
+        if busy:
+            self.logger.warning('Plugins still busy at shutdown: {0}'.format(', '.join(sorted(busy))))
+        
     def reload_plugins(self):
         """Reloads every plugin. In the process, it will load any new plugin added to the config
         file, and it will also unload any plugin that was removed in the config file."""
-        # Reset the list of callbacks
-        for key, value in self._plugin_callbacks.items():
-            self._plugin_callbacks[key] = []
         c = config.Config()
         self.plugins = c.read_plugins()
         self.load_plugins(Reload=True)
         
-    def _plugin_has_command(self, cmd, type, plugin):
-        """Returns true if the plugin has a command for the given type."""
-        for pcmd, ptype in plugin.chat_commands:
-            if cmd == pcmd and (ptype == self.CMD_ALL or type == ptype):
-                return True
-        return False
+    def _command_plugins(self, cmd, type):
+        """Returns the list of plugins that have a command for the given type."""
+        return [plugin for plugin, ptype in self._command_index.get(cmd, ())
+                if ptype == self.CMD_ALL or type == ptype]
 
     def _on_event(self, event, args):
         """
@@ -139,55 +238,201 @@ class IRCClient(IRC):
         event and its corresponding arguments are fed sent to the plugin's thread 
         via a Queue. 
         """
-        for plugin in self._plugin_callbacks[event]:
-            name, callback = plugin.name, plugin.run
-            
-            # We create an exception for on_channel_command event to prevent every thread that
-            # listens to a command event from being called. We only want to call the plugin
-            # that has this command.
-            if event == 'on_chat_command':
-                has_cmd = self._plugin_has_command(args[2], args[4], plugin)
-                
-                if not has_cmd:
-                    continue
+        # We create an exception for on_chat_command event to prevent every thread that
+        # listens to a command event from being called. We only want to call the plugin
+        # that has this command.
+        if event == 'on_chat_command':
+            plugins = self._command_plugins(args[2], args[4])
+        else:
+            plugins = self._plugin_callbacks[event]
+        
+        for plugin in plugins:
+            self._deliver(plugin, event, args[:4])
 
-            # Check if the plugin thread has already been initialized and alive
-            try:
-                if self._plugin_threads[name]:
-                    t, q = self._plugin_threads[name]
-                    alive = t.is_alive()
-                    
-                    if alive:
-                        # Communicate with the plugin thread
-                        q.put([event, args[:4]])
-                        self.logger.debug('New message for [{0}] triggered by [{1}].'.format(name, event))
-                    else:
-                        raise KeyError
-            # If both conditions are false, create a new thread and run it
-            except KeyError:
-                self.logger.debug('New thread for [{0}] triggered by [{1}].'.format(name, event))
-                
-                q = Queue.Queue()
-                thread = threading.Thread(target=callback, args=(q, self))
-                thread.daemon = True
-                thread.start()
-                self._plugin_threads[name] = [thread, q]
+    def _deliver(self, plugin, event, args):
+        """Feeds a single event to a plugin, in the plugin's execution model."""
+        name, callback = plugin.name, plugin.run
+        
+        if isinstance(plugin, AsyncPluginBase):
+            self._dispatch_async(plugin, event, args)
+            return
+        if self._pool:
+            self._submit(plugin, event, args)
+            return
+
+        # Check if the plugin thread has already been initialized and alive
+        try:
+            if self._plugin_threads[name]:
+                t, q = self._plugin_threads[name]
+                alive = t.is_alive()
                 
-                # Communicate with the plugin thread
-                q.put([event, args[:4]])
+                if alive:
+                    # Communicate with the plugin thread
+                    self._put(name, q, [event, args])
+                    self.logger.debug('New message for [{0}] triggered by [{1}].'.format(name, event))
+                else:
+                    raise KeyError
+        # If both conditions are false, create a new thread and run it
+        except KeyError:
+            self.logger.debug('New thread for [{0}] triggered by [{1}].'.format(name, event))
+            
+            # Whatever was queued for a dead thread is lost with its queue
+            plugin.release_hooks()
+            if event == '_run_hook':
+                args[0].pending = True
+            
+            q = self._new_queue(name)
+            thread = threading.Thread(target=callback, args=(q, self))
+            thread.daemon = True
+            thread.start()
+            self._plugin_threads[name] = [thread, q]
+            
+            # Communicate with the plugin thread
+            q.put([event, args])
+
+    def _new_queue(self, name):
+        size, policy = self._queue_limits.get(name, (self.queue_size, self.queue_policy))
+        return EventQueue(size, policy)
+
+    def _put(self, name, q, item):
+        """Puts an event in the queue of a plugin. Returns True if the queue has grown.
+        
+        Hook calls bypass the bound: a dropped call would leave its hook pending, and
+        the hook would never fire again. So does on_exit."""
+        dropped = q.dropped
+        grown = q.put(item, force=item[0] in ('_run_hook', 'on_exit'))
+        # Logging every drop would flood the log exactly when the bot is overloaded
+        if q.dropped != dropped and q.dropped & (q.dropped - 1) == 0:
+            self.logger.warning('Queue of [{0}] is full: {1} event(s) dropped so far.'.format(
+                name, q.dropped))
+        return grown
+
+    def _submit(self, plugin, event, args):
+        """Queues an event for the strand of a plugin, creating the strand on the
+        plugin's first event.
+        
+        The strand gets a task per queued event, which runs whichever event is then the
+        oldest in the queue. Events that are dropped or coalesced don't add a task."""
+        entry = self._plugin_strands.get(plugin.name)
+        if entry is None or entry[0] is not plugin:
+            self.logger.debug('New strand for [{0}] triggered by [{1}].'.format(plugin.name, event))
+            
+            entry = [plugin, self._pool.strand(plugin.name), self._new_queue(plugin.name)]
+            self._plugin_strands[plugin.name] = entry
+        
+        plugin, strand, q = entry
+        if self._put(plugin.name, q, [event, args]):
+            strand.submit(self._drain, plugin, q)
+
+    def _drain(self, plugin, q):
+        try:
+            event, args = q.get_nowait()
+        except Queue.Empty:
+            return
+        self.handle_event(plugin, event, args, q.last_wait)
+
+    def handle_event(self, plugin, event, args, wait = 0):
+        """Calls the handler of an event of a plugin and records its statistics.
+        
+        Args:
+            plugin: A PluginBase object
+            event: The name of the event
+            args: The list of arguments of the event
+            wait: The number of seconds the event has waited for the plugin
+        """
+        if event == 'on_chat_command':
+            name = 'command_{0}'.format(args[2])
+        elif event == '_run_hook':
+            name = 'hook {0}'.format(getattr(args[0].method, '__name__', '?'))
+        else:
+            name = event
+        
+        start = time.time()
+        try:
+            result = plugin.dispatch(event, args)
+        except Exception:
+            self.perf.record(plugin.name, name, wait, time.time() - start, True)
+            raise
+        self.perf.record(plugin.name, name, wait, time.time() - start)
+        return result
+
+    def _log_perf(self):
+        depths = dict((name, s['depth']) for name, s in self.queue_stats().items())
+        for line in self.perf.report():
+            self.logger.info(line)
+        if depths:
+            self.logger.info('Queue depths: {0}'.format(', '.join(
+                '{0} {1}'.format(name, depths[name]) for name in sorted(depths))))
+
+    def queue_stats(self):
+        """Returns a dict of plugin names to the counters of their event queue (see
+        EventQueue.stats())."""
+        stats = {}
+        for name, (t, q) in self._plugin_threads.items():
+            stats[name] = q.stats()
+        for name, entry in self._plugin_strands.items():
+            stats[name] = entry[2].stats()
+        return stats
+
+    def _dispatch_async(self, plugin, event, args, queued = None):
+        """Calls an event handler of an asynchronous plugin on the loop's thread."""
+        if not self.loop.in_loop_thread():
+            self.loop.call_soon_threadsafe(self._dispatch_async, plugin, event, args,
+                                           time.time())
+            return
+        
+        wait = time.time() - queued if queued else 0
+        self.handle_event(plugin, event, args, wait)
+
+    def executor(self):
+        """Returns the WorkerPool that runs blocking calls for asynchronous plugins. It's
+        the plugin worker pool if there is one, or a pool of _EXECUTOR_WORKERS threads
+        created on first use."""
+        if self._executor is None:
+            self._executor = WorkerPool(self._EXECUTOR_WORKERS)
+            self._executor.start()
+        return self._executor
 
-    def send(self, msg, silent = False):
-        """Sends a message to the IRC server."""
-        self.send_lock.acquire()
-        IRC.send(self, msg, silent)
-        self.send_lock.release()
+    def http(self):
+        """Returns the WebClient that plugins share to make HTTP requests, created on
+        first use."""
+        if self._http is None:
+            # Only the plugins that make HTTP requests need the requests package
+            from webclient import WebClient
+            self._http = WebClient(self.loop)
+        return self._http
+
+    def schedule(self, plugin, hook):
+        """Arms the timer of a plugin's Hook on the event loop. Returns the Timer.
         
+        Repeating hooks are drift-free: they fire every interval seconds from the time
+        they were armed, however long the plugin takes to run them."""
+        if hook.interval is None:
+            return self.loop.call_later(hook.delay, self._fire, plugin, hook)
+        return self.loop.call_every(hook.interval, self._fire, plugin, hook)
+
+    def _fire(self, plugin, hook):
+        # A plugin that can't keep up with a hook gets a single pending call, not a
+        # backlog of them. A call pending on a thread that has died will never run,
+        # though: delivering another one replaces the thread.
+        if hook.cancelled or hook.pending and not self._thread_died(plugin):
+            return
+        hook.pending = True
+        self._deliver(plugin, '_run_hook', [hook])
+
+    def _thread_died(self, plugin):
+        """Returns True if the thread of a plugin has exited, dropping its queue."""
+        entry = self._plugin_threads.get(plugin.name)
+        return bool(entry) and not entry[0].is_alive()
+
     def on_connect(self):
         IRC.on_connect(self)
         self._on_event('on_connect', [])
     
-    def on_quit(self):
-        raise NotImplementedError
+    def on_quit(self, user, reason):
+        IRC.on_quit(self, user, reason)
+        self.logger.info(u'{0} has quit ({1}).'.format(user.nick, reason))
+        self._on_event('on_quit', [user, reason])
     
     def on_chat_command(self, src, dst, msg):
         """Handles chat command event."""
@@ -256,8 +501,9 @@ class IRCClient(IRC):
         self.nick = self.nick + str(random.randint(0, 10))
         
     def on_exit(self):
-        """on_exit is called before the bot is shut down. Plugins should listen to this
-        event if they need to do any checks or clean ups before the bot exits.
+        """on_exit is called before the bot is shut down (see stop_plugins()). Plugins
+        should listen to this event if they need to do any checks or clean ups before the
+        bot exits.
         
         The event itself is also called when the bot reloads the plugins, though not this method."""
         pass
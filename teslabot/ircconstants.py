@@ -4,6 +4,7 @@ RPL_YOURHOST = '002'
 RPL_CREATED = '003'
 RPL_MYINFO = '004'
 RPL_BOUNCE = '005'
+RPL_ISUPPORT = '005'
 
 RPL_WHOISACTUALLY = '338'
 RPL_MOTD = '372'
@@ -16,7 +17,10 @@ RPL_WHOISUSER = '311'
 RPL_WHOISIDLE = '317'
 
 """Channel related reply numerics"""
+RPL_ENDOFWHO = '315'
 RPL_CHANNELMODEIS = '324'
+RPL_WHOSPCRPL = '354' # WHOX reply
+RPL_WHOREPLY = '352'
 RPL_TOPIC = '332'
 RPL_TOPICWHOTIME = '333'
 RPL_NAMREPLY = '353'
@@ -0,0 +1,129 @@
+"""IRC message parsing and routing.
+
+Messages have the following format (RFC 1459 with IRCv3 message tags):
+    [@tags] [:prefix] <command> [params] [:trailing]
+"""
+
+_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+
+class Message(object):
+    """A parsed IRC message.
+
+    Attributes:
+        tags: A dict of IRCv3 message tags, or None if the message has no tags
+        prefix: The source string of the message, or None if the message has no prefix
+        command: An uppercase command string or a three-digit numeric string
+        params: A list of the middle parameter strings
+        trailing: The trailing parameter string, or None if the message has none
+    """
+    __slots__ = ('tags', 'prefix', 'command', 'params', 'trailing')
+
+    def __init__(self, tags, prefix, command, params, trailing):
+        self.tags = tags
+        self.prefix = prefix
+        self.command = command
+        self.params = params
+        self.trailing = trailing
+
+    @property
+    def args(self):
+        """Returns every parameter, including the trailing one, as a list."""
+        if self.trailing is None:
+            return self.params
+        return self.params + [self.trailing]
+
+    def __repr__(self):
+        return '<Message: {0} {1} {2} {3!r}>'.format(self.prefix, self.command,
+                                                     self.params, self.trailing)
+
+
+def _unescape_tag(value):
+    if '\\' not in value:
+        return value
+
+    output = []
+    chars = iter(value)
+    for c in chars:
+        if c == '\\':
+            # A trailing backslash is dropped
+            c = next(chars, '')
+            output.append(_TAG_ESCAPES.get(c, c))
+        else:
+            output.append(c)
+    return ''.join(output)
+
+
+def parse_tags(raw):
+    """Returns a dict of IRCv3 tags from a raw tag string (without the leading @).
+    Tags without a value are mapped to an empty string."""
+    tags = {}
+    for tag in raw.split(';'):
+        if not tag:
+            continue
+        key, sep, value = tag.partition('=')
+        tags[key] = _unescape_tag(value)
+    return tags
+
+
+def parse(line):
+    """Parses a raw IRC line into a Message object.
+
+    Raises:
+        ValueError: The line doesn't contain a command.
+    """
+    tags = None
+    prefix = None
+
+    if line[:1] == '@':
+        raw_tags, sep, line = line[1:].partition(' ')
+        tags = parse_tags(raw_tags)
+        line = line.lstrip(' ')
+
+    if line[:1] == ':':
+        prefix, sep, line = line[1:].partition(' ')
+        line = line.lstrip(' ')
+
+    if line[:1] == ':':
+        raise ValueError('Message has no command.')
+
+    line, sep, trailing = line.partition(' :')
+    if not sep:
+        trailing = None
+
+    params = line.split()
+    if not params:
+        raise ValueError('Message has no command.')
+    command = params.pop(0).upper()
+
+    return Message(tags, prefix, command, params, trailing)
+
+
+class Dispatcher(object):
+    """Routes messages to the handlers registered for their command or numeric.
+
+    Handlers are called with the User object of the message source (or None if the
+    message has no prefix) and the Message object.
+    """
+    def __init__(self):
+        self._handlers = {}
+
+    def register(self, command, handler):
+        """Registers a handler for a given command or numeric string."""
+        self._handlers.setdefault(command.upper(), []).append(handler)
+
+    def unregister(self, command, handler):
+        try:
+            self._handlers[command.upper()].remove(handler)
+        except (KeyError, ValueError):
+            pass
+
+    def dispatch(self, user, msg):
+        """Calls every handler of the message's command. Returns False if there is none."""
+        handlers = self._handlers.get(msg.command)
+        if not handlers:
+            return False
+
+        for handler in handlers:
+            handler(user, msg)
+        return True
@@ -0,0 +1,166 @@
+"""An HTTP exporter of the bot's metrics, in the Prometheus text format.
+
+It's disabled by default. Setting metrics_port in teslabot.cfg serves the metrics at
+http://<metrics_host>:<metrics_port>/metrics from a thread of its own. Counters are
+read without locking, so a scrape may see a message counted by one metric and not
+yet by another.
+
+Plugins may publish metrics of their own with PluginBase.metrics().
+"""
+import BaseHTTPServer
+import logging
+import threading
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    pairs = ['{0}="{1}"'.format(k, unicode(v).replace('\\', '\\\\').replace('"', '\\"'))
+             for k, v in sorted(labels.items())]
+    return '{' + ','.join(pairs) + '}'
+
+
+def _value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Exposition(object):
+    """Accumulates metrics in the Prometheus text format."""
+    def __init__(self):
+        self.lines = []
+
+    def add(self, name, type, help, samples):
+        """Adds a metric.
+
+        Args:
+            name: The metric's name
+            type: counter, gauge or histogram
+            help: A line of documentation
+            samples: A number, or a list of (labels dict, number) pairs
+        """
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        self.lines.append('# HELP {0} {1}'.format(name, help))
+        self.lines.append('# TYPE {0} {1}'.format(name, type))
+        for labels, value in samples:
+            self.lines.append('{0}{1} {2}'.format(name, _labels(labels), _value(value)))
+
+    def add_histogram(self, name, help, histogram):
+        """Adds a perf.Histogram. Its buckets are made cumulative, as required by the
+        format."""
+        self.lines.append('# HELP {0} {1}'.format(name, help))
+        self.lines.append('# TYPE {0} histogram'.format(name))
+        seen = 0
+        bounds = list(histogram.bounds) + [float('inf')]
+        for bound, n in zip(bounds, histogram.buckets):
+            seen += n
+            self.lines.append('{0}_bucket{{le="{1}"}} {2}'.format(name, _value(bound), seen))
+        self.lines.append('{0}_sum {1}'.format(name, _value(histogram.total)))
+        self.lines.append('{0}_count {1}'.format(name, histogram.count))
+
+    def render(self):
+        return ('\n'.join(self.lines) + '\n').encode('utf-8')
+
+
+def collect(irc):
+    """Returns the metrics of an IRCClient as a byte string."""
+    out = Exposition()
+    stats = irc.outbound.stats()
+
+    out.add('teslabot_lines_received_total', 'counter',
+            'Messages received from the server.', irc.received)
+    out.add('teslabot_lines_sent_total', 'counter',
+            'Messages written to the server.', stats['sent'])
+    out.add_histogram('teslabot_parse_seconds',
+                      'Time taken to parse a received message.', irc.parse_time)
+    out.add('teslabot_send_queue_depth', 'gauge',
+            'Messages waiting in the outbound queue.', stats['depth'])
+    out.add('teslabot_send_queue_wait_seconds_max', 'gauge',
+            'Longest time a message waited in the outbound queue.', stats['max_wait'])
+    out.add('teslabot_throttle_activations_total', 'counter',
+            'Times the outbound rate limit started delaying messages.', stats['throttled'])
+    out.add('teslabot_reconnects_total', 'counter',
+            'Reconnection attempts.', irc.reconnects)
+    out.add('teslabot_connected', 'gauge',
+            'Whether or not the bot is connected to the server.', int(irc.sock is not None))
+
+    queues = irc.queue_stats()
+    out.add('teslabot_plugin_queue_depth', 'gauge',
+            'Events waiting for a plugin.',
+            [({'plugin': name}, queues[name]['depth']) for name in sorted(queues)])
+    out.add('teslabot_plugin_events_dropped_total', 'counter',
+            'Events dropped because the queue of a plugin was full.',
+            [({'plugin': name}, queues[name]['dropped']) for name in sorted(queues)])
+
+    perf = irc.perf.plugins()
+    out.add('teslabot_plugin_events_total', 'counter',
+            'Events handled by a plugin.',
+            [({'plugin': name}, perf[name].count) for name in sorted(perf)])
+    out.add('teslabot_plugin_handler_seconds_total', 'counter',
+            'Time spent in the event handlers of a plugin.',
+            [({'plugin': name}, perf[name].run.total) for name in sorted(perf)])
+
+    for plugin in list(irc._plugin_objects):
+        prefix = 'teslabot_{0}_'.format(plugin.name.lower())
+        for name, type, help, value in plugin.metrics():
+            out.add(prefix + name, type, help, value)
+
+    return out.render()
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+
+        try:
+            body = collect(self.server.irc)
+        except Exception:
+            self.server.logger.exception('Failed to collect metrics.')
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.logger.debug(format % args)
+
+
+class MetricsServer(object):
+    """Serves the metrics of an IRCClient over HTTP on a daemon thread.
+
+    Attributes:
+        host: The address to listen on. Only local clients can connect by default.
+        port: The TCP port to listen on
+    """
+    def __init__(self, irc, port, host = '127.0.0.1'):
+        self.logger = logging.getLogger('teslabot.metrics')
+        self.irc = irc
+        self.host = host
+        self.port = port
+        self._server = None
+
+    def start(self):
+        self._server = BaseHTTPServer.HTTPServer((self.host, self.port), _Handler)
+        self._server.irc = self.irc
+        self._server.logger = self.logger
+
+        thread = threading.Thread(target=self._server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        self.logger.info('Serving metrics on {0}:{1}.'.format(self.host, self.port))
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -0,0 +1,291 @@
+import collections
+import logging
+import socket
+import threading
+import time
+
+class TokenBucket(object):
+    """A token bucket rate limiter.
+
+    Attributes:
+        rate: The number of tokens added per second
+        burst: The maximum number of tokens the bucket can hold
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.time()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    @property
+    def tokens(self):
+        self._refill()
+        return self._tokens
+
+    def consume(self, n = 1):
+        """Takes n tokens from the bucket. Returns False if there aren't enough tokens."""
+        self._refill()
+        if self._tokens >= n:
+            self._tokens -= n
+            return True
+        return False
+
+    def delay(self, n = 1):
+        """Returns the number of seconds until n tokens are available."""
+        self._refill()
+        if self._tokens >= n:
+            return 0
+        return (n - self._tokens) / self.rate
+
+
+def get_target(line):
+    """Returns the lowercase target of a PRIVMSG or NOTICE line, or an empty string for
+    every other command."""
+    parts = line.split(' ', 2)
+    if len(parts) > 1 and parts[0] in ('PRIVMSG', 'NOTICE'):
+        return parts[1].lower()
+    return ''
+
+
+def split_utf8(data, budget):
+    """Splits a UTF-8 byte string into chunks of at most budget bytes.
+
+    Chunks end at a space (which is dropped) when there is one in the second half of
+    the chunk. Otherwise, they are cut at the last character boundary.
+
+    Raises:
+        ValueError: budget isn't positive, so no chunk can hold any data.
+    """
+    if budget <= 0:
+        raise ValueError('No room for text in a chunk of {0} bytes.'.format(budget))
+    chunks = []
+
+    while len(data) > budget:
+        cut = budget
+        # Continuation bytes of a multibyte character look like 10xxxxxx
+        while cut > 0 and (ord(data[cut]) & 0xC0) == 0x80:
+            cut -= 1
+        if cut == 0:
+            cut = budget
+
+        space = data.rfind(' ', 0, cut + 1)
+        if space > budget // 2:
+            chunks.append(data[:space])
+            data = data[space + 1:]
+        else:
+            chunks.append(data[:cut])
+            data = data[cut:]
+
+    if data:
+        chunks.append(data)
+    return chunks
+
+
+class OutboundQueue(object):
+    """Paces outgoing messages with a token bucket on a dedicated writer thread.
+
+    Callers never block: messages are queued per target (channel or nick) and the
+    writer thread serves the targets round-robin, so a single chatty target cannot
+    starve the others. Messages whose command is listed in PRIORITY_COMMANDS bypass
+    the queue and the rate limiter altogether.
+
+    Whenever the bucket holds more than one token, the writer takes as many messages
+    as there are tokens and writes them to the socket in one call.
+
+    Attributes:
+        sent: The number of messages written
+        throttled: The number of times the bucket ran dry while messages were pending
+        max_depth: The largest number of messages that were waiting at once
+
+        _write: A callable that writes a list of byte string lines to the socket
+        _queues: A dict of targets and their deque of (line, UNIX time queued, callback)
+            tuples. The callback is None, except for the last line of a batch queued with
+            an on_sent callback.
+        _order: A deque of targets that have pending messages, in round-robin order
+        _depth: The number of messages currently waiting
+    """
+    PRIORITY_COMMANDS = ('PING', 'PONG', 'QUIT')
+
+    def __init__(self, write, rate = 1.0, burst = 5):
+        self.logger = logging.getLogger('teslabot.outbound')
+        self.alive = False
+
+        self.sent = 0
+        self.throttled = 0
+        self.max_depth = 0
+
+        self._write = write
+        self._bucket = TokenBucket(rate, burst)
+        self._queues = {}
+        self._order = collections.deque()
+        self._depth = 0
+        self._throttling = False
+
+        self._wait_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Starts the writer thread if it isn't running already."""
+        with self._cond:
+            if self._thread and self._thread.is_alive():
+                return
+            self.alive = True
+            self._thread = threading.Thread(target=self._run, name='outbound')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self.alive = False
+            self._cond.notify()
+
+    def clear(self):
+        """Drops every pending message. Their on_sent callbacks are called with an
+        error."""
+        with self._cond:
+            callbacks = [item[2] for queue in self._queues.values() for item in queue
+                         if item[2]]
+            self._queues.clear()
+            self._order.clear()
+            self._depth = 0
+
+        for callback in callbacks:
+            callback(socket.error('Message dropped.'))
+
+    def depth(self):
+        """Returns the number of messages waiting to be sent."""
+        return self._depth
+
+    def is_priority(self, line):
+        return line.split(' ', 1)[0] in self.PRIORITY_COMMANDS
+
+    def put(self, line, target = None):
+        """Queues a byte string line (without CRLF). Priority lines are written
+        immediately by the calling thread."""
+        if self.is_priority(line):
+            self.send_now(line)
+            return
+
+        if target is None:
+            target = get_target(line)
+
+        self.put_many([line], target)
+
+    def put_many(self, lines, target, on_sent = None):
+        """Queues a list of byte string lines for a single target at once.
+
+        Args:
+            on_sent: A callable that is called on the writer thread once the last line
+                has been written, with None, or with the exception raised by the write
+        """
+        if not lines:
+            if on_sent:
+                on_sent(None)
+            return
+
+        now = time.time()
+        items = [(line, now, None) for line in lines]
+        items[-1] = (lines[-1], now, on_sent)
+        with self._cond:
+            queue = self._queues.get(target)
+            if queue is None:
+                queue = self._queues[target] = collections.deque()
+                self._order.append(target)
+            queue.extend(items)
+
+            self._depth += len(lines)
+            if self._depth > self.max_depth:
+                self.max_depth = self._depth
+            self._cond.notify()
+
+    def send_now(self, line):
+        """Writes a line immediately, bypassing the queue and the rate limiter."""
+        with self._write_lock:
+            self._write([line])
+        self.sent += 1
+
+    def _pop(self):
+        """Returns the next (line, UNIX time queued, callback) tuple in round-robin order."""
+        target = self._order.popleft()
+        queue = self._queues[target]
+        item = queue.popleft()
+
+        if queue:
+            self._order.append(target)
+        else:
+            del self._queues[target]
+        self._depth -= 1
+
+        return item
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.alive and not self._order:
+                    if self._throttling:
+                        self._throttling = False
+                        self.logger.warning('Throttling disabled.')
+                    self._cond.wait()
+                if not self.alive:
+                    return
+
+                delay = self._bucket.delay()
+                if delay > 0:
+                    if not self._throttling:
+                        self._throttling = True
+                        self.throttled += 1
+                        self.logger.warning('Throttling enabled.')
+                    self._cond.wait(delay)
+                    continue
+
+                batch = []
+                for i in range(min(int(self._bucket.tokens), self._depth)):
+                    batch.append(self._pop())
+                self._bucket.consume(len(batch))
+
+            now = time.time()
+            for line, queued, callback in batch:
+                wait = now - queued
+                self._wait_total += wait
+                if wait > self._wait_max:
+                    self._wait_max = wait
+            self._wait_count += len(batch)
+
+            error = None
+            with self._write_lock:
+                try:
+                    self._write([item[0] for item in batch])
+                    self.sent += len(batch)
+                except Exception as e:
+                    self.logger.warning('Failed to send messages: {0}'.format(e))
+                    error = e
+
+            for line, queued, callback in batch:
+                if callback:
+                    callback(error)
+
+    def stats(self):
+        """Returns a dict of queue metrics."""
+        avg_wait = 0.0
+        if self._wait_count:
+            avg_wait = self._wait_total / self._wait_count
+
+        return {
+            'depth': self._depth,
+            'max_depth': self.max_depth,
+            'targets': len(self._queues),
+            'sent': self.sent,
+            'throttled': self.throttled,
+            'avg_wait': avg_wait,
+            'max_wait': self._wait_max,
+        }
@@ -0,0 +1,160 @@
+"""Latency and throughput statistics of plugin event handlers.
+
+For every plugin and event, the client records how long the event waited in the
+plugin's queue and how long the handler ran. Commands and hooks are recorded under
+their own name (e.g. command_weather, hook monitor_happening) rather than as
+on_chat_command and _run_hook, since that's what tells which one is slow.
+"""
+import bisect
+import threading
+import time
+
+class Histogram(object):
+    """Counts durations in fixed buckets, so percentiles can be estimated in constant
+    memory.
+
+    Attributes:
+        count: The number of durations
+        total: The sum of the durations, in seconds
+        max: The longest duration, in seconds
+        bounds: A sorted tuple of the upper bounds of the buckets, in seconds
+        buckets: A list of counts, one per upper bound plus one for the durations
+            beyond the last bound
+    """
+    BOUNDS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30)
+
+    def __init__(self, bounds = BOUNDS):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket of the p-th percentile (0 < p <= 100).
+        Beyond the last bound, the longest duration is returned instead."""
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets[:-1]):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[i], self.max)
+        return self.max
+
+
+class EventStats(object):
+    """The statistics of an event (or of every event) of a plugin.
+
+    Attributes:
+        count: The number of handled events
+        errors: The number of handlers that raised an exception
+        wait: A Histogram of the time events spent in the plugin's queue
+        run: A Histogram of the execution time of the handler
+    """
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wait = Histogram()
+        self.run = Histogram()
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        self.wait.merge(other.wait)
+        self.run.merge(other.run)
+
+
+def _ms(seconds):
+    return '{0:.1f}'.format(seconds * 1000)
+
+
+class PerfStats(object):
+    """Thread-safe statistics of the event handlers of every plugin.
+
+    Attributes:
+        since: The time at which the statistics were started (or reset)
+
+        _events: A dict of (plugin name, event) pairs to their EventStats
+    """
+    def __init__(self):
+        self.since = time.time()
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def record(self, plugin, event, wait, elapsed, error = False):
+        """Records a single event handled by a plugin.
+
+        Args:
+            plugin: The plugin's name
+            event: The name of the event, command or hook
+            wait: The number of seconds the event waited for the plugin
+            elapsed: The number of seconds the handler ran
+            error: True if the handler raised an exception
+        """
+        with self._lock:
+            stats = self._events.get((plugin, event))
+            if stats is None:
+                stats = self._events[(plugin, event)] = EventStats()
+            stats.count += 1
+            stats.errors += error
+            stats.wait.add(wait)
+            stats.run.add(elapsed)
+
+    def reset(self):
+        with self._lock:
+            self._events = {}
+            self.since = time.time()
+
+    def plugins(self):
+        """Returns a dict of plugin names to the EventStats of all of their events."""
+        totals = {}
+        with self._lock:
+            for (plugin, event), stats in self._events.items():
+                totals.setdefault(plugin, EventStats()).merge(stats)
+        return totals
+
+    def events(self, plugin):
+        """Returns a dict of event names to the EventStats of a given plugin."""
+        with self._lock:
+            return dict((event, stats) for (name, event), stats in self._events.items()
+                        if name == plugin)
+
+    def format(self, name, stats):
+        """Returns a line of text that summarizes some EventStats."""
+        elapsed = max(time.time() - self.since, 1)
+        return '[{0}] {1} events ({2:.2f}/s), {3} errors; wait ms p50 {4} p95 {5} max {6};' \
+               ' run ms p50 {7} p95 {8} max {9}'.format(
+                   name, stats.count, stats.count / elapsed, stats.errors,
+                   _ms(stats.wait.percentile(50)), _ms(stats.wait.percentile(95)),
+                   _ms(stats.wait.max), _ms(stats.run.percentile(50)),
+                   _ms(stats.run.percentile(95)), _ms(stats.run.max))
+
+    def report(self, plugin = None):
+        """Returns a list of lines: a summary per plugin, or per event of a given
+        plugin. The slowest handlers come first."""
+        if plugin is None:
+            stats = self.plugins()
+        else:
+            stats = self.events(plugin)
+
+        names = sorted(stats, key=lambda name: stats[name].run.total, reverse=True)
+        return [self.format(name, stats[name]) for name in names]
@@ -1,16 +1,48 @@
 import sys
-import Queue
 import logging
-import time
+from coroutine import Future, Task, is_coroutine, sleep
+
+class Hook(object):
+    """A plugin method scheduled with PluginBase.hook() or PluginBase.call_later().
+
+    Attributes:
+        method: The method to call
+        args: A tuple of arguments for the method
+        interval: Seconds between calls of a repeating hook, or None for a one-shot hook
+        delay: Seconds before the call of a one-shot hook
+        timer: The event loop Timer of the hook, once the plugin has been started
+        pending: True while a call is waiting to be run by the plugin
+        cancelled: True once the hook has been removed
+    """
+    def __init__(self, method, args, interval = None, delay = 0):
+        self.method = method
+        self.args = args
+        self.interval = interval
+        self.delay = delay
+        self.timer = None
+        self.pending = False
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+        if self.timer:
+            self.timer.cancel()
+
 
 class PluginBase:
     """Base class for a plugin.
     
-    By default, it runs as a single thread and communicates via Queue. The Queue times out
-    every self._qtimeout and calls any hooked function.
+    By default, it runs as a single thread and communicates via Queue. The thread sleeps
+    until an event arrives.
+
+    If the client has a worker pool, run() isn't used: the client calls dispatch() on a
+    strand of the pool instead, one call at a time. The calls aren't made from a given
+    thread, so a plugin mustn't keep thread-bound objects across them (a sqlite3
+    connection needs check_same_thread=False).
 
-    Currently, there is no support for having hooks that operate instantly and on a given
-    interval in the same module.
+    Hooks are timers of the client's event loop. When a hook is due, a call to it is
+    delivered like an event, so it runs on the plugin's thread (or strand) between the
+    plugin's other events.
     
     Attributes:
         name: The name of the plugin.
@@ -46,9 +78,6 @@ class PluginBase:
         self.admin_commands = []
         
         self._hooks = []
-        self._qtimeout = 5
-        self._qcount = 0
-        self._last_hook_call = time.time()
         
         self.strings = self.Strings
         
@@ -96,52 +125,95 @@ class PluginBase:
         """
         self.irch = irc
         while self.alive:
-            try:
-                if self._qtimeout:
-                    if time.time() - self._last_hook_call > self._qtimeout:
-                        self.call_hooks()
-                    event, args = q.get(True, self._qtimeout)
-                else:
-                    # Timeout every microsecond.
-                    time.sleep(0.0001)
-                    event, args = q.get(False)
+            event, args = q.get()
+            irc.handle_event(self, event, args, q.last_wait)
                 
-                callback = getattr(self, event)
-                callback(*args)
-            except self.InvalidSyntax:
-                self.irch.notice(self.INV_SYNTAX, args[0].nick)
-            except PluginBase.InvalidArguments:
-                self.irch.notice(self.INV_ARGS, args[0].nick)
-            except PluginBase.InvalidPermission:
-                self.irch.notice(self.INV_PERMS, args[0].nick)
-            except Queue.Empty:
-                self.call_hooks()
+    def dispatch(self, event, args):
+        """Executes the callback of a single event and returns its result. Invalid
+        commands are reported to the user that sent them."""
+        try:
+            callback = getattr(self, event)
+            return callback(*args)
+        except (PluginBase.InvalidSyntax, PluginBase.InvalidArguments,
+                PluginBase.InvalidPermission) as e:
+            self._report(e, args[0])
+
+    def _report(self, error, user):
+        """Notifies a user of an InvalidSyntax, InvalidArguments or InvalidPermission
+        error raised by one of its commands."""
+        if not hasattr(user, 'nick'):
+            # Raised by a hook, not by a command
+            self.logger.warning('Ignored {0!r}.'.format(error))
+        elif isinstance(error, PluginBase.InvalidSyntax):
+            self.irch.notice(self.INV_SYNTAX, user.nick)
+        elif isinstance(error, PluginBase.InvalidArguments):
+            self.irch.notice(self.INV_ARGS, user.nick)
+        else:
+            self.irch.notice(self.INV_PERMS, user.nick)
                 
-    def hook(self, method, interval=1):
-        """Adds a callback that will be called every (multiple * timeout), where timeout 
-        is run()'s Queue.get() timeout in seconds. (Queue timeouts every 5 seconds by default.)"""
-        self._hooks.append([method, interval])
+    def start(self, irc):
+        """Called by the client when the plugin is loaded. Arms the hooks that were
+        added before then."""
+        self.irch = irc
+        for hook in self._hooks:
+            self._arm(hook)
+
+    def _arm(self, hook):
+        if self.irch and not hook.timer and not hook.cancelled:
+            hook.timer = self.irch.schedule(self, hook)
+
+    def hook(self, method, interval=5):
+        """Calls a method every interval seconds (which may be a fraction), until it
+        is unhooked. Hooking a method again changes its interval."""
+        self.unhook(method)
+        hook = Hook(method, (), interval)
+        self._hooks.append(hook)
+        self._arm(hook)
+        
+    def call_later(self, delay, method, *args):
+        """Calls method(*args) once, in delay seconds. Returns a Hook that can be
+        cancelled."""
+        hook = Hook(method, args, delay=delay)
+        self._hooks.append(hook)
+        self._arm(hook)
+        return hook
         
     def unhook(self, method):
-        """Removes a given callback from the hook list."""
-        for h in self._hooks:
-            if h[0] == method:
-                self._hooks.remove(h)
-        
-    def call_hooks(self):
-        """Calls a hooked function every (_qtimeout * multiple seconds), where _qtimeout are
-        the seconds for Queue.get() to timeout."""
-        self._last_hook_call = time.time()
-
-        if self._qtimeout:
-            self._qcount += 1
-
-            for h in self._hooks:
-                if self._qcount % h[1] == 0:
-                    h[0]()
-        else:
-                for h in self._hooks:
-                    h[0]()
+        """Cancels every hook and delayed call of a given method."""
+        for hook in [h for h in self._hooks if h.method == method]:
+            hook.cancel()
+            self._hooks.remove(hook)
+
+    def is_hooked(self, method):
+        return any(h.method == method for h in self._hooks)
+
+    def stop_hooks(self):
+        """Cancels every hook. Called when the plugin is unloaded."""
+        for hook in self._hooks:
+            hook.cancel()
+        self._hooks = []
+
+    def release_hooks(self):
+        """Clears the pending call of every hook. Called by the client when the calls
+        waiting for the plugin were lost, e.g. with its thread, since a pending hook
+        never fires again."""
+        for hook in self._hooks:
+            hook.pending = False
+
+    def _run_hook(self, hook):
+        """Delivered by the client when a hook is due."""
+        hook.pending = False
+        if hook.cancelled:
+            return
+        if hook.interval is None and hook in self._hooks:
+            self._hooks.remove(hook)
+        return hook.method(*hook.args)
+
+    def metrics(self):
+        """Returns a list of (name, type, help, value) tuples of metrics published by the
+        metrics exporter, under teslabot_<plugin name>_<name>. Called from the
+        exporter's thread, so it should only read counters."""
+        return []
 
     def on_exit(self):
         """Cleanly terminate the plugin's execution."""
@@ -179,4 +251,62 @@ class PluginBase:
             else:
                 self.irch.notice('No documentation available.', user.nick)
         else:
-            callback(user, dst, args)
\ No newline at end of file
+            return callback(user, dst, args)
+
+
+class AsyncPluginBase(PluginBase):
+    """Base class for a plugin that runs on the IRC client's event loop instead of a
+    thread of its own.
+
+    Event and command handlers, as well as hooks, may be coroutines (see coroutine.py):
+    generators that yield futures, such as those returned by irch.say(), irch.notice(),
+    run_in_executor() and sleep(). While a coroutine waits, the loop keeps processing
+    messages, so a plugin can have many lookups in progress at once.
+
+    Handlers must never block. Blocking calls (e.g. requests.get()) belong in
+    run_in_executor(), which runs them on the client's worker threads.
+    """
+    def dispatch(self, event, args):
+        """Executes the callback of a single event on the loop's thread. If it returns a
+        coroutine, the coroutine is scheduled and its Task is returned."""
+        result = PluginBase.dispatch(self, event, args)
+        if not is_coroutine(result):
+            return result
+
+        task = Task(self.irch.loop, result)
+        task.add_done_callback(lambda task: self._task_done(task, event, args))
+        return task
+
+    def _task_done(self, task, event, args):
+        error = task.exception()
+        if error is None:
+            return
+        if isinstance(error, (PluginBase.InvalidSyntax, PluginBase.InvalidArguments,
+                              PluginBase.InvalidPermission)):
+            self._report(error, args[0] if args else None)
+        else:
+            self.logger.error('[{0}] failed: {1!r}'.format(event, error))
+
+    def run_in_executor(self, func, *args):
+        """Calls func(*args) on a worker thread. Returns a Future of its result."""
+        future = Future(self.irch.loop)
+
+        def execute():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        self.irch.executor().submit(execute)
+        return future
+
+    def sleep(self, delay):
+        """Returns a Future that is done after delay seconds."""
+        return sleep(self.irch.loop, delay)
+
+    def on_exit(self):
+        """Stops the plugin's hooks. Unlike PluginBase.on_exit(), there is no thread to
+        terminate."""
+        self.alive = False
+        self.stop_hooks()
+
@@ -13,12 +13,14 @@ class CoreCommands(PluginBase):
         self.set_cmd('kickban', self.CMD_CHANNEL)
         self.set_cmd('ban', self.CMD_CHANNEL)
         self.set_cmd('unban', self.CMD_CHANNEL)
-        self.admin_commands = ['reload', 'say', 'action', 'join', 'leave', 'quit', 'nick', 'plugins']
+        self.admin_commands = ['reload', 'say', 'action', 'join', 'leave', 'quit', 'nick', 'plugins', 'queues', 'perf']
         
         self.lang_001 = 'Plugins: {0}'
         self.lang_002 = 'Type \x0310{0}commands\x03 for a list of available commands. Type \x0310{0}(command) help\x03 ' \
                         'to view the help text of a specific command. Note that the parentheses should not be included.'
         self.lang_003 = 'Goodbye.'
+        self.lang_004 = '[{0}] {depth}/{limit} waiting (max {max_depth}), {queued} queued, ' \
+                        '{dropped} dropped, {coalesced} coalesced ({policy})'
         
         self.users = {}
         
@@ -28,6 +30,39 @@ class CoreCommands(PluginBase):
         else:
             raise self.InvalidPermission
 
+    def command_queues(self, user, dst, args):
+        """Syntax: {0}queues
+        Displays the event queue counters of every plugin. Requires admin privileges."""
+        if user.admin:
+            stats = self.irch.queue_stats()
+            lines = []
+            for name in sorted(stats):
+                s = stats[name]
+                lines.append(self.lang_004.format(name, limit=s['maxsize'] or 'unbounded', **s))
+            self.irch.notice(lines or 'No plugin has received an event yet.', user.nick)
+        else:
+            raise self.InvalidPermission
+
+    def command_perf(self, user, dst, args):
+        """Syntax: {0}perf [plugin|reset]
+        Displays the number of events handled by every plugin (or by each event of a
+        plugin), the time they waited and the time their handlers took. Requires admin
+        privileges."""
+        if not user.admin:
+            raise self.InvalidPermission
+        
+        if args == 'reset':
+            self.irch.perf.reset()
+            self.irch.notice('Statistics reset.', user.nick)
+            return
+        
+        names = dict((p.name.lower(), p.name) for p in self.irch._import_plugins())
+        if args and args.lower() not in names:
+            raise self.InvalidArguments
+        
+        lines = self.irch.perf.report(names[args.lower()] if args else None)
+        self.irch.notice(lines or 'No event has been handled yet.', user.nick)
+
     def command_help(self, user, dst, args):
         self.irch.notice(self.lang_002.format(self.irch.trigger), user.nick)
 
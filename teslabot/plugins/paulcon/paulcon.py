@@ -1,4 +1,4 @@
-from pluginbase import PluginBase
+from pluginbase import PluginBase, AsyncPluginBase
 import logging
 from HTMLParser import HTMLParser
 import requests
@@ -13,9 +13,11 @@ try:
 except ImportError:
     from bs4 import BeautifulSoup
     
-class Paulcon(PluginBase):
+class Paulcon(AsyncPluginBase):
+    """Runs on the event loop. Web requests are made on the threads of the client's
+    WebClient, so that slow websites don't hold up other commands."""
     def __init__(self):
-        PluginBase.__init__(self)
+        AsyncPluginBase.__init__(self)
         self.name = 'Paulcon'
         self.logger = logging.getLogger('teslabot.plugin.paulcon')
         
@@ -67,7 +69,7 @@ class Paulcon(PluginBase):
         """Returns the most recent high magnitude earthquake."""
         url = 'http://www.seismi.org/api/eqs?limit=1'
         try:
-            r = requests.get(url)
+            r = yield self.irch.http().fetch(url)
             
             data = json.loads(r.text)
             
@@ -76,7 +78,7 @@ class Paulcon(PluginBase):
                               '{2} \x0311[{0}]\x03.'.format(eq['timedate'], eq['magnitude'], eq['region']), dst)
             
             #self.irch.say('\x02\x034(EARTHQUAKE) \x02\x03{0}'.format(title), dst)
-        except requests.ConnectionError:
+        except requests.RequestException:
             return
         
     def command_happening(self, user, dst, args):
@@ -88,7 +90,7 @@ class Paulcon(PluginBase):
             if args[0] == 'monitor':
                 self.subcommand_happening_monitor(user, dst, args[1])
         else:
-            reply = self.get_happening()
+            reply = yield self.irch.http().submit(self.get_happening)
             if not reply:
                 reply = '\x0311Nothing is happening.\x03'
             self.irch.say(reply, dst)
@@ -99,7 +101,7 @@ class Paulcon(PluginBase):
         if args == 'on':
             self.happening_dst = dst
             self.happening_last = ''
-            self.hook(self.monitor_happening, 12)
+            self.hook(self.monitor_happening, 60)
             self.irch.say('\x0311Happening monitor enabled.', dst)
         elif args == 'off':
             self.unhook(self.monitor_happening)
@@ -108,7 +110,7 @@ class Paulcon(PluginBase):
             raise PluginBase.InvalidSyntax
     
     def monitor_happening(self):
-        reply = self.get_happening()
+        reply = yield self.irch.http().submit(self.get_happening)
         if self.happening_last == reply:
             return
         if reply:
@@ -120,7 +122,7 @@ class Paulcon(PluginBase):
             reply = False
             url = 'http://rt.com'
             
-            req = requests.get(url)
+            req = self.irch.http().get(url)
             req.encoding = 'utf-8'
             
             soup = BeautifulSoup(req.text)
@@ -134,5 +136,5 @@ class Paulcon(PluginBase):
                 reply = u'\x02\x034(HAPPENING)\x03\x02 {0} | \x0311{1}'.format(hline, url + path)
             
             return reply
-        except requests.ConnectionError:
+        except requests.RequestException:
             return False
\ No newline at end of file
@@ -1,4 +1,5 @@
 from pluginbase import PluginBase
+from cache import Cache
 import sqlite3
 import logging
 import time
@@ -6,12 +7,258 @@ import os
 import datetime
 import re
 
+# Schema changes, applied in order on top of schema.sql. The user_version of a database
+# is the number of migrations it has gone through. Append new ones; never edit them.
+MIGRATIONS = [
+    # 1: Unique indexes on the looked up columns, so writes can be upserts. The rows
+    # that would break them are merged first. Nicks are folded with LOWER(), i.e. ASCII
+    # casemapping, not the server's: statistics outlive a connection and its
+    # CASEMAPPING, so Nick[1] and nick{1} are counted as two users.
+    """
+    CREATE TEMP TABLE merged AS
+        SELECT MIN(id) AS id, cid, word, SUM(count) AS count FROM word_list
+        WHERE word != '' GROUP BY cid, word;
+    DELETE FROM word_list;
+    INSERT INTO word_list (id, cid, word, count) SELECT id, cid, word, count FROM merged;
+    DROP TABLE merged;
+    CREATE UNIQUE INDEX word_list_word ON word_list (cid, word);
+    
+    CREATE TEMP TABLE nick_id AS
+        SELECT LOWER(nick) AS nick, MIN(id) AS id FROM user
+        GROUP BY LOWER(nick) HAVING COUNT(*) > 1;
+    UPDATE user_statistics SET uid = (SELECT n.id FROM user u, nick_id n
+                                      WHERE u.id = user_statistics.uid
+                                      AND LOWER(u.nick) = n.nick)
+        WHERE uid IN (SELECT u.id FROM user u, nick_id n WHERE LOWER(u.nick) = n.nick);
+    UPDATE user SET
+        lastseen_time = (SELECT u.lastseen_time FROM user u WHERE LOWER(u.nick) = LOWER(user.nick)
+                         ORDER BY u.lastseen_time DESC LIMIT 1),
+        lastseen_cid = (SELECT u.lastseen_cid FROM user u WHERE LOWER(u.nick) = LOWER(user.nick)
+                        ORDER BY u.lastseen_time DESC LIMIT 1)
+        WHERE id IN (SELECT id FROM nick_id);
+    DELETE FROM user WHERE LOWER(nick) IN (SELECT nick FROM nick_id)
+        AND id NOT IN (SELECT id FROM nick_id);
+    DROP TABLE nick_id;
+    CREATE UNIQUE INDEX user_nick ON user (LOWER(nick));
+    
+    CREATE TEMP TABLE merged AS
+        SELECT MIN(id) AS id, cid, uid, SUM(word_count) AS word_count,
+               SUM(line_count) AS line_count FROM user_statistics GROUP BY cid, uid;
+    DELETE FROM user_statistics;
+    INSERT INTO user_statistics (id, cid, uid, word_count, line_count)
+        SELECT id, cid, uid, word_count, line_count FROM merged;
+    DROP TABLE merged;
+    CREATE UNIQUE INDEX user_statistics_user ON user_statistics (cid, uid);
+    
+    CREATE INDEX channel_name ON channel (name);
+    """,
+    # 2: The persisted lists of TopWords
+    """
+    CREATE TABLE top_words (
+        cid INTEGER,
+        min_length INTEGER,
+        word TEXT,
+        count INTEGER,
+        FOREIGN KEY(cid) REFERENCES channel(id)
+    );
+    CREATE INDEX top_words_list ON top_words (cid, min_length);
+    """,
+    # 3: Rollups of channel_visit, whose old rows are then compacted away
+    """
+    CREATE TABLE channel_population (
+        id INTEGER PRIMARY KEY,
+        cid INTEGER,
+        resolution INTEGER,
+        start INTEGER,
+        min INTEGER,
+        max INTEGER,
+        total INTEGER,
+        samples INTEGER,
+        FOREIGN KEY(cid) REFERENCES channel(id)
+    );
+    CREATE UNIQUE INDEX channel_population_period
+        ON channel_population (cid, resolution, start);
+    CREATE INDEX channel_population_start ON channel_population (resolution, start);
+    INSERT INTO channel_population (cid, resolution, start, min, max, total, samples)
+        SELECT cid, r.resolution, time - time % r.resolution, MIN(count), MAX(count),
+               SUM(count), COUNT(*)
+        FROM channel_visit, (SELECT 60 AS resolution UNION SELECT 3600 UNION SELECT 86400) r
+        GROUP BY cid, r.resolution, time - time % r.resolution;
+    
+    CREATE TABLE channel_peak (
+        cid INTEGER PRIMARY KEY,
+        count INTEGER,
+        time INTEGER,
+        FOREIGN KEY(cid) REFERENCES channel(id)
+    );
+    -- The other columns of a MAX() aggregate come from the row of the maximum
+    INSERT INTO channel_peak (cid, count, time)
+        SELECT cid, MAX(count), time FROM channel_visit GROUP BY cid;
+    CREATE INDEX channel_peak_count ON channel_peak (count);
+    
+    CREATE INDEX channel_visit_time ON channel_visit (time);
+    """,
+]
+
+class StatsBuffer(object):
+    """Aggregates the statistics of chat activity in memory until they're written to the
+    database, so that a burst of messages costs a single transaction.
+    
+    Attributes:
+        words: A dict of (channel, word) pairs to the number of times the word was used
+        lines: A dict of (channel, nick) pairs to [word count, line count] lists
+        lastseen: A dict of nicks to the (channel, UNIX time) where they were last seen
+        visits: A list of (channel, number of users, UNIX time) tuples
+    """
+    def __init__(self):
+        self.clear()
+        
+    def clear(self):
+        self.words = {}
+        self.lines = {}
+        self.lastseen = {}
+        self.visits = []
+        
+    def __len__(self):
+        return len(self.words) + len(self.lines) + len(self.lastseen) + len(self.visits)
+        
+    def add_message(self, chan, nick, words):
+        for word in words:
+            key = (chan, word)
+            self.words[key] = self.words.get(key, 0) + 1
+        
+        counts = self.lines.setdefault((chan, nick.lower()), [0, 0])
+        counts[0] += len(words)
+        counts[1] += 1
+        
+    def add_lastseen(self, nick, chan, when):
+        self.lastseen[nick.lower()] = (chan, when)
+        
+    def add_visit(self, chan, count, when):
+        self.visits.append((chan, count, when))
+        
+    def merge(self, older):
+        """Adds the statistics of an older buffer (e.g. one that failed to be written)
+        to this one."""
+        for key, count in older.words.iteritems():
+            self.words[key] = self.words.get(key, 0) + count
+        for key, (words, lines) in older.lines.iteritems():
+            counts = self.lines.setdefault(key, [0, 0])
+            counts[0] += words
+            counts[1] += lines
+        for nick, seen in older.lastseen.iteritems():
+            self.lastseen.setdefault(nick, seen)
+        self.visits[:0] = older.visits
+
+
+def _rank(row):
+    word, count = row
+    return -count, word
+
+
+class TopWords(object):
+    """The most used words of each channel, kept in order so that they can be listed
+    without sorting the whole vocabulary of the channel.
+    
+    There is a list per channel and per minimum word length of MIN_LENGTHS, of the
+    most used words longer than it. Word counts only ever grow, so a word can only enter
+    a list when its count is updated, which keeps the lists exact.
+    
+    Attributes:
+        size: The number of words of each list
+        lists: A dict of (channel ID, minimum length) pairs to lists of (word, count)
+            pairs, from the most used word
+        unsaved: A set of the (channel ID, minimum length) pairs known to have no saved
+            list
+    """
+    MIN_LENGTHS = (0, 3, 5, 8)
+    
+    def __init__(self, size = 100):
+        self.size = size
+        self.clear()
+        
+    def clear(self):
+        self.lists = {}
+        self.unsaved = set()
+        
+    def bucket(self, length):
+        """Returns the minimum length of the list that holds the words longer than
+        length."""
+        return max([b for b in self.MIN_LENGTHS if b <= length] or [0])
+        
+    def load(self, cid, min_length, rows):
+        self.lists[(cid, min_length)] = sorted(rows, key=_rank)[:self.size]
+        self.unsaved.discard((cid, min_length))
+        
+    def update(self, cid, counts):
+        """Merges the new counts of some words of a channel into its lists.
+        
+        Args:
+            cid: The channel ID
+            counts: A dict of words to their updated count
+            
+        Returns:
+            The minimum lengths whose list has changed.
+        """
+        changed = []
+        for min_length in self.MIN_LENGTHS:
+            top = self.lists.get((cid, min_length))
+            if top is None:
+                continue
+            
+            floor = top[-1][1] if len(top) >= self.size else 0
+            merged = dict(top)
+            for word, count in counts.iteritems():
+                if len(word) > min_length and (count >= floor or word in merged):
+                    merged[word] = count
+            
+            rows = sorted(merged.items(), key=_rank)[:self.size]
+            if rows != top:
+                self.lists[(cid, min_length)] = rows
+                changed.append(min_length)
+        return changed
+        
+    def top(self, cid, length, limit):
+        """Returns up to limit (word, count) pairs of the most used words longer than
+        length, or None if the list doesn't hold enough of them.
+        
+        The list of bucket(length) must be loaded."""
+        top = self.lists[(cid, self.bucket(length))]
+        rows = [row for row in top if len(row[0]) > length][:limit]
+        if len(rows) < limit and len(top) >= self.size:
+            return None
+        return rows
+
+
 class Statistics(PluginBase):
     """Statistics provides various user and channel statistics via commands.
     
-    channels: A dictionary of cached channel IDs.
-    users: A dictionary of cached user IDs.
+    Statistics are buffered in a StatsBuffer and written to the database in a single
+    transaction every FLUSH_INTERVAL seconds, or as soon as the buffer holds FLUSH_SIZE
+    entries. Commands flush the buffer before they read the database, and so does
+    on_exit, which the client sends when the bot quits. A batch that fails to be written
+    is kept for the next flush, unless the buffer has grown past MAX_BUFFER entries.
+    
+    The number of users in a channel is recorded on every join and part, and rolled up
+    into its minimum, maximum and mean per minute, hour and day (ROLLUPS). Raw records
+    are kept for RAW_RETENTION seconds, and the rollups of each resolution for as long
+    as ROLLUPS says. The highest number of users ever seen in a channel is kept apart.
+    
+    channels: A Cache of channel names to their IDs.
+    users: A Cache of lowercase nicks to their IDs.
+    buffer: A StatsBuffer of the statistics that haven't been written yet.
+    top_words: The TopWords of the channels, loaded when they're first listed and
+        saved along with the word counts.
     """
+    FLUSH_INTERVAL = 5
+    FLUSH_SIZE = 5000
+    MAX_BUFFER = 100000
+    ID_CACHE_SIZE = 10000
+    # (resolution, retention) pairs, in seconds. None keeps the rollups forever.
+    ROLLUPS = ((60, 30 * 86400), (3600, 365 * 86400), (86400, None))
+    RAW_RETENTION = 7 * 86400
+    COMPACT_INTERVAL = 3600
+    
     def __init__(self):
         PluginBase.__init__(self)
         self.name = 'Statistics'
@@ -22,21 +269,28 @@ class Statistics(PluginBase):
         self.path_schema = os.path.abspath('plugins/statistics/schema.sql')
         self.path_statsdb = os.path.abspath('plugins/statistics/stats.sqlite3')
         
-        self.channels = {}
-        self.users = {}
+        self.channels = Cache(self.ID_CACHE_SIZE)
+        self.users = Cache(self.ID_CACHE_SIZE)
+        self.buffer = StatsBuffer()
+        self._retry_time = 0
+        self.top_words = TopWords()
+        
+        self.hook(self.flush, self.FLUSH_INTERVAL)
+        self.hook(self.compact, self.COMPACT_INTERVAL)
         
     def fmt_time(self, time):
         return datetime.datetime.fromtimestamp(int(time)).strftime('%H:%M:%S %Y-%m-%d')
     
     def on_load(self):
-        if os.path.exists(self.path_statsdb):
-            self.conn = sqlite3.connect(self.path_statsdb)
-        else:
+        if not os.path.exists(self.path_statsdb):
             self.logger.debug('stats.sqlite3 does not exist. Creating a new stats.sqlite3.')
             self.create_db()
+        else:
+            self.connect()
+            self.migrate()
         
     def create_db(self):
-        self.conn = sqlite3.connect(self.path_statsdb)
+        self.connect()
         
         with open(self.path_schema, 'r') as f:
             try:
@@ -45,78 +299,271 @@ class Statistics(PluginBase):
                 self.conn.commit()
             except Exception as e:
                 self.logger.warning(e.message)
+        self.migrate()
+        
+    def connect(self):
+        """Opens the database in WAL mode, so that readers don't block the writes of a
+        flush and a commit costs a single sync."""
+        # With a worker pool, callbacks run on any of its threads (one at a time)
+        self.conn = sqlite3.connect(self.path_statsdb, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute('PRAGMA synchronous = NORMAL')
+        
+    def migrate(self):
+        """Applies the migrations that the database hasn't gone through yet, each in a
+        transaction of its own."""
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        
+        for i, script in enumerate(MIGRATIONS[version:], version + 1):
+            self.logger.info('Upgrading stats.sqlite3 to version {0}.'.format(i))
+            try:
+                self.conn.executescript('BEGIN; {0} PRAGMA user_version = {1}; COMMIT;'
+                                        .format(script, i))
+            except sqlite3.Error:
+                # Closing the connection rolls the open transaction back
+                self.logger.exception('Failed to upgrade stats.sqlite3 to version {0}.'.format(i))
+                self.conn.close()
+                self.conn = None
+                raise
         
     def update_counter(self, chan, count):
         """Records the number of online users in a given channel (timestamped)."""
-        c = self.conn.cursor()
-        params = (self.get_channel_id(chan), count, int(time.time()))
-        c.execute("INSERT INTO channel_visit (cid, count, time) VALUES (?, ?, ?)", params)
-        self.conn.commit()
+        self.buffer.add_visit(chan, count, int(time.time()))
+        self._check_buffer()
         
     def update_lastseen(self, user, channel):
         """Records when and where a user was last seen."""
-        c = self.conn.cursor()
-        params = (self.get_channel_id(channel), int(time.time()), self.get_user_id(user.nick))
-        c.execute("UPDATE user " \
-                  "SET lastseen_cid = ?, lastseen_time = ? WHERE id = ?", params)
-        self.conn.commit()
+        self.buffer.add_lastseen(user.nick, channel, int(time.time()))
+        self._check_buffer()
 
     def update_user_statistics(self, user, chan, msg):
-        """Updates fields of user_statistics. If they don't exist for a given user
-        and channel, create row."""
+        """Counts the words and lines of a user in a channel."""
+        self.buffer.add_message(chan, user.nick, self.split_words(msg))
+        self._check_buffer()
+        
+    def _check_buffer(self):
+        # After a failed flush, the timer retries first
+        if len(self.buffer) >= self.FLUSH_SIZE and time.time() >= self._retry_time:
+            self.flush()
+            
+    def flush(self):
+        """Writes the buffered statistics to the database in a single transaction."""
+        if not len(self.buffer) or self.conn is None:
+            return
+        
+        buf, self.buffer = self.buffer, StatsBuffer()
         c = self.conn.cursor()
-        params = (self.get_channel_id(chan), self.get_user_id(user.nick))
-        c.execute('SELECT id FROM user_statistics ' \
-                  'WHERE cid = ? and uid = ?', params)
-
-        self.conn.commit()
-
-        params = (len(msg.split()), self.get_user_id(user.nick), self.get_channel_id(chan))
-
-        if not c.fetchone():
-            c.execute('INSERT INTO user_statistics (word_count, uid, cid, line_count) ' \
-                      'VALUES (?, ?, ?, 1)', params)
-        else:
-            c.execute('UPDATE user_statistics ' \
-                      'SET word_count = word_count+?, line_count = line_count+1 ' \
-                      'WHERE uid = ? AND cid = ?', params)
-        self.conn.commit()
+        try:
+            c.executemany('INSERT INTO word_list (cid, word, count) VALUES (?, ?, ?) ' \
+                          'ON CONFLICT (cid, word) DO UPDATE SET count = count+excluded.count',
+                          [(self.get_channel_id(chan), word, count)
+                           for (chan, word), count in buf.words.iteritems()])
+            self.update_top_words(c, buf.words)
+            
+            c.executemany('INSERT INTO user_statistics (word_count, line_count, uid, cid) ' \
+                          'VALUES (?, ?, ?, ?) ON CONFLICT (cid, uid) DO UPDATE ' \
+                          'SET word_count = word_count+excluded.word_count, ' \
+                          'line_count = line_count+excluded.line_count',
+                          [(words, lines, self.get_user_id(nick), self.get_channel_id(chan))
+                           for (chan, nick), (words, lines) in buf.lines.iteritems()])
+            
+            for nick, (chan, when) in buf.lastseen.iteritems():
+                params = (self.get_channel_id(chan), when, self.get_user_id(nick))
+                c.execute("UPDATE user " \
+                          "SET lastseen_cid = ?, lastseen_time = ? WHERE id = ?", params)
+            
+            visits = [(self.get_channel_id(chan), count, when) for chan, count, when in buf.visits]
+            c.executemany("INSERT INTO channel_visit (cid, count, time) VALUES (?, ?, ?)", visits)
+            for resolution, retention in self.ROLLUPS:
+                c.executemany('INSERT INTO channel_population ' \
+                              '(cid, resolution, start, min, max, total, samples) ' \
+                              'VALUES (?, ?, ?, ?, ?, ?, 1) ' \
+                              'ON CONFLICT (cid, resolution, start) DO UPDATE ' \
+                              'SET min = MIN(min, excluded.min), max = MAX(max, excluded.max), ' \
+                              'total = total+excluded.total, samples = samples+excluded.samples',
+                              [(cid, resolution, when - when % resolution, count, count, count)
+                               for cid, count, when in visits])
+            c.executemany('INSERT INTO channel_peak (cid, count, time) VALUES (?, ?, ?) ' \
+                          'ON CONFLICT (cid) DO UPDATE ' \
+                          'SET count = excluded.count, time = excluded.time ' \
+                          'WHERE excluded.count > count', visits)
+            
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.logger.warning('Failed to write statistics: {0}'.format(e))
+            try:
+                self.conn.rollback()
+            except sqlite3.Error:
+                self.logger.exception('Failed to roll statistics back.')
+            # The rollback may have undone the insertion of cached IDs, and the saving of
+            # the top words, which are loaded again when they're needed
+            self.clear_ids()
+            self.top_words.clear()
+            
+            self._retry_time = time.time() + self.FLUSH_INTERVAL
+            if len(buf) + len(self.buffer) > self.MAX_BUFFER:
+                self.logger.error('Dropped {0} unwritten statistics.'.format(len(buf)))
+            else:
+                self.buffer.merge(buf)
         
-    def get_channel_id(self, name):
-        """Retrieves the channel id from the database. If it's not present, it will create a new one."""
+    def compact(self):
+        """Deletes the channel_visit records and the rollups that are past their
+        retention."""
+        if self.conn is None:
+            return
+        
+        now = int(time.time())
         c = self.conn.cursor()
+        try:
+            c.execute('DELETE FROM channel_visit WHERE time < ?', (now - self.RAW_RETENTION,))
+            deleted = c.rowcount
+            for resolution, retention in self.ROLLUPS:
+                if retention is not None:
+                    c.execute('DELETE FROM channel_population WHERE resolution = ? AND start < ?',
+                              (resolution, now - retention))
+                    deleted += c.rowcount
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            self.logger.warning('Failed to compact statistics: {0}'.format(e))
+            return
         
-        c.execute("SELECT id FROM channel WHERE name = ? LIMIT 1", (name,))
-        self.conn.commit()
-
-        id = c.fetchone()
+        if deleted:
+            self.logger.debug('Compacted {0} channel population records.'.format(deleted))
         
-        if not id:
-            c.execute("INSERT INTO channel (name) VALUES (?)", (name,))
+    def update_top_words(self, c, words):
+        """Merges the new counts of the words of a flush into the TopWords of their
+        channels, and saves the lists that changed.
+        
+        Every saved list of a channel is loaded first, as a list that missed an update
+        would no longer be exact. Lists that were never saved are left to be built
+        from word_list when they're needed.
+        
+        Args:
+            c: The cursor of the flush's transaction
+            words: The dict of (channel, word) pairs of a StatsBuffer
+        """
+        touched = {}
+        for chan, word in words:
+            touched.setdefault(self.get_channel_id(chan), []).append(word)
+        
+        for cid, names in touched.iteritems():
+            loaded = [self.load_top_words(c, cid, b) for b in TopWords.MIN_LENGTHS]
+            if not any(loaded):
+                continue
+            
+            counts = {}
+            for i in range(0, len(names), 500):
+                chunk = names[i:i + 500]
+                c.execute('SELECT word, count FROM word_list WHERE cid = ? AND word IN ({0})'
+                          .format(', '.join('?' * len(chunk))), [cid] + chunk)
+                counts.update(c.fetchall())
+            
+            for min_length in self.top_words.update(cid, counts):
+                self.save_top_words(c, cid, min_length)
+                
+    def save_top_words(self, c, cid, min_length):
+        c.execute('DELETE FROM top_words WHERE cid = ? AND min_length = ?', (cid, min_length))
+        c.executemany('INSERT INTO top_words (cid, min_length, word, count) VALUES (?, ?, ?, ?)',
+                      [(cid, min_length, word, count)
+                       for word, count in self.top_words.lists[(cid, min_length)]])
+        
+    def load_top_words(self, c, cid, min_length):
+        """Loads the saved list of a channel into TopWords, unless it's already loaded.
+        Returns False if there is no such list."""
+        key = (cid, min_length)
+        if key in self.top_words.lists:
+            return True
+        if key in self.top_words.unsaved:
+            return False
+        
+        c.execute('SELECT word, count FROM top_words WHERE cid = ? AND min_length = ?', key)
+        rows = c.fetchall()
+        if not rows:
+            self.top_words.unsaved.add(key)
+            return False
+        self.top_words.load(cid, min_length, rows)
+        return True
+        
+    def get_top_words(self, cid, length, limit):
+        """Returns up to limit (word, count) pairs of the most used words of a channel
+        that are longer than length."""
+        min_length = self.top_words.bucket(length)
+        c = self.conn.cursor()
+        if not self.load_top_words(c, cid, min_length):
+            # Never listed since the table was created: built once from word_list
+            c.execute('SELECT word, count FROM word_list WHERE cid = ? AND length(word) > ? '
+                      'ORDER BY count DESC LIMIT ?', (cid, min_length, self.top_words.size))
+            self.top_words.load(cid, min_length, c.fetchall())
+            self.save_top_words(c, cid, min_length)
             self.conn.commit()
-            id = self.get_channel_id(name)
+        
+        rows = self.top_words.top(cid, length, limit)
+        if rows is None:
+            c = self.conn.cursor()
+            c.execute('SELECT word, count FROM word_list WHERE cid = ? AND length(word) > ? '
+                      'ORDER BY count DESC LIMIT ?', (cid, length, limit))
+            rows = c.fetchall()
+        return rows
+        
+    def get_channel_id(self, name):
+        """Retrieves the channel id from the cache or the database. If it's not present,
+        it will create a new one."""
+        id = self.channels.get(name)
+        if id is not None:
             return id
-        else:
-            self.channels[id[0]] = name
-            return id[0]
         
-    def get_user_id(self, nick):
-        """Retrieves the user's id. If not present, a new one will be created."""
         c = self.conn.cursor()
+        c.execute("SELECT id FROM channel WHERE name = ? LIMIT 1", (name,))
+        row = c.fetchone()
         
-        c.execute('SELECT id FROM user WHERE LOWER(nick) = ? LIMIT 1', (nick.lower(),))
-        self.conn.commit()
+        if row:
+            id = row[0]
+        else:
+            # Committed along with the statistics that refer to it
+            c.execute("INSERT INTO channel (name) VALUES (?)", (name,))
+            id = c.lastrowid
+        self.channels.set(name, id)
+        return id
         
-        id = c.fetchone()
+    def get_user_id(self, nick):
+        """Retrieves the user's id from the cache or the database. If not present, a new
+        one will be created.
         
-        if not id:
-            c.execute('INSERT INTO user (nick) VALUES (?)', (nick.lower(),))
-            self.conn.commit()
-            id = self.get_user_id(nick)
+        Nicks are compared in ASCII lowercase, like the user_nick index, whatever the
+        casemapping of the server."""
+        nick = nick.lower()
+        id = self.users.get(nick)
+        if id is not None:
             return id
+        
+        c = self.conn.cursor()
+        c.execute('SELECT id FROM user WHERE LOWER(nick) = ? LIMIT 1', (nick,))
+        row = c.fetchone()
+        
+        if row:
+            id = row[0]
         else:
-            self.users[id] = nick
-            return id[0]
+            c.execute('INSERT INTO user (nick) VALUES (?)', (nick,))
+            id = c.lastrowid
+        self.users.set(nick, id)
+        return id
+        
+    def clear_ids(self):
+        """Empties the ID caches, whose hit rates are kept."""
+        self.channels.clear()
+        self.users.clear()
+        
+    def metrics(self):
+        caches = [('channel', self.channels.stats()), ('user', self.users.stats())]
+        return [
+            ('id_cache_hits_total', 'counter', 'ID lookups answered from the cache.',
+             [({'cache': name}, stats['hits']) for name, stats in caches]),
+            ('id_cache_misses_total', 'counter', 'ID lookups that queried the database.',
+             [({'cache': name}, stats['misses']) for name, stats in caches]),
+            ('id_cache_entries', 'gauge', 'IDs in the cache.',
+             [({'cache': name}, stats['size']) for name, stats in caches]),
+        ]
         
     def on_channel_part(self, user, channel, reason):
         if user.nick != self.irch.user.nick:
@@ -131,34 +578,33 @@ class Statistics(PluginBase):
         self.update_lastseen(user, channel.name)
         
     def on_channel_message(self, user, channel, msg):
-        """Calls methods that use channel message for their statistics."""
-        self.handle_wordlist(channel.name, msg.split())
+        """Counts the words and lines of a channel message."""
         self.update_user_statistics(user, channel.name, msg)
         
-    def handle_wordlist(self, chan, word_list):
-        """Maintains a table of word frequencies for a given channel."""
-        c = self.conn.cursor()
-        cid = self.get_channel_id(chan)
-        
-        for word in word_list:
+    def split_words(self, msg):
+        """Returns the list of the normalized words of a message, for the word frequency
+        table. Words without any letter or digit are left out."""
+        words = []
+        for word in msg.split():
             word = re.sub(r'\W+', '', word).lower().decode('utf-8')
-            
-            c.execute(u'SELECT id FROM word_list WHERE cid = ? AND word = ?', (cid, word))
-            self.conn.commit()
-
-            id = c.fetchone()
-            
-            if not id:
-                c.execute(u'INSERT INTO word_list (cid, word, count) VALUES (?, ?, ?)', (cid, word, 1))
-            else:
-                c.execute('UPDATE word_list SET count = count+1 WHERE id = ?', (id[0],))
+            if word:
+                words.append(word)
+        return words
+        
+    def on_exit(self):
+        self.flush()
+        if self.conn:
             self.conn.commit()
+            self.conn.close()
+            self.conn = None
+        PluginBase.on_exit(self)
             
     def command_seen(self, user, dst, args):
         """Displays where and when a given user was last seen by the bot."""
         if not args or len(args.split()) > 1 or len(args.split()) < 1:
             raise PluginBase.InvalidSyntax
         
+        self.flush()
         c = self.conn.cursor()
         
         query = 'SELECT channel.name, user.lastseen_time, user.nick ' \
@@ -176,11 +622,15 @@ class Statistics(PluginBase):
         
     def command_stats(self, user, dst, args):
         """Provides the top statistical information about users and channels.
-        Subcommands: words, peak, user
+        Subcommands: words, peak, user, cache
         """
+        if args.strip() == 'cache':
+            self.subcommand_stats_cache(user, dst, '')
+            return
         if len(args.split()) < 2:
             raise self.InvalidSyntax
         
+        self.flush()
         subcmd, subargs = args.split(' ', 1)
         
         if subcmd == 'words':
@@ -242,8 +692,9 @@ class Statistics(PluginBase):
             
     def subcommand_stats_peak(self, user, dst, args):
         """Returns the highest record of online users for a given channel.
-        Returns peak online users information for channels.
-        Syntax: {0}stats peak [get|top] <channel>
+        Returns peak online users information for channels. 'day' gives the lowest,
+        highest and average number of online users of the last 24 hours.
+        Syntax: {0}stats peak [get|day|top] <channel>
         """
         subargs = args.split()
         if subargs[0] == 'get':
@@ -252,31 +703,53 @@ class Statistics(PluginBase):
                 
                 c = self.conn.cursor()
                 id = self.get_channel_id(chan)
-                c.execute("SELECT count, time FROM channel_visit WHERE cid = {0} ORDER BY count DESC LIMIT 1".format(id))
-                rows = c.fetchall()
+                c.execute("SELECT count, time FROM channel_peak WHERE cid = ?", (id,))
+                row = c.fetchone()
 
-                if not len(rows):
+                if not row:
                     self.irch.say(u'No data available for channel {0}.'.format(chan), dst)
                     return
                 
-                for row in rows:
-                    date = datetime.datetime.fromtimestamp(int(row[1])).strftime('%Y-%m-%d %H:%M:%S')
-                    
-                    if not id:
-                        self.irch.say(u'No data available for channel {0}.'.format(chan), dst)
-                    else:
-                        self.irch.say(u'There were {0} users online (peak) in {1} on {2}.'.format(row[0], chan, date), dst)
+                date = datetime.datetime.fromtimestamp(int(row[1])).strftime('%Y-%m-%d %H:%M:%S')
+                self.irch.say(u'There were {0} users online (peak) in {1} on {2}.'.format(row[0], chan, date), dst)
             except IndexError:
                 self.irch.notice(self.INV_SYNTAX, user.nick)
+        elif subargs[0] == 'day':
+            try:
+                chan = subargs[1]
+            except IndexError:
+                raise self.InvalidSyntax
+            
+            # Whole hours, and the minutes of the partial hour before them
+            since = int(time.time()) - 86400
+            minutes = -(-since // 60) * 60
+            hours = -(-since // 3600) * 3600
+            
+            c = self.conn.cursor()
+            c.execute('SELECT MIN(min), MAX(max), SUM(total), SUM(samples) ' \
+                      'FROM channel_population WHERE cid = ? ' \
+                      'AND (resolution = 60 AND start >= ? AND start < ? ' \
+                      'OR resolution = 3600 AND start >= ?)',
+                      (self.get_channel_id(chan), minutes, hours, hours))
+            low, high, total, samples = c.fetchone()
+            
+            if not samples:
+                self.irch.say(u'No data available for channel {0}.'.format(chan), dst)
+                return
+            
+            self.irch.say(u'In the last 24 hours, {0} had between {1} and {2} users online ' \
+                          u'({3:.1f} on average).'.format(chan, low, high, float(total) / samples), dst)
         elif subargs[0] == 'top':
             c = self.conn.cursor()
-            c.execute("SELECT channel.name, channel_visit.count " \
-                      "FROM channel_visit " \
+            c.execute("SELECT channel.name, channel_peak.count " \
+                      "FROM channel_peak " \
                       "INNER JOIN channel " \
-                      "WHERE channel.id = channel_visit.cid "
-                      "ORDER BY channel_visit.count DESC LIMIT 1")
-            self.conn.commit()
+                      "WHERE channel.id = channel_peak.cid "
+                      "ORDER BY channel_peak.count DESC LIMIT 1")
             row1 = c.fetchone()
+            if not row1:
+                self.irch.say('No data available.', dst)
+                return
             self.irch.say('Channel {0} has the highest peak at {1} users online.'.format(*row1), dst)
         else:
             raise self.InvalidSyntax()
@@ -288,21 +761,12 @@ class Statistics(PluginBase):
             self.irch.notice(self.INV_SYNTAX, user.nick)
         else:
             subargs = args.split(' ', 1)
-        
-            c = self.conn.cursor()
             cid = self.get_channel_id(subargs[0])
             
             if len(subargs) > 1:
-                c.execute('''SELECT word, count FROM word_list WHERE cid = ? 
-                AND length(word) > ? ORDER BY count DESC LIMIT 5''', (cid, int(subargs[1])))
-            elif len(subargs) > 0:
-                c.execute('SELECT word, count FROM word_list WHERE cid = ? ' \
-                          'ORDER BY count DESC LIMIT 5', (cid,))
+                rows = self.get_top_words(cid, int(subargs[1]), 5)
             else:
-                self.irch.say('No data available.', dst)
-                
-            self.conn.commit()
-            rows = c.fetchall()
+                rows = self.get_top_words(cid, 0, 5)
             
             if len(rows) > 0:
                 msg = []
@@ -315,12 +779,27 @@ class Statistics(PluginBase):
             else:
                 self.irch.say('No data available for channel {0}'.format(subargs[0]), dst)
                 
-    def subcommand_stats_reset(self, nick, dst, args):
+    def subcommand_stats_cache(self, user, dst, args):
+        """Displays the hit rates of the channel and user ID caches.
+        Syntax: {0}stats cache"""
+        reply = []
+        for name, cache in (('Channel', self.channels), ('User', self.users)):
+            stats = cache.stats()
+            reply.append('{0} IDs: {size}/{max_entries} cached, {hits} hits, {misses} misses '
+                         '({1:.0%} hit rate)'.format(name, stats['hit_rate'], **stats))
+        self.irch.say('; '.join(reply) + '.', dst)
+        
+    def subcommand_stats_reset(self, user, dst, args):
         """Wipes the statistics database. Requires admin privileges."""
-        if nick[0] in self.irch.admins:
-            self.conn.close()
-            os.remove(self.path_statsdb)
-            self.create_db()
-            self.irch.say('Statistics database reset.', dst)
-            self.conn = sqlite3.connect(self.path_statsdb)
+        if not user.admin:
+            raise self.InvalidPermission
+        
+        self.conn.close()
+        self.clear_ids()
+        self.top_words.clear()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path_statsdb + suffix):
+                os.remove(self.path_statsdb + suffix)
+        self.create_db()
+        self.irch.say('Statistics database reset.', dst)
             
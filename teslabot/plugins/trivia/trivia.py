@@ -34,8 +34,8 @@ class Trivia(PluginBase):
             self._callbacks = []
             return
 
-        # Number of 5 second intervals between asking a question or giving a hint
-        self.askpause = 2
+        # Number of seconds between asking a question or giving a hint
+        self.askpause = 10
         # Default number of questions to ask in a round
         self.defaultnumquestions = 10
 
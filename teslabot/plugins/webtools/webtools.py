@@ -1,8 +1,10 @@
 from pluginbase import PluginBase
+from outbound import TokenBucket
 from HTMLParser import HTMLParser
 from random import randint
 import logging
 import requests
+import codecs
 import re
 try:
     from BeautifulSoup import BeautifulSoup
@@ -10,25 +12,183 @@ except ImportError:
     from bs4 import BeautifulSoup
 import json
 from config import Config, ConfigParser
+from cache import Cache
 import datetime, time
-from urlparse import urlparse
+from urlparse import urlparse, urlunparse
+
+# Links to these files are looked up with HEAD, since they have no title to read
+BINARY_EXTENSIONS = ('.iso', '.img', '.zip', '.rar', '.7z', '.gz', '.bz2', '.xz', '.tar',
+                     '.exe', '.msi', '.dmg', '.apk', '.deb', '.rpm', '.pdf', '.mp3', '.flac',
+                     '.ogg', '.mp4', '.mkv', '.avi', '.webm', '.jpg', '.jpeg', '.png', '.gif')
+
+URL_RE = re.compile(r'https?://[^\s<>"]+', re.IGNORECASE)
+
+TITLE_RE = re.compile(r'<title[^>]*>(.*?)</title', re.IGNORECASE | re.DOTALL)
+CHARSET_RE = re.compile(r'<meta[^>]+charset=["\']?([\w-]+)', re.IGNORECASE)
+
+def read_title(r, budget):
+    """Reads the body of a streamed HTML response until its title is complete, or
+    until budget bytes have been read. Returns the title, or None."""
+    encoding = r.encoding if 'charset' in r.headers.get('content-type', '') else None
+    buf = ''
+    for chunk in r.iter_content(4096):
+        buf += chunk
+        if encoding is None:
+            match = CHARSET_RE.search(buf)
+            if match:
+                encoding = match.group(1)
+        match = TITLE_RE.search(buf)
+        if match or len(buf) >= budget:
+            break
+    else:
+        match = None
+
+    if not match:
+        return None
+    try:
+        decoder = codecs.getdecoder(encoding or 'utf-8')
+    except LookupError:
+        decoder = codecs.getdecoder('utf-8')
+    return decoder(match.group(1)[:budget], 'replace')[0]
+
+
+def normalize_url(url):
+    """Returns a URL with its scheme and host in lowercase, and without its default port
+    or fragment, so that different spellings of a link share a cache entry."""
+    parts = urlparse(url)
+    scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+    host, sep, port = netloc.rpartition(':')
+    if (scheme, port) in (('http', '80'), ('https', '443')):
+        netloc = host
+    return urlunparse((scheme, netloc, parts.path or '/', parts.params, parts.query, ''))
+
+
+def extract_urls(msg, limit):
+    """Returns the list of distinct URLs of a message, in order, up to limit URLs.
+    Punctuation that ends a sentence isn't taken as part of a URL."""
+    urls = []
+    seen = set()
+    for match in URL_RE.finditer(msg):
+        url = match.group(0).rstrip('.,;:!?\'')
+        while url.endswith(')') and url.count(')') > url.count('('):
+            url = url[:-1]
+
+        key = normalize_url(url)
+        if key in seen:
+            continue
+        seen.add(key)
+        urls.append(url)
+        if len(urls) == limit:
+            break
+    return urls
+
+
+class PreviewBatch(object):
+    """Says the previews of the URLs of a message in their original order, as soon as
+    the preceding ones are done. Previews that aren't done by the deadline are
+    skipped. Runs on the event loop's thread.
+
+    Attributes:
+        dst: The channel name to reply to
+        lookups: A list of the Futures of the previews that haven't been said yet
+    """
+    def __init__(self, plugin, dst, lookups, deadline):
+        self.dst = dst
+        self.lookups = list(lookups)
+        self._plugin = plugin
+        self._loop = plugin.irch.loop
+        self._timer = self._loop.call_later(deadline, self._expire)
+        for lookup in self.lookups:
+            lookup.add_done_callback(self._flush)
+
+    def _flush(self, future = None):
+        while self.lookups and self.lookups[0].done():
+            self._reply(self.lookups.pop(0))
+        if not self.lookups and self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _expire(self):
+        self._timer = None
+        lookups, self.lookups = self.lookups, []
+        for lookup in lookups:
+            if lookup.done():
+                self._reply(lookup)
+            else:
+                self._plugin.logger.debug(u'URL preview for {0} timed out.'.format(self.dst))
+
+    def _reply(self, lookup):
+        if lookup.exception() is not None:
+            self._plugin.logger.debug(u'URL lookup failed: {0}'.format(lookup.exception()))
+        elif lookup.result():
+            self._plugin.irch.say(lookup.result(), self.dst)
+
+
+def content_length(r):
+    """Returns the size of a resource from the headers of a response (which may only
+    hold part of it), or None."""
+    total = r.headers.get('content-range', '').rpartition('/')[2]
+    if total.isdigit():
+        return int(total)
+    length = r.headers.get('content-length', '')
+    if r.status_code == 200 and length.isdigit():
+        return int(length)
+    return None
+
 
 class WebTools(PluginBase):
     """WebTools provides commands for quickly extracting information from websites such as
     dictionaries and encyclopedias.
     
+    Requests go through the client's shared WebClient, so they time out, and the URLs of
+    a message are looked up concurrently. Titles are read from a streamed response, and
+    no more than title_budget bytes of a page are downloaded.
+
+    Has the following configuration options:
+    [webtools]
+        imageboard: (Optional) A space-separated list of imageboard domains
+
+        title_budget: (Optional) The number of bytes of a page that are read at most to
+        find its title. Defaults to TITLE_BUDGET.
+
+        cache_ttl: (Optional) The number of seconds that URL previews and lookups are
+        cached for. Defaults to CACHE_TTL.
+
+        cache_size: (Optional) The maximum number of cached results. Defaults to
+        CACHE_SIZE.
+
+        cache_file: (Optional) A sqlite database file in which the cache is persisted.
+    
     TODO:
         Replace REGEX with BeautifulSoup.
     """
+    TITLE_BUDGET = 65536
+    # At most MAX_PREVIEWS URLs of a message are previewed, within PREVIEW_DEADLINE seconds
+    MAX_PREVIEWS = 5
+    PREVIEW_DEADLINE = 10
+    # A channel gets PREVIEW_BURST previews at once, then one every 1 / PREVIEW_RATE seconds
+    PREVIEW_RATE = 0.2
+    PREVIEW_BURST = 3
+    CACHE_TTL = 60 * 60
+    CACHE_SIZE = 1000
+
     def __init__(self):
         PluginBase.__init__(self)
         self.name = 'WebTools'
         self.logger = logging.getLogger('teslabot.plugin.webtools')
 
+        self.title_budget = self._option('title_budget', self.TITLE_BUDGET)
+        self.cache = Cache(self._option('cache_size', self.CACHE_SIZE),
+                           self._option('cache_ttl', self.CACHE_TTL),
+                           self._option('cache_file', None, str))
+        self.admin_commands = ['webcache']
+        # The TokenBucket of every channel that URLs have been previewed in
+        self._preview_buckets = {}
+
         # Load imageboard URL parser settings
         try:
             self.imageboard_urls = Config().get(self.name.lower(), 'imageboard').split()
-        except ConfigParser.NoSectionError:
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
             self.logger.debug('Imageboard settings not found.')
             self.imageboard_urls = []
 
@@ -45,40 +205,132 @@ class WebTools(PluginBase):
         self.strings.KEYWORD_NOT_FOUND = 'No news items found.'
         self.strings.NEWS_SET_REFRESHED = 'The news set has been updated!'
 
+    def _option(self, name, default, type = int):
+        """Returns an option of the plugin's section, or default if it's missing or
+        invalid."""
+        try:
+            value = Config().get(self.name.lower(), name)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return default
+        try:
+            return type(value)
+        except ValueError:
+            self.logger.warning(u'Invalid value for [{0}]: {1!r}. Using {2!r}.'.format(
+                name, value, default))
+            return default
+
+    def on_exit(self):
+        self.cache.close()
+        PluginBase.on_exit(self)
+
+    def metrics(self):
+        stats = self.cache.stats()
+        return [
+            ('cache_hits_total', 'counter', 'Lookups answered from the cache.', stats['hits']),
+            ('cache_misses_total', 'counter', 'Lookups not found in the cache.', stats['misses']),
+            ('cache_entries', 'gauge', 'Results in the cache.', stats['size']),
+        ]
+
+    def command_webcache(self, user, dst, args):
+        """Syntax: {0}webcache [clear]
+        Displays the hit rate of the cache of web lookups, or clears it. Requires admin
+        privileges."""
+        if not user.admin:
+            raise self.InvalidPermission
+        if args == 'clear':
+            self.cache.clear()
+            self.irch.notice('Web cache cleared.', user.nick)
+            return
+
+        self.irch.notice('Web cache: {size}/{max_entries} entries, {hits} hits, {misses} misses '
+                         '({0:.0%} hit rate), {expirations} expired, {evictions} evicted.'.format(
+                             self.cache.stats()['hit_rate'], **self.cache.stats()), user.nick)
+
     def on_channel_message(self, user, channel, msg):
-        """Provides meta information of URLs in a given channel message."""
-        for word in msg.split():
-            if word[:7] == 'http://' or word[:8] == 'https://':
-                parsed_url = urlparse(word)
-                domain = parsed_url.netloc
-                pattern = '{0}/{1}/res/{1}'.format(domain, '.+')
-
-                if domain in self.imageboard_urls and re.findall(pattern, word):
-                    self.handle_imgboard_url(user, channel, word, domain)
-                else:
-                    desc = self.handle_http_url(word)
-                    self.irch.say(desc, channel.name)
+        """Provides meta information of URLs in a given channel message.
+
+        The URLs are looked up concurrently on the threads of the client's WebClient,
+        and the plugin doesn't wait for them: a PreviewBatch says the replies from the
+        event loop as they arrive. URLs over the channel's preview rate limit aren't
+        looked up at all."""
+        urls = [url for url in extract_urls(msg, self.MAX_PREVIEWS)
+                if self._allow_preview(channel.name)]
+        if not urls:
+            return
 
-    def handle_http_url(self, url):
-        r = requests.get(url)
+        http = self.irch.http()
+        lookups = [http.submit(self.preview, url) for url in urls]
+        self.irch.loop.call_soon_threadsafe(PreviewBatch, self, channel.name, lookups,
+                                            self.PREVIEW_DEADLINE)
 
-        if r.status_code == 200:
-            if r.headers['content-type'].count('text/html'):
-                r.encoding = 'utf-8'
-                soup = BeautifulSoup(r.text)
-                title = soup.title.text
+    def preview(self, url):
+        """Returns the preview text of a URL."""
+        domain = urlparse(url).netloc
+        pattern = '{0}/{1}/res/{1}'.format(domain, '.+')
 
-                return self.format_text(title)
-            else:
-                return u'Content-Type: {0} | Content Length: {1} KiB'.format(
-                    r.headers['content-type'],
-                    int(r.headers['content-length']) / 1024
-                )
-        else:
-            return u'HTTP Error Code: {0}'.format(r.status_code)
+        if domain in self.imageboard_urls and re.findall(pattern, url):
+            return self.handle_imgboard_url(url, domain)
+        return self.handle_http_url(url)
+
+    def _allow_preview(self, dst):
+        """Returns True unless the channel has had too many previews lately."""
+        bucket = self._preview_buckets.get(dst.lower())
+        if bucket is None:
+            bucket = TokenBucket(self.PREVIEW_RATE, self.PREVIEW_BURST)
+            self._preview_buckets[dst.lower()] = bucket
 
-    def handle_imgboard_url(self, user, channel, url, domain):
-        """Parses an imageboard url."""
+        if bucket.consume():
+            return True
+        self.logger.debug(u'Dropped a URL preview for {0}: rate limit reached.'.format(dst))
+        return False
+
+    def handle_http_url(self, url):
+        """Returns the title of a web page, or the type and size of other resources.
+        Successful results are cached; errors, which may be transient, aren't."""
+        key = u'url ' + normalize_url(url)
+        text = self.cache.get(key)
+        if text is None:
+            status, text = self.describe_url(url)
+            if 200 <= status < 300:
+                self.cache.set(key, text)
+        return text
+
+    def describe_url(self, url):
+        """Returns the HTTP status of a URL and the title of its web page, or the type
+        and size of other resources.
+
+        Only the first title_budget bytes of a page are requested (with a Range header)
+        and read, and reading stops as soon as the title is complete. The body of other
+        resources isn't read at all."""
+        http = self.irch.http()
+        if urlparse(url).path.lower().endswith(BINARY_EXTENSIONS):
+            r = http.request('HEAD', url, allow_redirects=True)
+            if r.status_code in (200, 206):
+                return r.status_code, self.describe_content(r)
+
+        headers = {'Range': 'bytes=0-{0}'.format(self.title_budget - 1)}
+        with http.open(url, headers=headers) as r:
+            if r.status_code not in (200, 206):
+                return r.status_code, u'HTTP Error Code: {0}'.format(r.status_code)
+
+            content_type = r.headers.get('content-type', '')
+            if 'html' not in content_type:
+                return r.status_code, self.describe_content(r)
+
+            title = read_title(r, self.title_budget)
+            if not title:
+                return r.status_code, u'Content-Type: {0} | No title'.format(content_type)
+            return r.status_code, self.format_text(title)
+
+    def describe_content(self, r):
+        size = content_length(r)
+        content_type = r.headers.get('content-type', 'unknown')
+        if size is None:
+            return u'Content-Type: {0}'.format(content_type)
+        return u'Content-Type: {0} | Content Length: {1} KiB'.format(content_type, size / 1024)
+
+    def handle_imgboard_url(self, url, domain):
+        """Returns the preview of an imageboard thread or post."""
         url = url.split('/')
         board = url[3]
         post = None
@@ -91,15 +343,13 @@ class WebTools(PluginBase):
             thread = url[-1].split('.')[0]
 
         api = 'http://{0}/{1}/res/{2}.json'.format(domain, board, thread)
-        r = requests.get(api)
-        r.encoding = 'utf-8'
+        text = self.cache.get_or_set(u'imgboard ' + api, self.get_text, api)
 
-        if r.text:
+        if text:
             try:
-                items = json.loads(r.text)
+                items = json.loads(text)
             except ValueError:
-                self.irch.say('404 - Not found.', channel.name)
-                return
+                return '404 - Not found.'
 
             item = None
 
@@ -110,8 +360,7 @@ class WebTools(PluginBase):
                     if int(p['no']) == post:
                         item = p
                 if item is None:
-                    self.irch.say('404 - Post Not found.', channel.name)
-                    return
+                    return '404 - Post Not found.'
 
             if item:
                 reply = '\x032[/{0}/]\x03 \x0310{1}\x03 \x02\x037{2}:\x03\x02 {3}'
@@ -129,13 +378,17 @@ class WebTools(PluginBase):
                     else:
                         time = '{0} hours ago'.format(time.seconds / (60*60))
 
-                reply = reply.format(board, time, item['name'], preview)
-
-                self.irch.say(reply, channel.name)
+                return reply.format(board, time, item['name'], preview)
 
         else:
-            self.irch.say('404 - Not found.', channel.name)
+            return '404 - Not found.'
         
+    def get_text(self, url):
+        """Returns the body of a web page, decoded as UTF-8."""
+        r = self.irch.http().get(url)
+        r.encoding = 'utf-8'
+        return r.text
+
     def format_text(self, text):
         """Removes HTML and truncates the text for chat output."""
         h = HTMLParser()
@@ -171,7 +424,7 @@ class WebTools(PluginBase):
         headers = {'user-agent': 'Mozilla/4.0 (compatible; MSIE 6.0; Windows NT 5.1; SV1; .NET ' \
                    'CLR 1.1.4322; .NET CLR 2.0.50727; .NET CLR 3.0.04506.30)'}
         url = u'http://translate.google.com/m?tl={0}&sl={1}&q={2}'.format(lang, 'auto', text.replace(' ', '+'))
-        r = requests.get(url, headers=headers)
+        r = self.irch.http().get(url, headers=headers)
         
         start = '<div dir="ltr" class="t0">'
         end = '</div>'
@@ -184,9 +437,11 @@ class WebTools(PluginBase):
         if len(args.split()) > 1:
             raise PluginBase.InvalidSyntax
         
-        req = requests.get('http://freegeoip.net/csv/{0}'.format(args))
-        req.encoding = 'utf-8'
-        text = req.text
+        reply = self.cache.get_or_set(u'geoip ' + args.lower(), self.lookup_geoip, args)
+        self.irch.say(reply, dst)
+
+    def lookup_geoip(self, args):
+        text = self.get_text('http://freegeoip.net/csv/{0}'.format(args))
         
         if text.find(',') != -1:
             country = text.split(',')[2]
@@ -194,13 +449,11 @@ class WebTools(PluginBase):
             country = country[1:][:-1]
             
             if len(city):
-                reply = u'IP address {0} originates from {1}, \x02{2}\x02.'.format(args, city, country)
+                return u'IP address {0} originates from {1}, \x02{2}\x02.'.format(args, city, country)
             else:
-                reply = u'IP address {0} originates from \x02{1}\x02.'.format(args, country)
-
-            self.irch.say(reply, dst)
+                return u'IP address {0} originates from \x02{1}\x02.'.format(args, country)
         else:
-            self.irch.say(text, dst)
+            return text
             
     def command_def(self, user, dst, args):
         """Syntax: {0}def [source] [word]
@@ -216,7 +469,11 @@ class WebTools(PluginBase):
             self.subcommand_def_dict(user, dst, phrase)
 
     def subcommand_def_dict(self, user, dst, phrase):
-        html = requests.get('http://www.wordnik.com/words/{0}'.format(phrase)).text
+        reply = self.cache.get_or_set(u'dict ' + phrase.lower(), self.lookup_dict, phrase)
+        self.irch.say(reply, dst)
+
+    def lookup_dict(self, phrase):
+        html = self.irch.http().get('http://www.wordnik.com/words/{0}'.format(phrase)).text
         soup = BeautifulSoup(html)
             
         reply = []
@@ -241,15 +498,17 @@ class WebTools(PluginBase):
                         type_count[word_type] = 1
             break
         if reply:
-            self.irch.say(u'\x038[Dict]\x03 \x02\x032{0}:\x03\x02 {1}'.format(phrase, u' | '.join(reply), source), dst)
+            return u'\x038[Dict]\x03 \x02\x032{0}:\x03\x02 {1}'.format(phrase, u' | '.join(reply), source)
         else:
-            self.irch.say(u'\x038[Dictionary]\x03 Definition for \x02{0}\x02 not found.'.format(phrase), dst)
+            return u'\x038[Dictionary]\x03 Definition for \x02{0}\x02 not found.'.format(phrase)
 
     def subcommand_def_urbdict(self, user, dst, args):
-        r = requests.get(u'http://api.urbandictionary.com/v0/define?term={0}'.format(args))
-        r.encoding = 'utf-8'
+        reply = self.cache.get_or_set(u'urbdict ' + args.lower(), self.lookup_urbdict, args)
+        self.irch.say(reply, dst)
 
-        decoded = json.loads(r.text)
+    def lookup_urbdict(self, args):
+        decoded = json.loads(self.get_text(
+            u'http://api.urbandictionary.com/v0/define?term={0}'.format(args)))
         ans = u'\x037[UrbDict]\x03 \x032{0}:\x03 {1} (\x0308{2}\x03\u2191\x0308{3}\x03\u2193)'
 
         if decoded.get('list'):
@@ -261,9 +520,9 @@ class WebTools(PluginBase):
                 break
 
         if decoded.get('result_type') == 'exact':
-            self.irch.say(ans, dst)
+            return ans
         else:
-            self.irch.say('\x038[UrbanDictionary]\x03 Definition not found.', dst)
+            return u'\x038[UrbanDictionary]\x03 Definition not found.'
     
     def command_news(self, user, dst, args):
         """Retrieves the latest news from around the world.
@@ -300,10 +559,10 @@ class WebTools(PluginBase):
                 # either when there is currently no news set, or
                 # when the argument 'refresh' is given.
                 try:
-                    r = requests.get(
+                    r = self.irch.http().get(
                         self.strings.URL_GOOGLE.format(self.news['cur_ed'])
                     )
-                except requests.ConnectionError:
+                except requests.RequestException:
                     self.irch.say(self.strings.CONNECTION_ERROR, dst)
                     return
 
@@ -390,8 +649,8 @@ class WebTools(PluginBase):
             raise PluginBase.InvalidPermission
         try:
             # TODO: Consider the safety of directly placing user input
-            r = requests.get(self.strings.URL_GOOGLE_SEARCH.format(args))
-        except requests.ConnectionError:
+            r = self.irch.http().get(self.strings.URL_GOOGLE_SEARCH.format(args))
+        except requests.RequestException:
             self.irch.say(self.strings.CONNECTION_ERROR, dst)
             return
 
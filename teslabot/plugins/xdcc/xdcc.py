@@ -345,9 +345,9 @@ class FileSession(object):
 class XDCC(PluginBase):
     """An XDCC plugin for file-sharing. Supports concurrent connections.
 
-    A note about _qtimeout: _qtimeout normally defaults to 5, but even 1 is too
-    slow for file transfer. Setting it to 0 ensures a fast connection but at the
-    cost of CPU cycles. This is a limitation of the plugin design.
+    Transfers are driven by hooks: while a file is offered, the DCC server is polled
+    for new connections every ACCEPT_INTERVAL seconds, and every PUMP_INTERVAL seconds
+    chunks are sent until the sockets' buffers are full (or for PUMP_TIME seconds).
 
     Has the following configuration options:
     [xdcc]
@@ -359,13 +359,17 @@ class XDCC(PluginBase):
 
         directory: (Required) The file system directory where the files will be stored.
     """
-    # TODO: Collect statistics information such as bytes sent, etc.
+    ACCEPT_INTERVAL = 0.5
+    PUMP_INTERVAL = 0.05
+    PUMP_TIME = 0.04
+    # The transfer rate is measured over windows of RATE_WINDOW seconds
+    RATE_WINDOW = 5
+
     def __init__(self):
         PluginBase.__init__(self)
 
         self.name = 'XDCC'
         self.logger = logging.getLogger('teslabot.plugin.XDCC')
-        self._qtimeout = 1
 
         self._dcc_port = 6500
         self._dcc_ip = None
@@ -406,6 +410,11 @@ class XDCC(PluginBase):
         self.new_conn_timeout = 20
         # Last time (in UNIX secs) that a new server connection was expected
         self._last_request = None
+        # Bytes sent by every transfer so far, and the rate of the last full window
+        self.bytes_sent = 0
+        self._rate = 0.0
+        self._rate_start = time.time()
+        self._rate_bytes = 0
 
         self.strings.TRANSFER_FAILURE = u'[{0}] failed!'
         self.strings.TRANSFER_SUCCESS = u'[{0}] was successful!'
@@ -531,7 +540,7 @@ class XDCC(PluginBase):
             ), user.nick)
             self._manager.add(DCCSocket(
                 user, self._dcc_port, file_name, file_handler, file_size))
-            self.hook(self.handle_new_conn)
+            self.hook(self.handle_new_conn, self.ACCEPT_INTERVAL)
 
             self.irch.notice(
                 u'You have been offered [{0}] for download. Please accept the file ' \
@@ -550,8 +559,8 @@ class XDCC(PluginBase):
             self._manager.load_sd(s, addr)
 
             # Only hook when it is not currently hooked.
-            if self.handle_dcc_conn not in self._hooks:
-                self.hook(self.handle_dcc_conn)
+            if not self.is_hooked(self.handle_dcc_conn):
+                self.hook(self.handle_dcc_conn, self.PUMP_INTERVAL)
         except socket.error:
             if not self._manager.pending():
                 self.unhook(self.handle_new_conn)
@@ -561,14 +570,26 @@ class XDCC(PluginBase):
                 self.logger.debug('Unhooked [handle_new_conn] due to inactivity.')
 
     def handle_dcc_conn(self):
-        """Polls every DCC transfer in progress to send a chunk."""
+        """Sends chunks to every DCC transfer in progress until no socket can take more
+        data, or for at most PUMP_TIME seconds."""
         client_list = self._manager.get_active_clients()
-        if client_list:
+        if not client_list:
+            # All transfers have been completed. Unhook this method.
+            self.unhook(self.handle_dcc_conn)
+            self.close_server()
+            return
+
+        deadline = time.time() + self.PUMP_TIME
+        while client_list and time.time() < deadline:
             conns = select.select([], client_list, [], 0)
+            if not conns[1]:
+                break
 
             for dcc_socket in conns[1]:
+                sent = dcc_socket._total_bytes_sent
                 try:
                     dcc_socket.send_chunk()
+                    self._count(dcc_socket._total_bytes_sent - sent)
                     if dcc_socket.done:
                         self._manager.remove(dcc_socket)
                         self.irch.notice(
@@ -578,14 +599,30 @@ class XDCC(PluginBase):
                     self._manager.remove(dcc_socket)
                     self.irch.notice(self.strings.TRANSFER_FAILURE.format(unicode(dcc_socket)),
                                   dcc_socket.user.nick)
-        else:
-            # All transfers have been completed. Unhook this method.
-            self.unhook(self.handle_dcc_conn)
-            self.close_server()
+            client_list = self._manager.get_active_clients()
+
+    def _count(self, n):
+        self.bytes_sent += n
+        self._rate_bytes += n
+        now = time.time()
+        if now - self._rate_start >= self.RATE_WINDOW:
+            self._rate = self._rate_bytes / (now - self._rate_start)
+            self._rate_start = now
+            self._rate_bytes = 0
+
+    def metrics(self):
+        rate = self._rate
+        if time.time() - self._rate_start >= 2 * self.RATE_WINDOW:
+            # No chunk has been sent for a whole window
+            rate = 0.0
+        return [
+            ('sent_bytes_total', 'counter', 'Bytes sent by DCC transfers.', self.bytes_sent),
+            ('send_rate_bytes', 'gauge', 'Bytes per second sent by DCC transfers.', rate),
+            ('active_transfers', 'gauge', 'DCC transfers in progress.', self._manager.active()),
+        ]
 
     def create_server(self, port):
         """Creates the DCC server socket."""
-        self._qtimeout = 0
         self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._server.bind(('0.0.0.0', port))
         self._server.setblocking(0)
@@ -593,5 +630,4 @@ class XDCC(PluginBase):
 
     def close_server(self):
         """Closes the DCC server socket."""
-        self._server.close()
-        self._qtimeout = 1
\ No newline at end of file
+        self._server.close()
\ No newline at end of file
@@ -1,6 +1,7 @@
 import logging
 from ircclient import IRCClient
 from config import Config
+from metrics import MetricsServer
 import sys
 
 def start_logging(level = logging.DEBUG):
@@ -35,8 +36,11 @@ if __name__ == '__main__':
                 
     irch = IRCClient(c.nick, c.realname, c.channels, c.admins, c.trigger,
                      c.plugins, c.password, c.ssl, c.reconnect,
-                     c.oper_user, c.oper_pass)
+                     c.oper_user, c.oper_pass, c.workers,
+                     c.queue_size, c.queue_policy, c.perf_interval)
     irch.load_plugins()
+    if c.metrics_port:
+        MetricsServer(irch, c.metrics_port, c.metrics_host).start()
     irch.connect(c.host, c.port)
 
     try:
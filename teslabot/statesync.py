@@ -0,0 +1,227 @@
+"""Network state synchronisation with WHO and WHOX.
+
+NAMES replies only tell which nicknames are in a channel. When the bot joins a
+channel, StateSync asks the server who is in it with a WHO query, which also returns
+the ident, hostname, realname and away status of every member (plus the services
+account with WHOX), so plugins don't need a WHOIS round-trip per user. Replies are
+applied to the UserList and ChannelList as they arrive.
+
+The state is then kept current incrementally by the JOIN, PART, QUIT, NICK, KICK and
+MODE handlers of the IRC class, with the help of parse_modes().
+"""
+import collections
+import logging
+
+from casemapping import casefold
+from user import intern_string
+
+# WHOX queries ask for: token, channel, ident, host, nick, flags, account, realname.
+# The server always replies with the fields in this order.
+WHOX_FIELDS = '%tcuhnfar'
+WHOX_TOKEN = '152'
+
+DEFAULT_PREFIX = '(qaohv)~&@%+'
+DEFAULT_CHANMODES = 'beI,k,l,imnpst'
+
+
+def parse_prefix(value):
+    """Returns a list of (mode, symbol) pairs from the value of the PREFIX token of
+    RPL_ISUPPORT (e.g. '(ov)@+'), from the highest rank to the lowest."""
+    if not value.startswith('(') or ')' not in value:
+        return []
+    modes, symbols = value[1:].split(')', 1)
+    return zip(modes, symbols)
+
+
+class StateSync(object):
+    """Queries the members of joined channels with WHO (or WHOX, if the server
+    supports it) and applies the replies to the user and channel lists.
+
+    One query is in flight at a time. Queries go through the outbound queue, so they
+    are subject to its rate limit, and the next one is only sent when the server has
+    finished replying to the previous one (or after WHO_TIMEOUT seconds).
+
+    Attributes:
+        prefixes: A list of (mode, symbol) pairs of channel prefix modes
+        chanmodes: A tuple of four strings of channel modes that always take a
+            parameter (list modes and others), take one when set, or never take one
+
+        _irc: The IRC object whose state is synchronised
+        _queue: A deque of channel names waiting to be queried
+        _current: The channel name of the query in flight, or None
+        _timer: The Timer that gives up on the query in flight
+    """
+    WHO_TIMEOUT = 60
+
+    def __init__(self, irc):
+        self.logger = logging.getLogger('teslabot.irc.statesync')
+        self._irc = irc
+        self._queue = collections.deque()
+        self._current = None
+        self._timer = None
+
+        self.prefixes = []
+        self.chanmodes = ()
+        self.set_prefix(DEFAULT_PREFIX)
+        self.set_chanmodes(DEFAULT_CHANMODES)
+
+    def _key(self, name):
+        return casefold(name, self._irc.channels.casemapping)
+
+    def set_prefix(self, value):
+        """Updates the channel prefix modes from the PREFIX token of RPL_ISUPPORT."""
+        prefixes = parse_prefix(value)
+        if not prefixes:
+            return
+        self.prefixes = prefixes
+        self._prefix_modes = ''.join(mode for mode, symbol in prefixes)
+        self._symbols = dict((symbol, mode) for mode, symbol in prefixes)
+        self._irc.channels.set_prefixes(self._symbols)
+
+    def set_chanmodes(self, value):
+        """Updates the channel mode types from the CHANMODES token of RPL_ISUPPORT."""
+        types = value.split(',')
+        if len(types) < 4:
+            return
+        self.chanmodes = tuple(types[:4])
+
+    def parse_modes(self, modes, args):
+        """Pairs the letters of a mode string with their parameters.
+
+        Args:
+            modes: A mode string, e.g. '+o-v+l'
+            args: A list of parameter strings
+
+        Returns:
+            A list of (adding, mode, parameter) tuples. The parameter is None for modes
+            that don't take one.
+        """
+        always = self._prefix_modes + self.chanmodes[0] + self.chanmodes[1]
+        when_set = self.chanmodes[2]
+        changes = []
+        adding = True
+        args = list(args)
+
+        for mode in modes:
+            if mode == '+':
+                adding = True
+            elif mode == '-':
+                adding = False
+            else:
+                arg = None
+                if mode in always or (adding and mode in when_set):
+                    arg = args.pop(0) if args else None
+                changes.append((adding, mode, arg))
+        return changes
+
+    def is_prefix_mode(self, mode):
+        return mode in self._prefix_modes
+
+    def clear(self):
+        """Forgets every pending query. Called when the connection is (re)established."""
+        self._queue.clear()
+        self._current = None
+        self._cancel_timer()
+
+    def request(self, chan):
+        """Queues a WHO query for a given channel name, unless one is already pending."""
+        key = self._key(chan)
+        if self._current is not None and self._key(self._current) == key:
+            return
+        if key in [self._key(name) for name in self._queue]:
+            return
+
+        self._queue.append(chan)
+        if self._current is None:
+            self._next()
+
+    def cancel(self, chan):
+        """Drops the pending query of a channel that the bot has left."""
+        key = self._key(chan)
+        for name in list(self._queue):
+            if self._key(name) == key:
+                self._queue.remove(name)
+
+    def pending(self):
+        """Returns the number of channels waiting to be queried, including the query in
+        flight."""
+        return len(self._queue) + (self._current is not None)
+
+    def _next(self):
+        self._cancel_timer()
+        self._current = None
+
+        while self._queue:
+            chan = self._queue.popleft()
+            if chan not in self._irc.channels:
+                continue
+
+            self._current = chan
+            if 'WHOX' in self._irc.isupport:
+                self._irc.send(u'WHO {0} {1},{2}'.format(chan, WHOX_FIELDS, WHOX_TOKEN))
+            else:
+                self._irc.send(u'WHO {0}'.format(chan))
+            self._timer = self._irc.loop.call_later(self.WHO_TIMEOUT, self._timeout)
+            return
+
+    def _timeout(self):
+        self._timer = None
+        self.logger.warning(u'WHO query for {0} timed out.'.format(self._current))
+        self._next()
+
+    def _cancel_timer(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+    def _update(self, chan, ident, host, nick, flags, gecos, account = None):
+        """Applies a single WHO or WHOX reply."""
+        irc = self._irc
+        if chan not in irc.channels and nick not in irc.users:
+            # Not a user that the bot shares a channel with
+            return
+        user = irc.users[nick]
+
+        if user.real != ident:
+            user.real = intern_string(ident)
+        if user.host != host:
+            user.host = intern_string(host)
+        user.gecos = gecos
+        user.away = flags[:1] == 'G'
+        if account is not None:
+            user.account = None if account == '0' else account
+
+        if chan not in irc.channels:
+            return
+        channel = irc.channels[chan]
+        modes = [self._symbols[c] for c in flags[1:] if c in self._symbols]
+
+        # The reply is authoritative for the user's prefix modes in the channel
+        user.modes.remove(channel.name, -1)
+        for mode in modes:
+            user.modes.add(channel.name, mode)
+        channel.remove(user)
+        channel.add(user, modes)
+
+    def on_RPL_WHOREPLY(self, user, msg):
+        """<me> <channel> <ident> <host> <server> <nick> <flags> :<hopcount> <realname>"""
+        args = msg.args
+        if len(args) < 8:
+            return
+        hops, sep, gecos = args[7].partition(' ')
+        self._update(args[1], args[2], args[3], args[5], args[6], gecos)
+
+    def on_RPL_WHOSPCRPL(self, user, msg):
+        """<me> <token> <channel> <ident> <host> <nick> <flags> <account> :<realname>"""
+        args = msg.args
+        if len(args) < 9 or args[1] != WHOX_TOKEN:
+            return
+        self._update(args[2], args[3], args[4], args[5], args[6], args[8], args[7])
+
+    def on_RPL_ENDOFWHO(self, user, msg):
+        """<me> <mask> :End of WHO list"""
+        if len(msg.args) < 2 or self._current is None:
+            return
+        if self._key(msg.args[1]) == self._key(self._current):
+            self.logger.debug(u'Synchronised {0}.'.format(self._current))
+            self._next()
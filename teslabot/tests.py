@@ -0,0 +1,904 @@
+"""
+Run from 'teslabot' dir with
+    python -m tests
+"""
+
+from framer import LineFramer
+from ircmessage import Dispatcher, parse
+from outbound import OutboundQueue, split_utf8
+from user import UserList
+from channel import ChannelList
+from irc import IRC
+from ircclient import IRCClient
+from workerpool import WorkerPool
+from eventqueue import EventQueue
+from perf import Histogram
+from metrics import MetricsServer
+from cache import Cache
+from eventloop import EventLoop
+from coroutine import Future, Return, Task, sleep
+from pluginbase import PluginBase, Hook
+from plugins.statistics.statistics import Statistics
+from plugins.statistics import statistics
+import time
+import threading
+import urllib2
+import os
+import tempfile
+import shutil
+import sqlite3
+
+
+class FramerTests:
+    def test_split_across_feeds(self):
+        f = LineFramer()
+        assert(f.feed('PING :a\r\n:srv 001 ') == ['PING :a'])
+        assert(f.feed('nick :Welcome\r\n') == [':srv 001 nick :Welcome'])
+        assert(len(f) == 0)
+
+    def test_crlf_split_across_feeds(self):
+        f = LineFramer()
+        assert(f.feed('PING :a\r') == [])
+        assert(f.feed('\nPING :b\n\r\n') == ['PING :a', 'PING :b'])
+
+    def test_cr_terminator(self):
+        f = LineFramer()
+        assert(f.feed('PING :a\rPING :b\r') == ['PING :a'])
+        assert(f.feed('PING :c\r') == ['PING :b'])
+        assert(f.feed('\n') == ['PING :c'])
+        assert(len(f) == 0)
+
+    def test_overlong_line_dropped(self):
+        f = LineFramer(max_line=10)
+        assert(f.feed('x' * 15) == [])
+        assert(f.feed('xxx\r\nok\r\n') == ['ok'])
+        assert(f.feed('y' * 11 + '\r\nok2\r\n') == ['ok2'])
+        assert(f.overflows == 2)
+
+
+class MessageTests:
+    def test_parse_privmsg(self):
+        msg = parse(':nick!real@host PRIVMSG #chan :hello :) world')
+        assert(msg.prefix == 'nick!real@host')
+        assert(msg.command == 'PRIVMSG')
+        assert(msg.params == ['#chan'])
+        assert(msg.trailing == 'hello :) world')
+        assert(msg.tags is None)
+
+    def test_parse_without_trailing(self):
+        msg = parse(':server 001')
+        assert(msg.command == '001')
+        assert(msg.args == [])
+
+        msg = parse('PING server')
+        assert(msg.prefix is None)
+        assert(msg.args == ['server'])
+
+    def test_parse_tags(self):
+        msg = parse('@time=2020-01-01;msgid=a\\sb\\:c;flag :n!r@h JOIN #chan')
+        assert(msg.tags == {'time': '2020-01-01', 'msgid': 'a b;c', 'flag': ''})
+        assert(msg.args == ['#chan'])
+
+    def test_parse_invalid(self):
+        for line in ('', ':prefix', '@tags'):
+            try:
+                parse(line)
+                assert(False)
+            except ValueError:
+                pass
+
+    def test_dispatch(self):
+        d = Dispatcher()
+        calls = []
+        d.register('privmsg', lambda user, msg: calls.append(msg.command))
+        assert(d.dispatch(None, parse('PRIVMSG #a :b')))
+        assert(not d.dispatch(None, parse('NOTICE #a :b')))
+        assert(calls == ['PRIVMSG'])
+
+
+class OutboundTests:
+    def test_round_robin(self):
+        written = []
+        q = OutboundQueue(written.extend)
+        for i in range(3):
+            q.put('PRIVMSG #busy :{0}'.format(i))
+        q.put('PRIVMSG #quiet :hi')
+        q.put('PONG :server')
+
+        assert(written == ['PONG :server'])
+        assert(q.depth() == 4)
+        order = [q._pop()[0] for i in range(4)]
+        assert(order == ['PRIVMSG #busy :0', 'PRIVMSG #quiet :hi',
+                         'PRIVMSG #busy :1', 'PRIVMSG #busy :2'])
+
+    def test_split_utf8(self):
+        data = u'\u00e9' * 10
+        chunks = split_utf8(data.encode('utf-8'), 5)
+        assert([len(c) for c in chunks] == [4, 4, 4, 4, 4])
+        assert(''.join(chunks).decode('utf-8') == data)
+
+        chunks = split_utf8('hello world and more', 12)
+        assert(chunks == ['hello world', 'and more'])
+
+        for budget in (0, -5):
+            try:
+                split_utf8('hello', budget)
+                assert(False)
+            except ValueError:
+                pass
+
+
+class UserListTests:
+    def test_casemapping_lookup(self):
+        users = UserList()
+        user = users.get(u'Nick[1]!real@host')
+        assert(users[u'nick{1}'] is user)
+        assert(users.get(u'NICK{1}!real@other') is user)
+        assert(user.host == u'other')
+
+        users.set_casemapping('ascii')
+        assert(u'nick{1}' not in users)
+        assert(u'nick[1]' in users)
+
+        # Non-ASCII letters are distinct under every casemapping
+        user = users[u'\u00c9mile']
+        assert(u'\u00e9mile' not in users and users[u'\u00c9MILE'] is user)
+
+    def test_rename(self):
+        users = UserList()
+        user = users[u'old']
+        users.rename(user, u'New')
+        assert(u'old' not in users)
+        assert(users[u'new'] is user)
+        assert(len(users) == 1)
+
+    def test_modes(self):
+        user = UserList()[u'nick']
+        assert(user.modes.get(u'#chan') == '' and not user.modes.is_op(u'#chan'))
+
+        user.modes.add(u'#chan', 'q')
+        user.modes.add(u'#chan', 'v')
+        user.modes.add(u'#chan', 'k')
+        assert(user.modes.get(u'#chan') == 'vq')
+        assert(user.modes.is_owner(u'#chan') and not user.modes.is_op(u'#chan'))
+
+        user.modes.remove(u'#chan', 'q')
+        assert(user.modes.get(u'#chan') == 'v')
+        user.modes.remove(u'#chan', -1)
+        user.modes.remove(u'#other', -1)
+        assert(user.modes._modes is None)
+
+
+class ChannelListTests:
+    def test_membership(self):
+        users = UserList()
+        channels = ChannelList(users)
+        channel = channels.add(u'#Chan[1]')
+        assert(channels.add(u'#chan{1}') is channel)
+
+        user = users[u'Nick']
+        channel.add(user, ['o'])
+        assert(user in channel and u'NICK' in channel)
+        assert(channel.is_oper(user))
+
+        old_nick = user.nick
+        users.rename(user, u'Other')
+        channels.rename_user(user, old_nick)
+        assert(channel[u'other'] is user and u'nick' not in channel)
+        assert(channel.prefixes(user) == set(['o']))
+
+        for member in channel:
+            channel.remove(member)
+        assert(channel.count() == 0)
+
+        channels.remove(channel)
+        assert(u'#chan[1]' not in channels)
+
+
+class StateSyncTests:
+    def _irc(self, *lines):
+        irc = IRC('Tesla', 'tesla', [], [])
+        for line in lines:
+            irc._parse_message(line)
+        return irc
+
+    def _queued(self, irc):
+        return [irc.outbound._pop()[0] for i in range(irc.outbound.depth())]
+
+    def test_who(self):
+        irc = self._irc(':Tesla!t@h JOIN #chan', ':Tesla!t@h JOIN #other')
+        assert(self._queued(irc) == ['WHO #chan', 'MODE #chan', 'MODE #other'])
+
+        irc._parse_message(':srv 352 Tesla #chan ~bob b.host srv Bob G*@+ :0 Bob Smith')
+        bob = irc.users[u'bob']
+        assert(bob.real == u'~bob' and bob.host == u'b.host' and bob.away)
+        assert(bob.gecos == u'Bob Smith')
+        assert(irc.channels[u'#chan'].prefixes(bob) == set(['o', 'v']))
+
+        irc._parse_message(':srv 315 Tesla #chan :End of /WHO list.')
+        assert(self._queued(irc) == ['WHO #other'])
+
+    def test_whox(self):
+        irc = self._irc(':srv 005 Tesla WHOX PREFIX=(ov)@+ :are supported',
+                        ':Tesla!t@h JOIN #chan')
+        assert(self._queued(irc)[0] == 'WHO #chan %tcuhnfar,152')
+
+        irc._parse_message(':srv 354 Tesla 152 #chan ~al a.host Al H@ alice :Alice')
+        al = irc.users[u'al']
+        assert(al.account == u'alice' and not al.away)
+        assert(irc.channels[u'#chan'].is_oper(al))
+
+    def test_modes(self):
+        irc = self._irc(':srv 005 Tesla CHANMODES=b,k,l,imnt :are supported',
+                        ':Tesla!t@h JOIN #chan', ':a!b@c JOIN #chan', ':d!e@f JOIN #chan')
+        channel = irc.channels[u'#chan']
+        irc._parse_message(':op!x@y MODE #chan +lbo-k+v 10 *!*@spam a key d')
+        assert(channel.prefixes(irc.users[u'a']) == set(['o']))
+        assert(irc.users[u'd'].modes.is_voice(u'#chan'))
+
+    def test_admin_quit(self):
+        irc = IRC('Tesla', 'tesla', [], ['Boss'])
+        for line in (':Tesla!t@h JOIN #chan', ':Boss!b@h JOIN #chan', ':Bob!b@h JOIN #chan',
+                     ':Boss!b@h QUIT :bye', ':Bob!b@h QUIT :bye', ':Boss!b@h JOIN #chan'):
+            irc._parse_message(line)
+        assert(irc.users[u'boss'].admin)
+        assert(u'bob' not in irc.users)
+
+
+class WorkerPoolTests:
+    def test_strands(self):
+        pool = WorkerPool(4)
+        pool.start()
+        done = threading.Event()
+        results = {'a': [], 'b': []}
+        running = set()
+
+        def task(name, i):
+            # Tasks of a strand must never overlap
+            assert(name not in running)
+            running.add(name)
+            results[name].append(i)
+            running.discard(name)
+            if len(results['a']) == len(results['b']) == 200:
+                done.set()
+
+        a, b = pool.strand('a'), pool.strand('b')
+        for i in range(200):
+            a.submit(task, 'a', i)
+            b.submit(task, 'b', i)
+
+        done.wait(5)
+        pool.stop()
+        assert(results['a'] == range(200) and results['b'] == range(200))
+
+    def test_errors(self):
+        pool = WorkerPool(2)
+        errors = []
+        pool.logger.exception = errors.append
+        pool.start()
+
+        def fail():
+            raise ValueError
+
+        # The last task raises once the strand's queue is empty
+        strand = pool.strand('a')
+        for i in range(3):
+            strand.submit(fail)
+        deadline = time.time() + 5
+        while len(errors) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        pool.stop()
+        assert(len(errors) == 3 and not strand.busy())
+
+
+class EventQueueTests:
+    def test_policies(self):
+        q = EventQueue(2, 'drop-oldest')
+        for i in range(4):
+            q.put(['on_channel_message', [i]])
+        assert([q.get()[1], q.get()[1]] == [[2], [3]])
+        assert(q.dropped == 2 and q.max_depth == 2)
+
+        q = EventQueue(2, 'drop-newest')
+        for i in range(4):
+            q.put(['on_channel_message', [i]])
+        assert([q.get()[1], q.get()[1]] == [[0], [1]])
+
+        q = EventQueue(2, 'coalesce')
+        q.put(['on_channel_message', [0]])
+        q.put(['on_chat_command', [1]])
+        q.put(['on_channel_message', [2]])
+        q.put(['on_ctcp', [3]])
+        assert([q.get()[1], q.get()[1]] == [[1], [2]])
+        assert(q.coalesced == 1 and q.dropped == 1)
+
+        q = EventQueue(1)
+        assert(q.put(['on_connect', []]))
+        assert(not q.put(['on_connect', []]) and q.dropped == 1)
+        assert(q.put(['on_exit', []], force=True) and len(q) == 2)
+
+    def test_hooks(self):
+        hook1, hook2 = Hook(None, ()), Hook(None, ())
+        q = EventQueue(2, 'drop-oldest')
+        q.put(['_run_hook', [hook1]], force=True)
+        for i in range(4):
+            q.put(['on_channel_message', [i]])
+        assert([q.get()[0], q.get()[1]] == ['_run_hook', [3]] and len(q) == 0)
+
+        q = EventQueue(2, 'coalesce')
+        q.put(['_run_hook', [hook1]])
+        q.put(['_run_hook', [hook2]])
+        q.put(['_run_hook', [hook1]])
+        assert([q.get()[1], q.get()[1]] == [[hook2], [hook1]] and q.coalesced == 1)
+
+        # A flood of events must not drop the call of a hook, which would stop it
+        irc = IRCClient('Tesla', 'tesla', [], [], '.', [], workers=2,
+                        queue_size=1, queue_policy='drop-oldest')
+        release = threading.Event()
+        calls = []
+
+        class Slow(PluginBase):
+            def on_channel_message(self, i):
+                release.wait(5)
+
+        plugin = Slow()
+        hook = Hook(lambda: calls.append(1), (), 60)
+        irc._deliver(plugin, 'on_channel_message', [0])
+        irc._fire(plugin, hook)
+        for i in range(1, 20):
+            irc._deliver(plugin, 'on_channel_message', [i])
+        release.set()
+
+        end = time.time() + 5
+        while not calls and time.time() < end:
+            time.sleep(0.01)
+        irc._pool.stop()
+        assert(calls == [1] and not hook.pending)
+
+    def test_pool(self):
+        irc = IRCClient('Tesla', 'tesla', [], [], '.', [], workers=2,
+                        queue_size=5, queue_policy='drop-oldest')
+        release = threading.Event()
+        seen = []
+
+        class Slow(PluginBase):
+            def on_channel_message(self, i):
+                release.wait(5)
+                seen.append(i)
+
+        plugin = Slow()
+        irc._deliver(plugin, 'on_channel_message', [0])
+        while irc.queue_stats()['PluginBase']['depth']:
+            time.sleep(0.01)
+        for i in range(1, 20):
+            irc._deliver(plugin, 'on_channel_message', [i])
+        release.set()
+
+        end = time.time() + 5
+        while len(seen) < 6 and time.time() < end:
+            time.sleep(0.01)
+        irc._pool.stop()
+        # The first event was running; the others were cut down to the newest five
+        assert(seen == [0, 15, 16, 17, 18, 19])
+        stats = irc.queue_stats()['PluginBase']
+        assert(stats['dropped'] == 14 and stats['depth'] == 0)
+
+
+class PerfTests:
+    def test_histogram(self):
+        h = Histogram()
+        for ms in range(1, 101):
+            h.add(ms / 1000.0)
+        assert(h.count == 100 and h.max == 0.1)
+        assert(h.percentile(50) == 0.05 and h.percentile(95) == 0.1)
+
+    def test_handle_event(self):
+        irc = IRCClient('Tesla', 'tesla', [], [], '.', [])
+
+        class Plugin(PluginBase):
+            def command_echo(self, user, dst, args):
+                return args
+
+            def on_channel_message(self, user, channel, msg):
+                raise ValueError
+
+        plugin = Plugin()
+        plugin.irch = irc
+        assert(irc.handle_event(plugin, 'on_chat_command', [None, '#a', 'echo', 'hi'], 0.5) == 'hi')
+        try:
+            irc.handle_event(plugin, 'on_channel_message', [None, None, 'x'])
+        except ValueError:
+            pass
+
+        events = irc.perf.events('PluginBase')
+        assert(sorted(events) == ['command_echo', 'on_channel_message'])
+        assert(events['command_echo'].wait.max == 0.5)
+        assert(events['on_channel_message'].errors == 1)
+        assert(irc.perf.plugins()['PluginBase'].count == 2)
+
+
+class MetricsTests:
+    def test_server(self):
+        irc = IRCClient('Tesla', 'tesla', [], [], '.', [])
+        irc._parse_message(':server 001 Tesla :Welcome')
+        irc.perf.record('Trivia', 'on_channel_message', 0, 0.25)
+
+        server = MetricsServer(irc, 0)
+        server.start()
+        try:
+            url = 'http://127.0.0.1:{0}/metrics'.format(server._server.server_address[1])
+            lines = urllib2.urlopen(url, timeout=5).read().splitlines()
+        finally:
+            server.stop()
+
+        assert('teslabot_lines_received_total 1' in lines)
+        assert('teslabot_parse_seconds_count 1' in lines)
+        assert('teslabot_parse_seconds_bucket{le="+Inf"} 1' in lines)
+        assert('teslabot_plugin_handler_seconds_total{plugin="Trivia"} 0.25' in lines)
+        assert('# TYPE teslabot_send_queue_depth gauge' in lines)
+
+
+class CacheTests:
+    def test_lru(self):
+        cache = Cache(max_entries=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert(cache.get('a') == 1)
+        cache.set('c', 3)
+        # b was the least recently used entry
+        assert('b' not in cache and cache.get('a') == 1 and cache.get('c') == 3)
+        assert(cache.evictions == 1)
+
+        cache.set('d', 4, ttl=-1)
+        assert(cache.get('d') is None and cache.expirations == 1)
+        calls = []
+        assert(cache.get_or_set('e', lambda: calls.append(1) or 5) == 5)
+        assert(cache.get_or_set('e', lambda: calls.append(1) or 5) == 5 and len(calls) == 1)
+
+    def test_persist(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            cache = Cache(ttl=60, path=path)
+            cache.set('url', u'Title')
+            cache.set('old', u'Stale', ttl=-1)
+            cache.close()
+
+            cache = Cache(path=path)
+            assert(cache.get('url') == u'Title' and cache.get('old') is None)
+            assert(cache.stats()['hits'] == 1)
+            cache.close()
+        finally:
+            os.remove(path)
+
+
+class StatisticsTests:
+    class Nick(object):
+        def __init__(self, nick):
+            self.nick = nick
+
+    class Chan(object):
+        def __init__(self, name):
+            self.name = name
+
+    def _open(self, path):
+        stats = Statistics()
+        stats.path_statsdb = os.path.join(path, 'stats.sqlite3')
+        stats.on_load()
+        return stats
+
+    def _say(self, stats, nick, msg, channel = '#c'):
+        stats.on_channel_message(self.Nick(nick), self.Chan(channel), msg)
+
+    def _count(self, path, query):
+        db = sqlite3.connect(os.path.join(path, 'stats.sqlite3'))
+        try:
+            return db.execute(query).fetchone()[0]
+        finally:
+            db.close()
+
+    def _baseline(self, path):
+        """Creates a database with the schema of the first version of the plugin."""
+        db = sqlite3.connect(os.path.join(path, 'stats.sqlite3'))
+        with open('plugins/statistics/schema.sql') as f:
+            db.executescript(f.read())
+        return db
+
+    def test_migrate(self):
+        path = tempfile.mkdtemp()
+        try:
+            db = self._baseline(path)
+            db.executescript("""
+                INSERT INTO channel (name) VALUES ('#c');
+                INSERT INTO word_list (cid, word, count)
+                    VALUES (1, 'hi', 2), (1, 'hi', 3), (1, '', 7), (1, 'yo', 1);
+                INSERT INTO user (nick, lastseen_time, lastseen_cid)
+                    VALUES ('bob', 10, 1), ('Bob', 20, 1), ('al', 5, 1);
+                INSERT INTO user_statistics (cid, uid, word_count, line_count)
+                    VALUES (1, 1, 5, 1), (1, 2, 6, 2), (1, 3, 1, 1);
+                INSERT INTO channel_visit (cid, count, time) VALUES (1, 5, 100), (1, 9, 110);
+            """)
+            db.close()
+
+            stats = self._open(path)
+            c = stats.conn
+            assert(c.execute('PRAGMA user_version').fetchone()[0] == len(statistics.MIGRATIONS))
+            assert(c.execute('SELECT word, count FROM word_list ORDER BY word').fetchall() ==
+                   [(u'hi', 5), (u'yo', 1)])
+            # Bob's duplicate is merged into the oldest row, with the latest last seen
+            assert(c.execute('SELECT id, nick, lastseen_time FROM user ORDER BY id').fetchall() ==
+                   [(1, u'bob', 20), (3, u'al', 5)])
+            assert(c.execute('SELECT uid, word_count, line_count FROM user_statistics '
+                             'ORDER BY uid').fetchall() == [(1, 11, 3), (3, 1, 1)])
+            assert(c.execute('SELECT count, time FROM channel_peak').fetchall() == [(9, 110)])
+            assert(c.execute('SELECT resolution, start, min, max, total, samples '
+                             'FROM channel_population ORDER BY resolution').fetchall() ==
+                   [(60, 60, 5, 9, 14, 2), (3600, 0, 5, 9, 14, 2), (86400, 0, 5, 9, 14, 2)])
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_migrate_failure(self):
+        path = tempfile.mkdtemp()
+        statistics.MIGRATIONS.append('CREATE TABLE partial (id INTEGER); '
+                                     'INSERT INTO missing VALUES (1);')
+        try:
+            self._baseline(path).close()
+            try:
+                self._open(path)
+                assert(False)
+            except sqlite3.Error:
+                pass
+
+            # The failed migration is rolled back; the ones before it are kept
+            assert(self._count(path, 'PRAGMA user_version') == len(statistics.MIGRATIONS) - 1)
+            assert(self._count(path, "SELECT COUNT(*) FROM sqlite_master "
+                                     "WHERE name = 'partial'") == 0)
+        finally:
+            statistics.MIGRATIONS.pop()
+            shutil.rmtree(path)
+
+    def test_flush_failure(self):
+        path = tempfile.mkdtemp()
+        try:
+            stats = self._open(path)
+            self._say(stats, 'ann', 'one two')
+            stats.update_counter('#c', 4)
+            stats.conn.execute('ALTER TABLE channel_visit RENAME TO visits')
+            stats.flush()
+            # The batch is kept for the next flush
+            assert(len(stats.buffer) == 4)
+
+            self._say(stats, 'ann', 'two')
+            stats.conn.execute('ALTER TABLE visits RENAME TO channel_visit')
+            stats.flush()
+            assert(len(stats.buffer) == 0)
+            c = stats.conn
+            assert(c.execute('SELECT count FROM channel_visit').fetchall() == [(4,)])
+            assert(c.execute("SELECT count FROM word_list WHERE word = 'two'").fetchone() == (2,))
+            assert(c.execute('SELECT word_count, line_count FROM user_statistics').fetchone() == (3, 2))
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_shutdown(self):
+        for workers in (0, 2):
+            path = tempfile.mkdtemp()
+            try:
+                irc = IRCClient('Tesla', 'tesla', [], [], '.', [], workers=workers)
+                stats = self._open(path)
+                irc._plugin_objects = [stats]
+                irc._plugin_callbacks['on_exit'] = [stats]
+                self._say(stats, 'ann', 'bye')
+
+                irc.alive = 0
+                irc.run()
+                assert(stats.conn is None)
+                assert(self._count(path, 'SELECT SUM(count) FROM word_list') == 1)
+                if irc._pool:
+                    irc._pool.stop()
+            finally:
+                shutil.rmtree(path)
+
+    def test_rollups(self):
+        path = tempfile.mkdtemp()
+        try:
+            stats = self._open(path)
+            for count, when in ((5, 3600), (9, 3630), (3, 3700), (2, 7200)):
+                stats.buffer.add_visit('#c', count, when)
+            stats.flush()
+            c = stats.conn
+            assert(c.execute('SELECT resolution, start, min, max, total, samples '
+                             'FROM channel_population ORDER BY resolution, start').fetchall() ==
+                   [(60, 3600, 5, 9, 14, 2), (60, 3660, 3, 3, 3, 1), (60, 7200, 2, 2, 2, 1),
+                    (3600, 3600, 3, 9, 17, 3), (3600, 7200, 2, 2, 2, 1),
+                    (86400, 0, 2, 9, 19, 4)])
+            # The peak only moves for a higher count
+            assert(c.execute('SELECT count, time FROM channel_peak').fetchall() == [(9, 3630)])
+            stats.buffer.add_visit('#c', 9, 9000)
+            stats.buffer.add_visit('#c', 10, 9100)
+            stats.flush()
+            assert(c.execute('SELECT count, time FROM channel_peak').fetchall() == [(10, 9100)])
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_compact(self):
+        path = tempfile.mkdtemp()
+        try:
+            stats = self._open(path)
+            now = int(time.time())
+            for days in (400, 40, 8, 1):
+                stats.buffer.add_visit('#c', days, now - days * 86400)
+            stats.flush()
+            stats.compact()
+            c = stats.conn
+            assert(c.execute('SELECT count FROM channel_visit').fetchall() == [(1,)])
+            assert(c.execute('SELECT resolution, COUNT(*) FROM channel_population '
+                             'GROUP BY resolution').fetchall() == [(60, 2), (3600, 3), (86400, 4)])
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_peak_day(self):
+        path = tempfile.mkdtemp()
+        try:
+            stats = self._open(path)
+            replies = []
+
+            class Client(object):
+                def say(self, msg, dst):
+                    replies.append(msg)
+
+            stats.irch = Client()
+            now = int(time.time())
+            for count, ago in ((50, 90000), (2, 86400 - 120), (4, 3000)):
+                stats.buffer.add_visit('#c', count, now - ago)
+            stats.flush()
+            stats.subcommand_stats_peak(self.Nick('ann'), '#c', 'day #c')
+            assert(replies == [u'In the last 24 hours, #c had between 2 and 4 users online '
+                               u'(3.0 on average).'])
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_id_caches(self):
+        path = tempfile.mkdtemp()
+        try:
+            stats = self._open(path)
+            self._say(stats, 'ann', 'hi')
+            stats.flush()
+            assert(len(stats.users) == 1 and len(stats.channels) == 1)
+
+            # A rollback undoes the insertion of bob, so the cached IDs can't be trusted
+            self._say(stats, 'bob', 'hi')
+            stats.conn.execute('ALTER TABLE user_statistics RENAME TO broken')
+            stats.flush()
+            assert(len(stats.users) == 0 and len(stats.channels) == 0)
+            stats.conn.execute('ALTER TABLE broken RENAME TO user_statistics')
+            stats.flush()
+            c = stats.conn
+            assert(c.execute("SELECT id FROM user WHERE nick = 'bob'").fetchone()[0] ==
+                   stats.get_user_id('Bob'))
+
+            replies = []
+
+            class Client(object):
+                def say(self, msg, dst):
+                    replies.append(msg)
+
+            class Admin(self.Nick):
+                admin = True
+
+            stats.irch = Client()
+            users, channels = stats.users.stats(), stats.channels.stats()
+            stats.subcommand_stats_reset(Admin('root'), '#c', '')
+            assert(replies == ['Statistics database reset.'])
+            assert(len(stats.users) == 0 and len(stats.channels) == 0)
+            # The counters survive a reset
+            assert(stats.users.stats()['hits'] == users['hits'])
+            assert(stats.channels.stats()['misses'] == channels['misses'])
+
+            self._say(stats, 'carl', 'hi')
+            stats.flush()
+            c = stats.conn
+            assert(c.execute("SELECT id FROM user WHERE nick = 'carl'").fetchone()[0] ==
+                   stats.get_user_id('carl') == 1)
+            assert(stats.get_channel_id('#c') == 1)
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_top_words(self):
+        path = tempfile.mkdtemp()
+        try:
+            stats = self._open(path)
+            self._say(stats, 'ann', 'apple apple apple banana')
+            stats.flush()
+            cid = stats.get_channel_id('#c')
+            assert(stats.get_top_words(cid, 0, 5) == [(u'apple', 3), (u'banana', 1)])
+            stats.conn.close()
+
+            # Words counted before the lists are listed again must reach them
+            stats = self._open(path)
+            self._say(stats, 'ann', ' '.join(['banana'] * 10))
+            stats.flush()
+            assert(stats.get_top_words(cid, 0, 5) == [(u'banana', 11), (u'apple', 3)])
+
+            stats.top_words.clear()
+            self._say(stats, 'ann', ' '.join(['apple'] * 9))
+            stats.flush()
+            assert(stats.get_top_words(cid, 0, 5) == [(u'apple', 12), (u'banana', 11)])
+            assert(stats.get_top_words(cid, 5, 5) == [(u'banana', 11)])
+            stats.conn.close()
+        finally:
+            shutil.rmtree(path)
+
+
+class CoroutineTests:
+    def test_task(self):
+        loop = EventLoop()
+        pending = Future(loop)
+
+        def child(value):
+            yield sleep(loop, 0.01)
+            raise Return(value * 2)
+
+        def parent():
+            a, b = yield [Task(loop, child(1)), Task(loop, child(2))]
+            c = yield pending
+            try:
+                yield Task(loop, failing())
+            except KeyError:
+                raise Return(a + b + c)
+
+        def failing():
+            yield sleep(loop, 0)
+            raise KeyError
+
+        task = Task(loop, parent())
+        pending.set_result(10)
+        while not task.done():
+            loop.run_once(0.1)
+        assert(task.result() == 16)
+
+
+class HookTests:
+    def test_hooks(self):
+        irc = IRCClient('Tesla', 'tesla', [], [], '.', [])
+        calls = []
+        delivered = []
+        irc._deliver = lambda plugin, event, args: delivered.append(args[0])
+
+        plugin = PluginBase()
+        plugin.hook(lambda: calls.append('tick'), 0.01)
+        plugin.call_later(0.02, calls.append, 'once')
+        plugin.start(irc)
+
+        end = time.time() + 0.1
+        while time.time() < end:
+            irc.loop.run_once(0.01)
+        # Calls that the plugin hasn't run yet don't pile up
+        assert(len(delivered) == 2)
+
+        for hook in delivered:
+            plugin._run_hook(hook)
+        assert(sorted(calls) == ['once', 'tick'])
+        assert(len(plugin._hooks) == 1)
+
+        plugin.stop_hooks()
+        assert(not plugin._hooks and delivered[0].timer.cancelled)
+
+    def test_dead_thread(self):
+        irc = IRCClient('Tesla', 'tesla', [], [], '.', [])
+        release = threading.Event()
+        calls = []
+
+        class Crashing(PluginBase):
+            def on_channel_message(self):
+                release.wait(5)
+                # Ends the plugin's thread, like an unhandled error would
+                raise SystemExit
+
+        plugin = Crashing()
+        plugin.hook(lambda: calls.append('tick'), 60)
+        plugin.call_later(60, calls.append, 'once')
+        tick, once = plugin._hooks
+
+        irc._deliver(plugin, 'on_channel_message', [])
+        irc._fire(plugin, tick)
+        irc._fire(plugin, once)
+        release.set()
+        irc._plugin_threads['PluginBase'][0].join(5)
+
+        # The calls queued for the dead thread are lost, but the hooks still fire
+        irc._fire(plugin, tick)
+        irc._fire(plugin, once)
+        end = time.time() + 5
+        while len(calls) < 2 and time.time() < end:
+            time.sleep(0.01)
+        assert(sorted(calls) == ['once', 'tick'])
+
+if __name__ == '__main__':
+    tests = FramerTests()
+
+    tests.test_split_across_feeds()
+    tests.test_crlf_split_across_feeds()
+    tests.test_cr_terminator()
+    tests.test_overlong_line_dropped()
+
+    tests = MessageTests()
+
+    tests.test_parse_privmsg()
+    tests.test_parse_without_trailing()
+    tests.test_parse_tags()
+    tests.test_parse_invalid()
+    tests.test_dispatch()
+
+    tests = OutboundTests()
+
+    tests.test_round_robin()
+    tests.test_split_utf8()
+
+    tests = UserListTests()
+
+    tests.test_casemapping_lookup()
+    tests.test_rename()
+    tests.test_modes()
+
+    tests = ChannelListTests()
+
+    tests.test_membership()
+
+    tests = StateSyncTests()
+
+    tests.test_who()
+    tests.test_whox()
+    tests.test_modes()
+    tests.test_admin_quit()
+
+    tests = WorkerPoolTests()
+
+    tests.test_strands()
+    tests.test_errors()
+
+    tests = EventQueueTests()
+
+    tests.test_policies()
+    tests.test_hooks()
+    tests.test_pool()
+
+    tests = PerfTests()
+
+    tests.test_histogram()
+    tests.test_handle_event()
+
+    tests = MetricsTests()
+
+    tests.test_server()
+
+    tests = CacheTests()
+
+    tests.test_lru()
+    tests.test_persist()
+
+    tests = StatisticsTests()
+
+    tests.test_migrate()
+    tests.test_migrate_failure()
+    tests.test_flush_failure()
+    tests.test_shutdown()
+    tests.test_rollups()
+    tests.test_compact()
+    tests.test_peak_day()
+    tests.test_id_caches()
+    tests.test_top_words()
+
+    tests = CoroutineTests()
+
+    tests.test_task()
+
+    tests = HookTests()
+
+    tests.test_hooks()
+    tests.test_dead_thread()
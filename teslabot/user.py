@@ -1,10 +1,54 @@
+from casemapping import casefold, RFC1459
+
+# Channel prefix modes, from the lowest rank to the highest, and their bit in a mask
+PREFIX_MODES = 'vhoaq'
+PREFIX_BITS = dict((mode, 1 << i) for i, mode in enumerate(PREFIX_MODES))
+
+_INTERN_LIMIT = 100000
+_interned = {}
+
+def intern_string(s):
+    """Returns a canonical copy of a string, so that equal idents and hostnames of
+    different users (or of the same user, parsed from every message) are only stored
+    once. Unlike the built-in intern(), this also accepts unicode strings.
+
+    The table is emptied once it holds _INTERN_LIMIT strings. Strings that are still
+    referenced stay alive, they just aren't shared with new copies anymore.
+    """
+    if isinstance(s, str):
+        return intern(s)
+
+    try:
+        return _interned[s]
+    except KeyError:
+        if len(_interned) >= _INTERN_LIMIT:
+            _interned.clear()
+        _interned[s] = s
+        return s
+
+def modes_to_mask(modes):
+    """Returns the bitmask of an iterable of prefix mode letters. Other modes are
+    ignored."""
+    mask = 0
+    for mode in modes:
+        mask |= PREFIX_BITS.get(mode, 0)
+    return mask
+
+def mask_to_modes(mask):
+    """Returns the prefix mode letters of a bitmask, from the lowest rank to the highest."""
+    return ''.join(mode for mode in PREFIX_MODES if mask & PREFIX_BITS[mode])
+
 class User(object):
     """
     Attributes:
         nick: A string of the user's nickname
         real: A string of the user's realname
         host: A string of the user's hostname
-        modes: A list of user modes
+        gecos: A string of the user's real name, as set in the client (known once the
+            user's channel has been synchronised with WHO)
+        account: The services account name of the user, or None (known with WHOX)
+        away: A boolean whether or not the user is marked as away (known with WHO)
+        modes: A UserModes object of the user's channel prefix modes
         idle: A integer of idle time in seconds
         sign: An integer of idle time in UNIX time
         
@@ -14,12 +58,20 @@ class User(object):
         _ahost and _areal: Two strings containing the hostname and realname that a User 
         must match in order to acquire privileges. If no host or real is specified, it defaults
         to the asterik mask.
+
+    The bot may track hundreds of thousands of users, so the class uses __slots__
+    instead of a per-instance dict, and realnames and hostnames are interned.
     """
+    __slots__ = ('nick', 'real', 'host', 'gecos', 'account', 'away', 'modes', 'server',
+                 'idle', 'signon', '_admin', '_ahost', '_areal')
+
     def __init__(self, **kwargs):
         self.nick = kwargs.get('nick', '')
-        self.real = kwargs.get('real', '')
-        self.host = kwargs.get('host', '')
-        self.modes = []
+        self.real = intern_string(kwargs.get('real', ''))
+        self.host = intern_string(kwargs.get('host', ''))
+        self.gecos = ''
+        self.account = None
+        self.away = False
         self.server = kwargs.get('server', False)
         self.idle = 0
         self.signon = 0
@@ -42,12 +94,11 @@ class User(object):
                 return True
             if self._ahost == '*' and self._areal == '*':
                 return True
-        else:
-            return False
+        return False
         
     @admin.setter
     def admin(self, value):
-        self.admin = value
+        self._admin = value
     
     def _parse(self, name):
         delim1 = name.find('!')
@@ -55,8 +106,8 @@ class User(object):
         
         if delim1 > -1 and delim2 > -1:
             self.nick = name[:delim1]
-            self.real = name[delim1 + 1:delim2]
-            self.host = name[delim2 + 1:]
+            self.real = intern_string(name[delim1 + 1:delim2])
+            self.host = intern_string(name[delim2 + 1:])
         else:
             self.nick = name
             
@@ -65,81 +116,116 @@ class User(object):
     
 
 class UserModes(object):
-    """Stores user modes for every channel."""
+    """Stores user prefix modes (v, h, o, a and q) for every channel.
+
+    Attributes:
+        _modes: A dict of channel names and the bitmask of the user's prefix modes
+            (see PREFIX_BITS), or None while the user has no mode in any channel
+    """
+    __slots__ = ('_modes',)
+
     def __init__(self):
-        self._modes = {}
-        self._privileges = {'v': 1, 'o': 2, 'h': 3, 'a': 4, 'q': 5}
+        self._modes = None
 
     def __str__(self):
         output = "<UserModes: {0}>"
         output2 = ''
 
-        for key, value in self._modes.items():
+        for key, value in (self._modes or {}).items():
             output2 += '{0}:'.format(key)
-            for mode in value:
+            for mode in mask_to_modes(value):
                 output2 += ' +{0}'.format(mode)
         return output.format(output2)
        
     def get(self, chan):
-        return self._modes[chan]
+        """Returns a string of the user's prefix modes in a given channel."""
+        if not self._modes:
+            return ''
+        return mask_to_modes(self._modes.get(chan, 0))
+
+    def has(self, chan, mode):
+        """Returns true if the user has a given prefix mode in a given channel."""
+        if not self._modes:
+            return False
+        return bool(self._modes.get(chan, 0) & PREFIX_BITS.get(mode, 0))
 
     def add(self, chan, mode):
-        """Appends a given mode to the user's channel mode list.
+        """Adds a given mode to the user's channel modes.
         Arguments:
-            mode: A single ASCII/UTF-8 letter
+            mode: A single ASCII/UTF-8 letter. Modes that aren't prefix modes are ignored.
         """
-        try:
-            mode_list = self._modes[chan]
-            if mode in mode_list:
-                return
-            mode_list.append(mode)
-        except KeyError:
-            self._modes[chan] = [mode]
+        bit = PREFIX_BITS.get(mode)
+        if bit is None:
+            return
+        if self._modes is None:
+            self._modes = {}
+        self._modes[chan] = self._modes.get(chan, 0) | bit
 
     def remove(self, chan, mode):
-        """Removes a given mode from the user's channel mode list.
+        """Removes a given mode from the user's channel modes.
         Args:
-            mode: A mode string. If -1, wipe the list of modes.
+            mode: A mode string. If -1, wipe the modes of the channel.
             chan: A channel name string
         """
+        if not self._modes or chan not in self._modes:
+            return
+
         if mode == -1:
-            self._modes[chan] = []
-            print(self._modes)
+            mask = 0
         else:
-            mode_list = self._modes[chan]
-            for x in enumerate(mode_list):
-                if x[1] == mode:
-                    mode_list.pop(x[0])
+            mask = self._modes[chan] & ~PREFIX_BITS.get(mode, 0)
+
+        if mask:
+            self._modes[chan] = mask
+        else:
+            del self._modes[chan]
+            if not self._modes:
+                self._modes = None
 
     def is_owner(self, chan):
-        mode_list = self.get(chan)
-        if 'q' in mode_list:
-            return True
-        return False
+        return self.has(chan, 'q')
 
     def is_op(self, chan):
-        mode_list = self.get(chan)
-        if 'o' in mode_list:
-            return True
-        return False
+        return self.has(chan, 'o')
 
     def is_voice(self, chan):
-        mode_list = self.get(chan)
-        if 'v' in mode_list:
-            return True
-        return False
+        return self.has(chan, 'v')
     
 class UserList(object):
-    def __init__(self):
-        self._users = []
+    """Stores every known User object, indexed by casefolded nickname.
+    
+    Attributes:
+        casemapping: The casemapping used to fold nicknames (see casemapping.py)
+        
+        _users: A dict of casefolded nicknames and their User object
+    """
+    def __init__(self, casemapping = RFC1459):
+        self.casemapping = casemapping
+        self._users = {}
+        
+    def _key(self, nick):
+        key = casefold(nick, self.casemapping)
+        # Most nicknames are already lowercase: reuse the nickname object as the key
+        # instead of keeping an equal copy alive
+        return nick if key == nick else key
         
     def __getitem__(self, nick):
-        for i, item in enumerate(self._users):
-            if item.nick.lower() == nick.lower():
-                return self._users[i]
-        user = User(nick=nick)
-        self._users.append(user)
+        """Returns the User object of a given nickname. If it's not already in the list,
+        create a new object."""
+        key = self._key(nick)
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = User(nick=nick)
         return user
+    
+    def __contains__(self, nick):
+        return self._key(nick) in self._users
+    
+    def __len__(self):
+        return len(self._users)
+    
+    def __iter__(self):
+        return iter(self._users.values())
             
     def get(self, src = False, user = False):
         """Returns the User reference of a given source.
@@ -154,21 +240,50 @@ class UserList(object):
         """
         if user:
             return self.__getitem__(user.nick)
-        user = User(src=src)
         
-        for i, item in enumerate(self._users):    
-            if self._users[i].nick.lower() == user.nick.lower():
-                if self._users[i].host != user.host:
-                    self._users[i].host = user.host
-                    
-                if self._users[i].real != user.real:
-                    self._users[i].real = user.real
+        delim = src.find('!')
+        nick = src[:delim] if delim > -1 else src
+        key = self._key(nick)
+        
+        user = self._users.get(key)
+        if user is None:
+            user = self._users[key] = User(src=src)
+            return user
+        
+        if delim > -1:
+            delim2 = src.find('@', delim)
+            if delim2 > -1:
+                real = src[delim + 1:delim2]
+                host = src[delim2 + 1:]
                 
-                return self._users[i]
-            
-        self._users.append(user)
+                if user.host != host:
+                    user.host = intern_string(host)
+                if user.real != real:
+                    user.real = intern_string(real)
         return user
         
     def append(self, user):
         """Appends a User class to the list of users."""
-        self._users.append(user)
\ No newline at end of file
+        self._users[self._key(user.nick)] = user
+        
+    def rename(self, user, nick):
+        """Changes the nickname of a user and re-indexes it."""
+        key = self._key(user.nick)
+        if self._users.get(key) is user:
+            del self._users[key]
+        user.nick = nick
+        self._users[self._key(nick)] = user
+        
+    def remove(self, user):
+        """Removes a given User object from the list."""
+        key = self._key(user.nick)
+        if self._users.get(key) is user:
+            del self._users[key]
+            
+    def set_casemapping(self, casemapping):
+        """Changes the casemapping and re-indexes every user."""
+        self.casemapping = casemapping
+        users = self._users.values()
+        self._users = {}
+        for user in users:
+            self.append(user)
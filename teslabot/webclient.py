@@ -0,0 +1,160 @@
+"""A shared HTTP client for plugins.
+
+Every request goes through a single requests Session, so connections to a site are
+kept alive and reused, and is bounded in every way that a slow or hostile site could
+otherwise abuse: connecting and reading have timeouts, no more than PER_HOST requests
+to a given host run at once, and bodies larger than MAX_SIZE are refused.
+
+Plugins get the client with IRCClient.http(). Its get() blocks, so asynchronous
+plugins use fetch() (or submit()), which run on the client's own threads and return a
+Future:
+
+    r = yield self.irch.http().fetch(url)
+
+Threaded plugins may start several fetches and wait for each of them with
+Future.result(), so that the requests run concurrently.
+"""
+import contextlib
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urlparse import urlparse
+from coroutine import Future
+from workerpool import WorkerPool
+
+class ResponseTooLarge(requests.RequestException):
+    """Raised when the body of a response exceeds the size cap."""
+
+
+class WebClient(object):
+    """A pooled HTTP client with per-host connection limits, timeouts and a size cap.
+
+    Attributes:
+        session: The requests Session used by every request
+        timeout: A (connect, read) tuple of timeouts, in seconds
+        max_size: The maximum number of bytes read from a response body
+        per_host: The maximum number of concurrent requests to a single host
+
+        _loop: The EventLoop of the futures returned by fetch() and submit()
+        _pool: The WorkerPool that runs fetch() and submit(), created on first use
+        _hosts: A dict of host names to the BoundedSemaphore of their requests
+    """
+    CONNECT_TIMEOUT = 5
+    READ_TIMEOUT = 10
+    MAX_SIZE = 1024 * 1024
+    PER_HOST = 4
+    WORKERS = 8
+    CHUNK_SIZE = 16384
+    USER_AGENT = 'Mozilla/5.0 (compatible; Teslabot)'
+
+    def __init__(self, loop, per_host = PER_HOST, workers = WORKERS,
+                 timeout = (CONNECT_TIMEOUT, READ_TIMEOUT), max_size = MAX_SIZE):
+        self.logger = logging.getLogger('teslabot.webclient')
+        self.timeout = timeout
+        self.max_size = max_size
+        self.per_host = per_host
+
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = self.USER_AGENT
+        # Keep as many idle connections per host as there may be concurrent requests
+        adapter = HTTPAdapter(pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._loop = loop
+        self._workers = workers
+        self._pool = None
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            semaphore = self._hosts.get(host)
+            if semaphore is None:
+                semaphore = self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return semaphore
+
+    @contextlib.contextmanager
+    def open(self, url, method = 'GET', **kwargs):
+        """Sends a request and yields the streamed Response, whose body hasn't been
+        read yet. The connection goes back to the pool when the block exits.
+
+            with http.open(url) as r:
+                for chunk in r.iter_content(4096):
+                    ...
+
+        Keyword arguments are passed to Session.request().
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs['stream'] = True
+
+        with self._host(url):
+            r = self.session.request(method, url, **kwargs)
+            try:
+                yield r
+            finally:
+                r.close()
+
+    def get(self, url, max_size = None, **kwargs):
+        """Returns the Response of a GET request, with its body read (r.text, r.json(),
+        etc. can be used as usual).
+
+        Args:
+            url: The URL string
+            max_size: The size cap of this response, instead of the client's max_size
+
+        Raises:
+            ResponseTooLarge: The body is larger than the size cap.
+            requests.RequestException: The request failed or timed out.
+        """
+        return self.request('GET', url, max_size, **kwargs)
+
+    def request(self, method, url, max_size = None, **kwargs):
+        """Like get(), for any method."""
+        limit = max_size or self.max_size
+
+        with self.open(url, method, **kwargs) as r:
+            length = r.headers.get('content-length', '')
+            if length.isdigit() and int(length) > limit:
+                raise ResponseTooLarge('{0} is {1} bytes long.'.format(url, length))
+
+            body = []
+            size = 0
+            for chunk in r.iter_content(self.CHUNK_SIZE):
+                size += len(chunk)
+                if size > limit:
+                    raise ResponseTooLarge('{0} is over {1} bytes long.'.format(url, limit))
+                body.append(chunk)
+
+            r._content = ''.join(body)
+            r._content_consumed = True
+            return r
+
+    def submit(self, func, *args):
+        """Calls func(*args) on one of the client's threads. Returns a Future of its
+        result."""
+        future = Future(self._loop)
+
+        def execute():
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = WorkerPool(self._workers)
+                self._pool.start()
+        self._pool.submit(execute)
+        return future
+
+    def fetch(self, url, **kwargs):
+        """Returns a Future of get(url, **kwargs)."""
+        return self.submit(lambda: self.get(url, **kwargs))
+
+    def close(self):
+        if self._pool:
+            self._pool.stop()
+        self.session.close()
@@ -0,0 +1,133 @@
+import collections
+import logging
+import threading
+
+class Strand(object):
+    """Runs the tasks submitted to it one at a time, in order, on the threads of a
+    WorkerPool. Tasks of different strands may run concurrently.
+
+    Attributes:
+        name: A name used in log messages
+
+        _pool: The WorkerPool that runs the tasks
+        _tasks: A deque of (callable, args) pairs waiting to run
+        _scheduled: Whether or not the strand is queued in (or running on) the pool
+    """
+    def __init__(self, pool, name):
+        self.name = name
+        self._pool = pool
+        self._tasks = collections.deque()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args):
+        """Queues a task. Returns immediately."""
+        with self._lock:
+            self._tasks.append((func, args))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._pool._schedule(self)
+
+    def pending(self):
+        """Returns the number of tasks waiting to run."""
+        return len(self._tasks)
+
+    def busy(self):
+        """Returns True while the strand has a task waiting or running."""
+        return self._scheduled
+
+    def _run_one(self):
+        """Runs the next task, then gives the thread back to the pool. The strand is
+        queued again if it still has tasks, so that a busy strand doesn't hold a thread
+        while other strands are waiting."""
+        with self._lock:
+            func, args = self._tasks.popleft()
+
+        try:
+            func(*args)
+        finally:
+            with self._lock:
+                self._scheduled = bool(self._tasks)
+                reschedule = self._scheduled
+            if reschedule:
+                self._pool._schedule(self)
+
+
+class WorkerPool(object):
+    """A fixed number of threads that run the tasks of strands.
+
+    Each plugin gets a strand, so that its callbacks never run concurrently (plugin
+    state needs no locking) while the number of threads doesn't depend on the
+    number of plugins. Successive tasks of a strand may run on different threads,
+    though, so objects bound to the thread that created them can't be kept across
+    callbacks: e.g. sqlite3 connections must be opened with check_same_thread=False.
+
+    Attributes:
+        size: The number of worker threads
+
+        _ready: A deque of strands that have tasks to run
+        _threads: A list of the worker threads
+    """
+    def __init__(self, size):
+        self.logger = logging.getLogger('teslabot.workerpool')
+        self.size = size
+        self.alive = False
+
+        self._ready = collections.deque()
+        self._cond = threading.Condition()
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self.alive:
+                return
+            self.alive = True
+            for i in range(self.size):
+                thread = threading.Thread(target=self._run, name='worker-{0}'.format(i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stops the worker threads once they finish their current task. Pending tasks
+        are dropped."""
+        with self._cond:
+            self.alive = False
+            self._ready.clear()
+            self._cond.notify_all()
+        self._threads = []
+
+    def strand(self, name):
+        """Returns a new Strand that runs on this pool."""
+        return Strand(self, name)
+
+    def submit(self, func, *args):
+        """Queues a task that doesn't need to be serialized with any other task."""
+        Strand(self, getattr(func, '__name__', 'task')).submit(func, *args)
+
+    def pending(self):
+        """Returns the number of strands waiting for a thread."""
+        return len(self._ready)
+
+    def _schedule(self, strand):
+        with self._cond:
+            self._ready.append(strand)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self.alive and not self._ready:
+                    self._cond.wait()
+                if not self.alive:
+                    return
+                strand = self._ready.popleft()
+
+            try:
+                strand._run_one()
+            except SystemExit:
+                # Plugins call sys.exit() to end their own thread when they are unloaded
+                pass
+            except Exception:
+                self.logger.exception('Unhandled exception in [{0}].'.format(strand.name))